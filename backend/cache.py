@@ -0,0 +1,171 @@
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+CACHE_MAX_BYTES = int(os.environ.get('FILEFUSION_CACHE_MAX_BYTES', str(1 << 30)))
+CACHE_MAX_AGE = float(os.environ.get('FILEFUSION_CACHE_MAX_AGE', str(7 * 24 * 3600)))
+
+_ENTRY_RE = re.compile(r'^([0-9a-f]{64})\.([a-z0-9]*)$')
+
+
+class CacheEntry:
+    def __init__(self, path, size, created):
+        self.path = path
+        self.size = size
+        self.created = created
+        self.pins = 0
+
+
+class PendingEntry:
+    """An entry being produced; ``ok`` tells its waiters how it went."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+
+
+class ConversionCache:
+    """Content-addressed file store keyed by sha256(input bytes) and a suffix.
+
+    The server keeps converted outputs keyed by target format and uploaded
+    inputs keyed by their extension. Files live at ``<root>/<digest>.<suffix>``;
+    the index is an OrderedDict in LRU order rebuilt from the directory at
+    startup. Entries in use are pinned so eviction never pulls them out from
+    under a conversion or a send.
+    """
+
+    def __init__(self, root, max_bytes=CACHE_MAX_BYTES, max_age=CACHE_MAX_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            if not _ENTRY_RE.match(name):
+                continue
+            st = os.stat(path)
+            entries.append((st.st_atime, name, CacheEntry(path, st.st_size, st.st_mtime)))
+        for _, name, entry in sorted(entries):
+            self.index[name] = entry
+            self.total_bytes += entry.size
+        with self.lock:
+            self._evict()
+
+    @staticmethod
+    def key(digest, output_format):
+        return f"{digest}.{output_format}"
+
+    def _lookup(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry.created > self.max_age and entry.pins == 0:
+            self._remove(key)
+            return None
+        self.index.move_to_end(key)
+        entry.pins += 1
+        return entry
+
+    def acquire(self, digest, output_format):
+        """Return a pinned path if the entry is cached, else ``None``."""
+        with self.lock:
+            entry = self._lookup(self.key(digest, output_format))
+            if entry is None:
+                return None
+            self.hits += 1
+            return entry.path
+
+    def get_or_create(self, digest, output_format, produce):
+        """Return ``(path, hit)`` for a pinned entry, or ``(None, False)``.
+
+        ``produce(tmp_path)`` runs at most once per key at a time; concurrent
+        callers for the same key wait for it and then share its result, a
+        failure included, so a broken input is not converted once per caller.
+        """
+        key = self.key(digest, output_format)
+        while True:
+            with self.lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    self.hits += 1
+                    return entry.path, True
+                pending = self.inflight.get(key)
+                if pending is None:
+                    pending = self.inflight[key] = PendingEntry()
+                    self.misses += 1
+                    break
+            pending.done.wait()
+            if not pending.ok:
+                return None, False
+
+        final_path = os.path.join(self.root, key)
+        tmp_path = os.path.join(self.root, f".{key}.{uuid.uuid4().hex}.tmp")
+        try:
+            ok = produce(tmp_path)
+            if ok and os.path.exists(tmp_path):
+                os.replace(tmp_path, final_path)
+                with self.lock:
+                    entry = CacheEntry(final_path, os.path.getsize(final_path), time.time())
+                    entry.pins = 1
+                    self.index[key] = entry
+                    self.total_bytes += entry.size
+                    self._evict()
+                pending.ok = True
+                return final_path, False
+            return None, False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self.lock:
+                self.inflight.pop(key).done.set()
+
+    def release(self, path):
+        with self.lock:
+            entry = self.index.get(os.path.basename(path))
+            if entry is not None and entry.pins > 0:
+                entry.pins -= 1
+            self._evict()
+
+    def _remove(self, key):
+        entry = self.index.pop(key)
+        self.total_bytes -= entry.size
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        now = time.time()
+        for key, entry in list(self.index.items()):
+            if entry.pins == 0 and now - entry.created > self.max_age:
+                self._remove(key)
+        for key, entry in list(self.index.items()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if entry.pins == 0:
+                self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.index),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -1,38 +1,275 @@
 import os
+import queue
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+    HAVE_UNO = True
+except ImportError:
+    HAVE_UNO = False
+
+SOFFICE_BIN = shutil.which('soffice') or 'soffice'
+LIBREOFFICE_WORKERS = int(os.environ.get('FILEFUSION_LO_WORKERS', '2'))
+JOB_TIMEOUT = float(os.environ.get('FILEFUSION_LO_TIMEOUT', '120'))
+STARTUP_TIMEOUT = 30.0
+PROFILE_ROOT = os.path.join(tempfile.gettempdir(), 'filefusion_lo')
+
+# storeToURL filter per (document kind, output format)
+EXPORT_FILTERS = {
+    ('writer', 'pdf'): 'writer_pdf_Export',
+    ('writer', 'docx'): 'MS Word 2007 XML',
+    ('writer', 'doc'): 'MS Word 97',
+    ('writer', 'odt'): 'writer8',
+    ('calc', 'pdf'): 'calc_pdf_Export',
+    ('calc', 'xlsx'): 'Calc MS Excel 2007 XML',
+    ('calc', 'xls'): 'MS Excel 97',
+    ('calc', 'ods'): 'calc8',
+    ('impress', 'pdf'): 'impress_pdf_Export',
+    ('impress', 'pptx'): 'Impress MS PowerPoint 2007 XML',
+    ('impress', 'odp'): 'impress8',
+}
+
+
+def _file_url(path):
+    return 'file://' + os.path.abspath(path)
+
+
+def _props(**kwargs):
+    props = []
+    for name, value in kwargs.items():
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        props.append(prop)
+    return tuple(props)
 
-def convert_with_libreoffice(input_path: str, output_path: str, output_format: str) -> bool:
-    try:
-        # Check if soffice is available
-        result = subprocess.run(['soffice', '--version'], capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"[ERROR] LibreOffice not found: {result.stderr}")
-            return False
 
-        print(f"[INFO] Converting: {input_path} -> {output_path} as {output_format}")
-        subprocess.run([
-            'soffice',
-            '--headless',
-            '--convert-to', output_format,
-            '--outdir', os.path.dirname(output_path),
-            input_path
-        ], check=True, capture_output=True, text=True)
+class LibreOfficeWorker:
+    """One long-lived headless soffice with its own profile and pipe endpoint.
 
-        base_name = os.path.splitext(os.path.basename(input_path))[0]
-        generated_file = os.path.join(os.path.dirname(output_path), f"{base_name}.{output_format}")
+    With the UNO bindings available, documents are loaded and exported
+    inside the running instance. Without them there is no instance to keep
+    warm: every job cold-starts soffice --convert-to. The worker still owns
+    an isolated profile, initialised by a throwaway conversion in ``start``,
+    so jobs skip first-run setup and never fight over the shared profile.
+    """
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.pipe_name = f"filefusion_{os.getpid()}_{worker_id}"
+        self.profile_dir = os.path.join(PROFILE_ROOT, f"worker_{worker_id}")
+        self.proc = None
+        self.desktop = None
+        self.jobs_done = 0
+
+    def _base_args(self):
+        return [
+            SOFFICE_BIN,
+            '--headless', '--invisible', '--nologo', '--nodefault',
+            '--norestore', '--nolockcheck',
+            f"-env:UserInstallation={_file_url(self.profile_dir)}",
+        ]
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        if not HAVE_UNO:
+            return self._prime_profile()
+
+        accept = f"--accept=pipe,name={self.pipe_name};urp;StarOffice.ComponentContext"
+        self.proc = subprocess.Popen(self._base_args() + [accept],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        local_ctx = uno.getComponentContext()
+        resolver = local_ctx.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local_ctx)
+        deadline = time.time() + STARTUP_TIMEOUT
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                break
+            try:
+                ctx = resolver.resolve(
+                    f"uno:pipe,name={self.pipe_name};urp;StarOffice.ComponentContext")
+                self.desktop = ctx.ServiceManager.createInstanceWithContext(
+                    'com.sun.star.frame.Desktop', ctx)
+                print(f"[INFO] LibreOffice worker {self.worker_id} ready (pid {self.proc.pid})")
+                return True
+            except Exception:
+                time.sleep(0.25)
+
+        print(f"[ERROR] LibreOffice worker {self.worker_id} failed to start")
+        self.kill()
+        return False
+
+    def _prime_profile(self):
+        """Convert a throwaway document so the profile is set up before the first job."""
+        if os.path.isdir(os.path.join(self.profile_dir, 'user')):
+            return True
+        source = os.path.join(self.profile_dir, 'prime.txt')
+        with open(source, 'w') as f:
+            f.write("FileFusion\n")
+        try:
+            if self._convert_cli(source, os.path.join(self.profile_dir, 'prime.pdf'), 'pdf'):
+                print(f"[INFO] LibreOffice worker {self.worker_id} profile initialised")
+                return True
+        except (subprocess.SubprocessError, OSError) as e:
+            print(f"[ERROR] LibreOffice worker {self.worker_id} profile setup failed: {e}")
+        finally:
+            for name in ('prime.txt', 'prime.pdf'):
+                try:
+                    os.remove(os.path.join(self.profile_dir, name))
+                except FileNotFoundError:
+                    pass
+        print(f"[ERROR] LibreOffice worker {self.worker_id} failed to start")
+        return False
 
-        if not os.path.exists(generated_file):
-            print(f"[ERROR] Conversion failed: Output file {generated_file} not created")
+    def kill(self):
+        self.desktop = None
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+        self.proc = None
+
+    def restart(self):
+        print(f"[WARN] Restarting LibreOffice worker {self.worker_id}")
+        self.kill()
+        return self.start()
+
+    def is_healthy(self):
+        if not HAVE_UNO:
+            return True
+        if self.proc is None or self.proc.poll() is not None or self.desktop is None:
             return False
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return False
+
+    def convert(self, input_path, output_path, output_format):
+        if HAVE_UNO:
+            return self._convert_uno(input_path, output_path, output_format)
+        return self._convert_cli(input_path, output_path, output_format)
+
+    def _convert_uno(self, input_path, output_path, output_format):
+        # A hung export can only be interrupted by killing the instance; the
+        # blocked UNO call then fails with a DisposedException.
+        watchdog = threading.Timer(JOB_TIMEOUT, self.kill)
+        watchdog.start()
+        doc = None
+        try:
+            doc = self.desktop.loadComponentFromURL(
+                _file_url(input_path), '_blank', 0, _props(Hidden=True, ReadOnly=True))
+            if doc is None:
+                print(f"[ERROR] LibreOffice could not open {input_path}")
+                return False
+            if doc.supportsService('com.sun.star.presentation.PresentationDocument'):
+                kind = 'impress'
+            elif doc.supportsService('com.sun.star.sheet.SpreadsheetDocument'):
+                kind = 'calc'
+            else:
+                kind = 'writer'
+            filter_name = EXPORT_FILTERS.get((kind, output_format))
+            if filter_name is None:
+                print(f"[ERROR] No {kind} export filter for {output_format}")
+                return False
+            doc.storeToURL(_file_url(output_path), _props(FilterName=filter_name, Overwrite=True))
+            return os.path.exists(output_path)
+        finally:
+            watchdog.cancel()
+            if doc is not None:
+                try:
+                    doc.close(True)
+                except Exception:
+                    pass
+
+    def _convert_cli(self, input_path, output_path, output_format):
+        outdir = tempfile.mkdtemp(prefix='out_', dir=self.profile_dir)
+        try:
+            subprocess.run(self._base_args() + [
+                '--convert-to', output_format,
+                '--outdir', outdir,
+                input_path
+            ], check=True, capture_output=True, text=True, timeout=JOB_TIMEOUT)
+            base_name = os.path.splitext(os.path.basename(input_path))[0]
+            generated_file = os.path.join(outdir, f"{base_name}.{output_format}")
+            if not os.path.exists(generated_file):
+                print(f"[ERROR] Conversion failed: Output file {generated_file} not created")
+                return False
+            shutil.move(generated_file, output_path)
+            return True
+        finally:
+            shutil.rmtree(outdir, ignore_errors=True)
+
+
+class LibreOfficePool:
+    """Dispatches conversion jobs to a fixed set of warm LibreOffice workers."""
 
-        if generated_file != output_path:
-            os.rename(generated_file, output_path)
+    def __init__(self, size=LIBREOFFICE_WORKERS):
+        self.size = max(1, size)
+        self.workers = [LibreOfficeWorker(i) for i in range(self.size)]
+        self.idle = queue.Queue()
+        self.available = False
 
-        print(f"[INFO] Conversion successful: {output_path}")
+    def start(self):
+        if shutil.which(SOFFICE_BIN) is None:
+            print("[ERROR] LibreOffice not found: soffice is not on PATH")
+            return False
+        if HAVE_UNO:
+            print(f"[INFO] Starting {self.size} LibreOffice workers, mode: UNO")
+        else:
+            print(f"[WARN] python3-uno not installed: the {self.size} LibreOffice workers run "
+                  f"in cold CLI mode, one soffice start per job. Install it for warm workers.")
+        threads = [threading.Thread(target=w.start, daemon=True) for w in self.workers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for w in self.workers:
+            self.idle.put(w)
+        self.available = True
         return True
-    except subprocess.CalledProcessError as e:
-        print(f"[ERROR] LibreOffice conversion failed: {e.stderr}")
-        return False
-    except Exception as e:
-        print(f"[ERROR] Conversion error: {e}")
-        return False
\ No newline at end of file
+
+    def shutdown(self):
+        self.available = False
+        for w in self.workers:
+            w.kill()
+
+    def convert(self, input_path: str, output_path: str, output_format: str) -> bool:
+        if not self.available:
+            print("[ERROR] LibreOffice pool is not running")
+            return False
+
+        worker = self.idle.get()
+        try:
+            if not worker.is_healthy() and not worker.restart():
+                return False
+            print(f"[INFO] Worker {worker.worker_id} converting: {input_path} -> {output_path} as {output_format}")
+            start = time.time()
+            try:
+                ok = worker.convert(input_path, output_path, output_format)
+            except subprocess.TimeoutExpired:
+                print(f"[ERROR] Conversion timed out after {JOB_TIMEOUT:.0f}s")
+                ok = False
+            except subprocess.CalledProcessError as e:
+                print(f"[ERROR] LibreOffice conversion failed: {e.stderr}")
+                ok = False
+            except Exception as e:
+                print(f"[ERROR] Conversion error: {e}")
+                ok = False
+
+            worker.jobs_done += 1
+            if ok:
+                print(f"[INFO] Conversion successful in {time.time() - start:.2f}s: {output_path}")
+            elif not worker.is_healthy():
+                # crashed or killed by the watchdog; bring it back before reuse
+                worker.restart()
+            return ok
+        finally:
+            self.idle.put(worker)
@@ -1,10 +1,17 @@
 import streamlit as st
 import os
-import time
+import json
+import re
+import sys
+import urllib.request
+from collections import deque
 import pandas as pd
 import altair as alt
 from streamlit_autorefresh import st_autorefresh
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.log import LEVELS, LogTail, format_record
+
 # CONFIG
 st.set_page_config(page_title="Client & Server Logs Dashboard", layout="wide")
 st.title("📜 Secure File Transfer Logs Dashboard")
@@ -12,10 +19,125 @@ st.title("📜 Secure File Transfer Logs Dashboard")
 # Paths
 LOG_DIR = "../logs"
 server_log_file = os.path.join(LOG_DIR, "server.log")
+# Lines kept per log for the text areas, and CC rounds graphed per client
+DISPLAY_LINES = 2000
+MAX_ROUNDS = 150
+CC_PATTERN = re.compile(r"cwnd=([\d.]+) ssthresh=([\d.]+) state=(.+)$")
+# The server's live counters (backend/metrics.py)
+METRICS_URL = os.environ.get('FILEFUSION_METRICS_URL', 'http://127.0.0.1:9464/metrics.json')
+
+
+class LogView:
+    """What the dashboard shows for one log file, updated from new bytes only.
+
+    Lives in session_state across autorefreshes, so each refresh costs
+    time proportional to what was logged since the previous one.
+    """
+
+    def __init__(self, path):
+        self.tail = LogTail(path)
+        self.reset()
+
+    def reset(self):
+        self.recent = deque(maxlen=DISPLAY_LINES)
+        self.rounds = {"CWND": [], "SSTHRESH": [], "State": []}
+        self.frame = None
+
+    def update(self):
+        records, restarted = self.tail.read_new()
+        if restarted:
+            self.reset()
+        self.recent.extend(records)
+        for record in records:
+            if len(self.rounds["CWND"]) >= MAX_ROUNDS:
+                break
+            msg = record.get('msg', '')
+            if "[CC]" not in msg:
+                continue
+            match = CC_PATTERN.search(msg)
+            if match:
+                self.rounds["CWND"].append(float(match.group(1)))
+                self.rounds["SSTHRESH"].append(float(match.group(2)))
+                self.rounds["State"].append(match.group(3))
+                self.frame = None
+        return self
+
+    def text(self, min_level):
+        floor = LEVELS[min_level]
+        return "\n".join(format_record(r) for r in self.recent
+                         if LEVELS.get(r.get('level'), 0) >= floor)
+
+    def cc_frames(self):
+        """``(rounds, state bands)`` DataFrames, rebuilt only after new CC lines."""
+        if self.frame is None and self.rounds["CWND"]:
+            df = pd.DataFrame(self.rounds)
+            df.insert(0, "Round", range(1, len(df) + 1))
+            # a band starts wherever the state differs from the round before
+            starts = df.loc[df["State"].ne(df["State"].shift()), ["Round", "State"]]
+            bands_df = pd.DataFrame({
+                "Start": starts["Round"].to_numpy(),
+                "End": starts["Round"].shift(-1, fill_value=len(df) + 1).to_numpy(),
+                "State": starts["State"].to_numpy(),
+            })
+            self.frame = df, bands_df
+        return self.frame
+
+
+def fetch_metrics(url=METRICS_URL):
+    """The server's metrics snapshot, or None while it is not reachable."""
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return json.load(response)
+    except (OSError, ValueError):
+        return None
+
+
+def counter_total(snapshot, name, **labels):
+    return sum(sample['value'] for sample in snapshot['counters'].get(name, [])
+               if all(sample['labels'].get(k) == v for k, v in labels.items()))
+
+
+def log_view(path):
+    views = st.session_state.setdefault("log_views", {})
+    if path not in views:
+        views[path] = LogView(path)
+    return views[path].update()
+
 
 # Refresh
 refresh_interval = st.slider("🔄 Refresh interval (seconds)", 1, 10, 3)
 st_autorefresh(interval=refresh_interval * 1000, key="refresh_counter")
+min_level = st.selectbox("Minimum level", list(LEVELS), index=list(LEVELS).index('debug'))
+
+############################
+# SECTION: Live server metrics
+############################
+st.subheader("📊 Server Metrics")
+snapshot = fetch_metrics()
+if snapshot is None:
+    st.info(f"ℹ️ Metrics endpoint {METRICS_URL} not reachable; showing logs only.")
+else:
+    metric_cols = st.columns(6)
+    metric_cols[0].metric("Open connections",
+                          int(counter_total(snapshot, 'filefusion_open_connections')))
+    metric_cols[1].metric("Bytes in",
+                          int(counter_total(snapshot, 'filefusion_bytes_total', direction='in')))
+    metric_cols[2].metric("Bytes out",
+                          int(counter_total(snapshot, 'filefusion_bytes_total', direction='out')))
+    metric_cols[3].metric("Retransmits",
+                          int(counter_total(snapshot, 'filefusion_retransmits_total')))
+    metric_cols[4].metric("Cache hits",
+                          int(counter_total(snapshot, 'filefusion_cache_lookups_total',
+                                            result='hit')))
+    metric_cols[5].metric("Queued conversions",
+                          int(counter_total(snapshot, 'filefusion_conversions_queued')))
+    transfers = snapshot['transfers'] + snapshot['recent'][::-1]
+    if transfers:
+        st.caption("Transfers in flight, then the most recent finished ones")
+        st.dataframe(pd.DataFrame([
+            {**{k: v for k, v in t.items() if k != 'retransmits'},
+             **{f"retx_{kind}": n for kind, n in t['retransmits'].items()}}
+            for t in transfers]))
 
 # Columns layout: Left (Server logs), Right (Client logs)
 cols = st.columns([1, 2])
@@ -26,16 +148,14 @@ cols = st.columns([1, 2])
 with cols[0]:
     st.subheader("🖥️ Server Logs")
 
-    try:
-        with open(server_log_file, "r") as f:
-            server_logs = f.read()
+    if os.path.exists(server_log_file):
         st.text_area(
             label="Server Log Output",
-            value=server_logs,
+            value=log_view(server_log_file).text(min_level),
             height=400,
             key="server_log_area"
         )
-    except FileNotFoundError:
+    else:
         st.warning("⚠️ Server log not found yet.")
 
 ############################
@@ -48,6 +168,11 @@ with cols[1]:
     client_logs_files = sorted(
         [f for f in os.listdir(LOG_DIR) if f.startswith("client_") and f.endswith(".log")]
     )
+    # forget views of logs the server cleared on restart
+    live_paths = {os.path.join(LOG_DIR, f) for f in client_logs_files} | {server_log_file}
+    for path in list(st.session_state.get("log_views", {})):
+        if path not in live_paths:
+            del st.session_state["log_views"][path]
 
     if not client_logs_files:
         st.info("ℹ️ No client logs found yet.")
@@ -62,11 +187,9 @@ with cols[1]:
                 with col:
                     st.markdown(f"**🗎 {filename}**")
                     try:
-                        with open(os.path.join(LOG_DIR, filename), "r") as f:
-                            client_logs = f.read()
                         st.text_area(
                             label="",
-                            value=client_logs,
+                            value=log_view(os.path.join(LOG_DIR, filename)).text(min_level),
                             height=200,
                             key=f"client_log_{filename}"
                         )
@@ -84,82 +207,16 @@ else:
     for filename in client_logs_files:
         st.markdown(f"### 📌 Graph for {filename}")
 
-        round_numbers = []
-        cwnd_values = []
-        ssthresh_values = []
-        states = []
-
         try:
-            with open(os.path.join(LOG_DIR, filename), "r") as f:
-                round_counter = 1
-                for line in f:
-                    if "[CC]" in line:
-                        # Remove timestamp if present
-                        if "," in line and line[0].isdigit():
-                            _, text = line.strip().split(",", 1)
-                        else:
-                            text = line.strip()
-
-                        tokens = text.split()
-                        cwnd_token = [t for t in tokens if t.startswith("cwnd=")]
-                        ssthresh_token = [t for t in tokens if t.startswith("ssthresh=")]
-                        state_token = [t for t in tokens if t.startswith("state=")]
-
-                        if cwnd_token and ssthresh_token and state_token:
-                            cwnd = float(cwnd_token[0].split("=")[1])
-                            ssthresh = float(ssthresh_token[0].split("=")[1])
-                            state = state_token[0].split("=")[1]
-                            round_numbers.append(round_counter)
-                            cwnd_values.append(cwnd)
-                            ssthresh_values.append(ssthresh)
-                            states.append(state)
-                            round_counter += 1
-
+            frames = log_view(os.path.join(LOG_DIR, filename)).cc_frames()
         except Exception as e:
             st.warning(f"Error reading {filename}: {e}")
             continue
 
-        if not cwnd_values:
+        if frames is None:
             st.info(f"No congestion control logs in {filename}.")
             continue
-
-        # Build DataFrame
-        df = pd.DataFrame({
-            "Round": round_numbers,
-            "CWND": cwnd_values,
-            "SSTHRESH": ssthresh_values,
-            "State": states
-        })
-
-        # ✅ Limit to first 150 rounds
-        df = df[df["Round"] <= 150]
-
-        if df.empty:
-            st.info(f"No data in first 150 rounds for {filename}.")
-            continue
-
-        # Build background shading intervals
-        bands = []
-        if not df.empty:
-            prev_state = df.iloc[0]["State"]
-            start_round = df.iloc[0]["Round"]
-            for i in range(1, len(df)):
-                this_state = df.iloc[i]["State"]
-                if this_state != prev_state:
-                    bands.append({
-                        "Start": start_round,
-                        "End": df.iloc[i]["Round"],
-                        "State": prev_state
-                    })
-                    start_round = df.iloc[i]["Round"]
-                    prev_state = this_state
-            bands.append({
-                "Start": start_round,
-                "End": df.iloc[-1]["Round"] + 1,
-                "State": prev_state
-            })
-
-        bands_df = pd.DataFrame(bands)
+        df, bands_df = frames
 
         # Show data
         st.dataframe(df)
@@ -0,0 +1,248 @@
+import asyncio
+import bisect
+import json
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.transfer import TransferStats
+
+# Local HTTP endpoint serving /metrics (Prometheus text) and /metrics.json;
+# port 0 turns it off
+METRICS_HOST = os.environ.get('FILEFUSION_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('FILEFUSION_METRICS_PORT', '9464'))
+# Finished transfers kept for the JSON view
+RECENT_TRANSFERS = 50
+RTT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SECONDS_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Mirror a total kept elsewhere (collectors call this at scrape time)."""
+        self.values[_key(labels)] = value
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, dict(key), value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            labels = dict(key)
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                yield f"{self.name}_bucket", {**labels, 'le': _number(bound)}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+def _label_value(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class ServerMetrics:
+    """Global counters plus the transfers in flight, rendered on demand.
+
+    Everything is updated from the event loop thread, so no locking.
+    ``collectors`` are called at scrape time to refresh gauges that mirror
+    state kept elsewhere (cache, scheduler).
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.metrics = []
+        self.collectors = []
+        self.active = set()
+        self.recent = deque(maxlen=RECENT_TRANSFERS)
+        self.bytes = self.counter('filefusion_bytes_total', "Bytes of data packets on the wire.")
+        self.delivered = self.counter('filefusion_delivered_bytes_total',
+                                      "File bytes transferred, excluding retransmits.")
+        self.packets = self.counter('filefusion_packets_total', "Data packets sent or received.")
+        self.retransmits = self.counter('filefusion_retransmits_total',
+                                        "Packets sent again, by trigger.")
+        self.dup_acks = self.counter('filefusion_dup_acks_total', "Duplicate ACKs received.")
+        self.duplicates = self.counter('filefusion_duplicate_packets_total',
+                                       "Received packets that were duplicates or dropped.")
+        self.transfers = self.counter('filefusion_transfers_total', "Finished transfers.")
+        self.transfer_seconds = self.histogram('filefusion_transfer_seconds',
+                                               "Duration of finished transfers.", SECONDS_BUCKETS)
+        self.rtt = self.histogram('filefusion_rtt_seconds', "RTT samples taken by senders.",
+                                  RTT_BUCKETS)
+        self.queue_wait = self.histogram('filefusion_queue_wait_seconds',
+                                         "Time conversions waited for a worker.",
+                                         SECONDS_BUCKETS)
+        self.conversion = self.histogram('filefusion_conversion_seconds',
+                                         "Conversion run time by format pair.", SECONDS_BUCKETS)
+        self.connections = self.counter('filefusion_connections_total', "Accepted connections.")
+        self.open_connections = self.gauge('filefusion_open_connections',
+                                           "Connections being served now.")
+        # mirrored from the cache and scheduler by the server's collector
+        self.cache_lookups = self.counter('filefusion_cache_lookups_total',
+                                          "Conversion cache lookups by result.")
+        self.cache_entries = self.gauge('filefusion_cache_entries', "Converted files cached.")
+        self.cache_bytes = self.gauge('filefusion_cache_bytes', "Bytes of converted files cached.")
+        self.conversions_running = self.gauge('filefusion_conversions_running',
+                                              "Conversions running now.")
+        self.conversions_queued = self.gauge('filefusion_conversions_queued',
+                                             "Conversions waiting for a worker.")
+        self.conversions_rejected = self.counter('filefusion_conversions_rejected_total',
+                                                 "Conversions turned away by a full queue.")
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text):
+        metric = Gauge(name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets):
+        metric = Histogram(name, help_text, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def begin(self, conn, direction, cc):
+        """Track a new transfer; pair with ``finish`` in a finally block."""
+        stats = TransferStats(conn, direction, cc)
+        self.active.add(stats)
+        return stats
+
+    def finish(self, stats, ok):
+        self.active.discard(stats)
+        direction = stats.direction
+        self.bytes.inc(stats.bytes, direction=direction)
+        self.delivered.inc(stats.delivered, direction=direction)
+        self.packets.inc(stats.packets, direction=direction)
+        for kind in ('fast', 'timeout', 'sack'):
+            count = getattr(stats, f"{kind}_retransmits")
+            if count:
+                self.retransmits.inc(count, kind=kind)
+        if stats.dup_acks:
+            self.dup_acks.inc(stats.dup_acks)
+        if stats.duplicates:
+            self.duplicates.inc(stats.duplicates)
+        for sample in stats.rtt_samples:
+            self.rtt.observe(sample, cc=stats.cc)
+        outcome = 'ok' if ok else 'error'
+        self.transfers.inc(direction=direction, outcome=outcome)
+        snapshot = stats.snapshot()
+        self.transfer_seconds.observe(snapshot['elapsed'], direction=direction)
+        self.recent.append({**snapshot, 'outcome': outcome, 'finished': time.time()})
+
+    def collect(self):
+        for collector in self.collectors:
+            collector(self)
+
+    def prometheus(self):
+        self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                label_text = ','.join(f'{k}="{_label_value(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {_number(value)}" if label_text
+                             else f"{name} {_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        self.collect()
+        now = time.time()
+        counters = {}
+        histograms = {}
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                histograms[metric.name] = [
+                    {'labels': dict(key), 'count': count, 'sum': round(total, 6)}
+                    for key, (_, total, count) in metric.values.items()]
+            else:
+                counters[metric.name] = [{'labels': labels, 'value': value}
+                                         for _, labels, value in metric.samples()]
+        return {
+            'uptime': round(now - self.started, 1),
+            'counters': counters,
+            'histograms': histograms,
+            'transfers': [stats.snapshot(now) for stats in self.active],
+            'recent': list(self.recent),
+        }
+
+
+async def handle_metrics_request(metrics, reader, writer):
+    try:
+        request_line = (await reader.readline()).decode(errors='replace').split()
+        while (await reader.readline()).strip():
+            pass
+        path = request_line[1].split('?')[0] if len(request_line) > 1 else '/'
+        if path == '/metrics':
+            status, ctype, body = '200 OK', 'text/plain; version=0.0.4', metrics.prometheus()
+        elif path == '/metrics.json':
+            status, ctype, body = '200 OK', 'application/json', json.dumps(metrics.snapshot())
+        else:
+            status, ctype, body = '404 Not Found', 'text/plain', "try /metrics or /metrics.json\n"
+        payload = body.encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode()
+                     + payload)
+        await writer.drain()
+    except (ConnectionError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(metrics, host=METRICS_HOST, port=METRICS_PORT):
+    """Serve ``metrics`` over plain HTTP on the running loop; None if disabled."""
+    if not port:
+        return None
+    return await asyncio.start_server(
+        lambda reader, writer: handle_metrics_request(metrics, reader, writer), host, port)
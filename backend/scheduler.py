@@ -0,0 +1,167 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_CONVERSIONS = int(os.environ.get('FILEFUSION_MAX_CONVERSIONS', '0'))
+QUEUE_LIMIT = int(os.environ.get('FILEFUSION_QUEUE_LIMIT', '32'))
+# Before any history exists for a format, assume this many seconds per MiB
+DEFAULT_SECONDS_PER_MB = 1.0
+MIN_ESTIMATE = 0.5
+HISTORY_ALPHA = 0.3
+# Seconds of expected run time a job gains per second spent waiting, so
+# big files still get their turn under a steady stream of small ones
+AGING = 0.5
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ConversionJob:
+    def __init__(self, job_id, client, kind, size, estimate, fn, future):
+        self.job_id = job_id
+        self.client = client
+        self.kind = kind
+        self.size = size
+        self.estimate = estimate
+        self.fn = fn
+        self.future = future
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+
+class ConversionScheduler:
+    """Bounded conversion queue in front of the LibreOffice pool.
+
+    At most ``concurrency`` jobs run at once on a dedicated thread pool;
+    at most ``max_queue`` more wait. The next job to run comes from the
+    client with the fewest conversions running, and among those the
+    shortest expected job first. Expected run time is size times an
+    EWMA of seconds per byte for the (input, output) format pair, fed by
+    ``record``; waiting jobs age so large files are not starved.
+    """
+
+    def __init__(self, concurrency, max_queue=QUEUE_LIMIT):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                           thread_name_prefix='convert')
+        self.waiting = []
+        self.running = {}
+        self.running_per_client = defaultdict(int)
+        self.seconds_per_byte = {}
+        self.ids = itertools.count(1)
+        self.completed = 0
+        self.rejected = 0
+
+    def full(self):
+        return len(self.waiting) >= self.max_queue
+
+    def estimate(self, kind, size):
+        rate = self.seconds_per_byte.get(kind, DEFAULT_SECONDS_PER_MB / (1 << 20))
+        return max(rate * size, MIN_ESTIMATE)
+
+    def submit(self, client, kind, size, fn):
+        """Queue blocking ``fn()`` for ``client``; the job's future gets its result.
+
+        Must be called from the event loop. Raises QueueFull when the queue
+        is at its limit.
+        """
+        if self.full():
+            self.rejected += 1
+            raise QueueFull(f"{len(self.waiting)} conversions already queued")
+        job = ConversionJob(next(self.ids), client, kind, size, self.estimate(kind, size), fn,
+                            asyncio.get_running_loop().create_future())
+        self.waiting.append(job)
+        self._dispatch()
+        return job
+
+    def cancel(self, job):
+        """Drop a job that has not started; returns False once it is running."""
+        if job not in self.waiting:
+            return False
+        self.waiting.remove(job)
+        job.future.cancel()
+        return True
+
+    def _order(self, now):
+        return sorted(self.waiting, key=lambda j: (self.running_per_client[j.client],
+                                                   j.estimate - AGING * (now - j.submitted),
+                                                   j.job_id))
+
+    def _dispatch(self):
+        while self.waiting and len(self.running) < self.concurrency:
+            job = self._order(time.time())[0]
+            self.waiting.remove(job)
+            self.running[job.job_id] = job
+            self.running_per_client[job.client] += 1
+            job.started = time.time()
+            asyncio.get_running_loop().create_task(self._run(job))
+
+    async def _run(self, job):
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, job.fn)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            job.finished = time.time()
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            del self.running[job.job_id]
+            self.running_per_client[job.client] -= 1
+            if not self.running_per_client[job.client]:
+                del self.running_per_client[job.client]
+            self.completed += 1
+            self._dispatch()
+
+    def record(self, job):
+        """Learn the run time of a finished job for later estimates.
+
+        Only for jobs that really converted: cache hits and failures end
+        early and would drag the estimates towards zero.
+        """
+        if job.size <= 0 or job.finished is None:
+            return
+        rate = (job.finished - job.started) / job.size
+        old = self.seconds_per_byte.get(job.kind)
+        self.seconds_per_byte[job.kind] = rate if old is None else (
+            (1 - HISTORY_ALPHA) * old + HISTORY_ALPHA * rate)
+
+    def position(self, job):
+        """``(queue position, seconds until done)``; position 0 means running."""
+        now = time.time()
+        if job.started is not None:
+            return 0, max(job.estimate - (now - job.started), 0.0)
+        # replay the queue order onto the free-at times of the worker slots
+        slots = [max(j.estimate - (now - j.started), 0.0) for j in self.running.values()]
+        slots += [0.0] * (self.concurrency - len(slots))
+        heapq.heapify(slots)
+        ahead = 0
+        for other in self._order(now):
+            if other is job:
+                break
+            heapq.heappush(slots, heapq.heappop(slots) + other.estimate)
+            ahead += 1
+        return ahead + 1, slots[0] + job.estimate
+
+    def backlog_seconds(self):
+        """Rough time until the queue has drained, used as a retry hint."""
+        queued = sum(j.estimate for j in self.waiting)
+        return queued / self.concurrency + min(
+            (max(j.estimate - (time.time() - j.started), 0.0) for j in self.running.values()),
+            default=0.0)
+
+    def stats(self):
+        return {
+            'running': len(self.running),
+            'queued': len(self.waiting),
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
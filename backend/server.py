@@ -1,24 +1,85 @@
+import asyncio
 import ssl
-import socket
-import threading
 import os
+import sys
 import time
-from collections import defaultdict
-from converter import convert_with_libreoffice
+import uuid
+from converter import EXPORT_FILTERS, LibreOfficePool
+from cache import ConversionCache
+from scheduler import MAX_CONVERSIONS, ConversionScheduler, QueueFull
+from metrics import METRICS_HOST, METRICS_PORT, ServerMetrics, start_metrics_server
 import glob
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import aio
+from common.protocol import (ACK_FIN, CAP_DATAGRAM, CAP_KEEPALIVE, CAP_QUEUE_STATUS, CAP_RESUME,
+                             CAP_RWND, CAP_SACK, CAP_STRIPE, CMD_BYE, CMD_FETCH, CMD_SUBMIT,
+                             END_SEQ,
+                             HELLO_MAGIC, MAX_PACKET_SIZE, QUEUE_STATUS,
+                             RESULT_BUSY, RESULT_ERROR, RESULT_OK, STATUS_BUSY, STATUS_ERROR,
+                             STATUS_HAVE, STATUS_IDLE, STATUS_PENDING, STATUS_QUEUED,
+                             STATUS_READY, STATUS_SEND, STATUS_SESSION, TransferParams,
+                             encode_ack)
+from common.compression import make_codec, offered_codecs
+from common.datagram import HAVE_AESGCM, start_datagram_endpoint
+from common.log import (CONNECTION, DEBUG, ERROR, INFO, TRACE, WARNING, AsyncLog,
+                        bind_connection)
+from common.resume import PartialStore, valid_transfer_id
+from common.impair import Impairment
+from common.congestion import (CONGESTION_CONTROLS, DEFAULT_CONGESTION_CONTROL,
+                               make_congestion_control)
+from common.rtt import RetransmitTimer
+from common.transfer import (HAVE_PWRITE, DelayedAck, PacketSource, PeerWindow, RangeWriter,
+                             Scoreboard, StreamingReceiver, file_sha256)
+
 HOST = '0.0.0.0'
 PORT = 65432
-BUFFER_SIZE = 4096
-PACKET_HEADER_SIZE = 8
+LISTEN_BACKLOG = 1024
+# v2 clients negotiate the packet size in the hello; v1 clients stay on 4 KiB
+PACKET_SIZE = int(os.environ.get('FILEFUSION_PACKET_SIZE', str(64 * 1024)))
+ADAPTIVE_PACKETS = os.environ.get('FILEFUSION_ADAPTIVE_PACKETS', '0') == '1'
+SUPPORTED_CAPS = (CAP_SACK | CAP_QUEUE_STATUS | CAP_RESUME | CAP_RWND | CAP_KEEPALIVE
+                  | (CAP_STRIPE if HAVE_PWRITE else 0) | (CAP_DATAGRAM if HAVE_AESGCM else 0))
+# Upper clamp for the adaptive retransmission timeout (RFC 6298 style)
 TIMEOUT = 50.0
-WINDOW_SIZE = 5
+# Download congestion controller unless a v2 client asks for another
+CONGESTION_CONTROL = os.environ.get('FILEFUSION_CC', DEFAULT_CONGESTION_CONTROL)
+# Packet compression codecs we accept, best first (FILEFUSION_COMPRESSION)
+COMPRESSION_CODECS = offered_codecs()
 UPLOAD_DIR = 'uploads'
+# Interrupted uploads wait here (for FILEFUSION_RESUME_TTL) to be resumed
+PARTIAL_DIR = os.path.join(UPLOAD_DIR, 'partial')
 CONVERTED_DIR = 'converted'
+ALLOWED_EXTENSIONS = [".pptx", ".doc", ".docx", ".odt", ".xls", ".xlsx"]
+# Formats LibreOffice has an export filter for; the name also keys the cache
+# and the metrics, so nothing else is accepted
+OUTPUT_FORMATS = sorted({output_format for _, output_format in EXPORT_FILTERS})
+# Seconds between queue position updates to v2 clients
+QUEUE_UPDATE_INTERVAL = 1.0
+# Striped transfers: at most this many connections per transfer, each
+# carrying at least STRIPE_MIN_BYTES, so only large files get split
+MAX_STRIPES = int(os.environ.get('FILEFUSION_MAX_STRIPES', '8'))
+STRIPE_MIN_BYTES = int(os.environ.get('FILEFUSION_STRIPE_MIN_BYTES', str(16 << 20)))
+# How long a client has to open the extra connections of a striped transfer
+STRIPE_ATTACH_TIMEOUT = 30.0
+# Idle seconds a keep-alive connection waits for its next hello, and a
+# session for its next command, before the server closes it
+KEEPALIVE_TIMEOUT = float(os.environ.get('FILEFUSION_KEEPALIVE_TIMEOUT', '60'))
+# UDP port for the datagram transport (CAP_DATAGRAM); 0 turns it off
+UDP_PORT = int(os.environ.get('FILEFUSION_UDP_PORT', str(PORT)))
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(CONVERTED_DIR, exist_ok=True)
 
+CONVERTER = LibreOfficePool()
+CACHE = ConversionCache(CONVERTED_DIR)
+INPUTS = ConversionCache(UPLOAD_DIR)
+SCHEDULER = ConversionScheduler(MAX_CONVERSIONS or CONVERTER.size)
+PARTIALS = PartialStore(PARTIAL_DIR)
+METRICS = ServerMetrics()
+# The UDP endpoint once started, shared by every datagram channel
+DATAGRAMS = None
+
 LOG_DIR = "../logs"
 os.makedirs(LOG_DIR, exist_ok=True)
 
@@ -28,188 +89,916 @@ for file in glob.glob(os.path.join(LOG_DIR, "client_*.log")):
 
 # Reset server log with timestamp
 LOG_FILE = os.path.join(LOG_DIR, "server.log")
-with open(LOG_FILE, "w") as f:
-    f.write(f"--- Server started at {time.ctime()} ---\n")
+LOG = AsyncLog(LOG_FILE, 'server', mode='w')
+LOG.log(f"--- Server started at {time.ctime()} ---")
 
 
-def log_message(message):
-    print(message)
-    with open(LOG_FILE, "a") as f:
-        f.write(f"{message}\n")
+def log_message(message, level=INFO):
+    LOG.log(message, level)
 
 
-def send_ack(conn, ack_num):
-    conn.sendall(ack_num.to_bytes(4, 'big'))
-    log_message(f"[SERVER] Sent ACK {ack_num}")
+def collect_state(metrics):
+    cache = CACHE.stats()
+    metrics.cache_lookups.set(cache['hits'], result='hit')
+    metrics.cache_lookups.set(cache['misses'], result='miss')
+    metrics.cache_entries.set(cache['entries'])
+    metrics.cache_bytes.set(cache['bytes'])
+    queue = SCHEDULER.stats()
+    metrics.conversions_running.set(queue['running'])
+    metrics.conversions_queued.set(queue['queued'])
+    metrics.conversions_rejected.set(queue['rejected'])
 
-def receive_with_ack(conn, dest_path):
-    filesize = int(conn.recv(16).decode().strip())
-    log_message(f"[SERVER] Expecting {filesize} bytes")
 
-    buffer = {}
-    expected_seq = 0
-    received_bytes = 0
+METRICS.collectors.append(collect_state)
 
-    while received_bytes < filesize:
-        header = conn.recv(PACKET_HEADER_SIZE)
-        seq_num = int.from_bytes(header[:4], 'big')
-        data_len = int.from_bytes(header[4:], 'big')
 
-        if seq_num == 0xFFFFFFFF and data_len == 0:
-            log_message("[SERVER] End of transmission")
-            break
+def send_ack(writer, ack_num, blocks=None, window=None):
+    writer.write(encode_ack(ack_num, blocks, window))
+    log_message(f"[SERVER] Sent ACK {ack_num}{f' SACK {blocks}' if blocks else ''}"
+                f"{f' rwnd={window}' if window is not None else ''}", TRACE)
 
-        data = b''
-        while len(data) < data_len:
-            data += conn.recv(data_len - len(data))
+async def receive_with_ack(reader, writer, dest_path, params=None, offset=0, byte_range=None):
+    """Receive a file into dest_path and return the SHA-256 of its contents.
 
-        buffer[seq_num] = data
+    With an ``offset`` the first that many bytes are already in dest_path
+    and the sender starts right after them. With a ``(start, end)``
+    ``byte_range`` this is one stripe: its bytes go to that range of the
+    existing dest_path, and the digest covers just the range.
+    """
+    params = params or TransferParams()
+    filesize = int((await aio.recv_exact(reader, 16)).decode().strip())
+    log_message(f"[SERVER] Expecting {filesize} bytes"
+                f"{f' (resuming at {offset})' if offset else ''}", DEBUG)
 
-        if seq_num == expected_seq:
-            while expected_seq in buffer:
-                expected_seq += 1
-        send_ack(conn, expected_seq - 1)
-
-    # reconstruct
-    with open(dest_path, 'wb') as f:
-        for seq in sorted(buffer):
-            f.write(buffer[seq])
+    stats = METRICS.begin(CONNECTION.get(), 'in', params.cc)
+    # packets and ACKs take the UDP channel if there is one; END still comes over TLS
+    channel = params.channel
+    if channel:
+        channel.start(reader)
+    ok = False
+    try:
+        with open(dest_path, 'r+b' if byte_range else 'ab' if offset else 'wb') as f:
+            receiver = StreamingReceiver(RangeWriter(f, byte_range[0]) if byte_range else f,
+                                         params.max_packet, codec=make_codec(params.compression))
+            if offset:
+                # hashing a large resumed prefix would stall every other connection
+                await asyncio.get_running_loop().run_in_executor(
+                    None, receiver.preload, dest_path, offset)
+            delayed_ack = DelayedAck()
+
+            def ack():
+                send_ack(channel or writer, receiver.last_in_order,
+                         receiver.sack_blocks() if params.sack else None,
+                         receiver.window() if params.rwnd else None)
+                delayed_ack.sent()
+
+            while True:
+                try:
+                    seq_num, payload = await aio.read_packet(
+                        channel or reader, receiver, delayed_ack.wait(time.time()))
+                except asyncio.TimeoutError:
+                    ack()
+                    await writer.drain()
+                    continue
+                if seq_num is None:
+                    log_message("[SERVER] End of transmission", DEBUG)
+                    if params.fin_ack:
+                        send_ack(writer, ACK_FIN, [] if params.sack else None,
+                                 0 if params.rwnd else None)
+                        await writer.drain()
+                    break
+                stats.packets += 1
+                stats.bytes += receiver.wire_len
+                if not receiver.accept(seq_num, payload):
+                    stats.duplicates += 1
+                stats.delivered = receiver.bytes_written - offset
+                if delayed_ack.on_packet(time.time(), receiver.ack_urgent(filesize)):
+                    ack()
+                    await writer.drain()
+
+        if receiver.bytes_written != filesize:
+            raise ConnectionError(f"Upload truncated: {receiver.bytes_written}/{filesize} bytes")
+        ok = True
+    finally:
+        if channel:
+            channel.stop()
+        METRICS.finish(stats, ok)
+    if receiver.stats and receiver.stats.packets:
+        log_message(f"[SERVER][COMPRESSION] Received {receiver.stats.describe()}")
     log_message(f"[SERVER] File saved to {dest_path}")
-
-
-
-def send_with_ack(conn, file_path):
-    filesize = os.path.getsize(file_path)
-    conn.sendall(str(filesize).encode().ljust(16))
-    log_message(f"[SERVER] Sending file size: {filesize}")
-
-    
-    LOSS_PACKETS = {10, 20}
-    dropped_once = set()
-
-    
-    packets = []
-    with open(file_path, 'rb') as f:
-        seq_num = 0
-        while True:
-            data = f.read(BUFFER_SIZE)
-            if not data:
-                break
-            header = seq_num.to_bytes(4, 'big') + len(data).to_bytes(4, 'big')
-            packets.append((seq_num, header + data))
-            seq_num += 1
-    total_packets = len(packets)
-
-    base = 0
-    next_seq = 0
-    timers = {}
-    dup_acks = defaultdict(int)
-    conn.settimeout(TIMEOUT)
-
-    while base < total_packets:
-        while next_seq < base + WINDOW_SIZE and next_seq < total_packets:
-            seq, pkt_data = packets[next_seq]
-
-            if seq in LOSS_PACKETS and seq not in dropped_once:
-                log_message(f"[SIMULATION] Intentionally dropping Packet {seq}")
-                dropped_once.add(seq)
-                timers[seq] = time.time()  # start timer even though dropped
+    return receiver.sha256.hexdigest()
+
+
+
+async def send_with_ack(reader, writer, file_path, params=None, start=0, byte_range=None):
+    """Send file_path from byte ``start``, or only its ``byte_range`` for one stripe."""
+    params = params or TransferParams()
+    filesize = byte_range[1] - byte_range[0] if byte_range else os.path.getsize(file_path)
+    writer.write(str(filesize).encode().ljust(16))
+    log_message(f"[SERVER] Sending file size: {filesize}"
+                f"{f' (resuming at {start})' if start else ''}", DEBUG)
+
+    source = PacketSource.from_file(file_path, params.packet_size,
+                                    params.peer_max_packet, params.adaptive, start, byte_range)
+    log_message(f"[SERVER] Packet size {source.packet_size}"
+                f"{' (adaptive)' if source.adaptive else ''}", DEBUG)
+    codec = make_codec(params.compression)
+    if codec:
+        reason = source.enable_compression(codec)
+        log_message(f"[SERVER][COMPRESSION] {codec.name} {'on' if source.stats else 'off'}: "
+                    f"{reason}")
+    stats = METRICS.begin(CONNECTION.get(), 'out', params.cc)
+    impairment = Impairment(log=lambda m: log_message(f"[SIMULATION] {m}", DEBUG))
+    # packets and ACKs take the UDP channel if there is one, a datagram each
+    channel = params.channel
+    packets = channel or writer
+    if channel:
+        channel.start()
+        source.batch_bytes = 0
+    ok = False
+    try:
+        base = 0
+        next_seq = 0
+        timer = RetransmitTimer(max_rto=TIMEOUT)
+        scoreboard = Scoreboard()
+        peer_window = PeerWindow()
+        cc = make_congestion_control(params.cc, lambda m: log_message(f"[SERVER][CC] {m}", DEBUG))
+
+        while not source.finished(base):
+            pace_wait = 0.0
+            while next_seq < base + cc.window() and source.has_packet(next_seq):
+                if not peer_window.allows(source, base, next_seq):
+                    peer_window.blocked(time.time())
+                    break
+                pace_wait = cc.pacing_wait(time.time())
+                if pace_wait:
+                    break
+                seq = next_seq
+                cc.on_send(time.time())
+                for out_seq in impairment.outgoing(seq):
+                    stats.bytes += aio.send_packet(packets, source, out_seq)
+                    stats.packets += 1
+                    log_message(f"[SERVER] Sent Packet {out_seq}", TRACE)
+                timer.on_send(seq, time.time())  # the timer runs even for a dropped packet
                 next_seq += 1
+            for seq in impairment.flush():
+                stats.bytes += aio.send_packet(packets, source, seq)
+                stats.packets += 1
+                log_message(f"[SERVER] Sent Packet {seq}", TRACE)
+            if peer_window.probe_due(time.time()) and source.has_packet(next_seq):
+                # the first unacknowledged packet, or the next one if none is out
+                probe = min(base, next_seq)
+                log_message(f"[SERVER] Window probe with Packet {probe} "
+                            f"(rwnd={peer_window.window})", DEBUG)
+                stats.bytes += aio.send_packet(packets, source, probe)
+                stats.packets += 1
+                timer.on_send(probe, time.time(), retransmit=probe < next_seq)
+                next_seq = max(next_seq, probe + 1)
+
+            expired = [seq for seq in timer.expired(time.time())
+                       if seq >= base and seq not in scoreboard.sacked]
+            if expired:
+                scoreboard.on_timeout()
+                cc.on_timeout()
+                log_message(f"[SERVER][RTT] Timeout backoff {timer.rtt.describe()}", DEBUG)
+            for seq in expired:
+                if source.on_loss():
+                    log_message(f"[SERVER] Packet size shrunk to {source.packet_size}", DEBUG)
+                log_message(f"[SERVER] Timeout retransmit of Packet {seq}", DEBUG)
+                stats.bytes += aio.send_packet(packets, source, seq)
+                stats.packets += 1
+                stats.timeout_retransmits += 1
+                timer.on_send(seq, time.time(), retransmit=True)
+
+            aio.flush_packets(packets, source)
+            await writer.drain()
+            try:
+                now = time.time()
+                ack_num, blocks, window = await aio.recv_ack(
+                    channel or reader, params.sack,
+                    min(timer.socket_timeout(now), pace_wait or TIMEOUT,
+                        peer_window.wait(now, TIMEOUT)), params.rwnd)
+            except asyncio.TimeoutError:
                 continue
-
-            conn.sendall(pkt_data)
-            log_message(f"[SERVER] Sent Packet {seq}")
-            timers[seq] = time.time()
-            next_seq += 1
-
-        try:
-            ack_data = conn.recv(4)
-            ack_num = int.from_bytes(ack_data, 'big')
-            log_message(f"[SERVER] Received ACK {ack_num}")
+            log_message(f"[SERVER] Received ACK {ack_num}{f' SACK {blocks}' if blocks else ''}"
+                        f"{f' rwnd={window}' if window is not None else ''}", TRACE)
+            peer_window.update(window)
+
+            if params.sack:
+                scoreboard.update(ack_num, blocks)
+                lost = scoreboard.lost(max(base, ack_num + 1), next_seq)
+                if lost:
+                    cc.on_loss(next_seq)
+                for seq in lost:
+                    if source.on_loss():
+                        log_message(f"[SERVER] Packet size shrunk to {source.packet_size}", DEBUG)
+                    log_message(f"[SERVER] SACK retransmit of Packet {seq}", DEBUG)
+                    stats.bytes += aio.send_packet(packets, source, seq)
+                    stats.packets += 1
+                    stats.sack_retransmits += 1
+                    scoreboard.on_retransmit(seq)
+                    timer.on_send(seq, time.time(), retransmit=True)
 
             if ack_num >= base:
+                newly_acked = ack_num + 1 - base
                 base = ack_num + 1
-                for i in list(timers):
-                    if i <= ack_num:
-                        timers.pop(i, None)
-                dup_acks.clear()
+                now = time.time()
+                rtt_sample = timer.on_ack(ack_num, now)
+                if rtt_sample is not None:
+                    stats.on_rtt(rtt_sample, timer.rtt.srtt)
+                    log_message(f"[SERVER][RTT] {timer.rtt.describe()}", TRACE)
+                stats.delivered = source.offset(base) - start
+                source.release(base)
+                if source.on_progress():
+                    log_message(f"[SERVER] Packet size grown to {source.packet_size}", DEBUG)
+                # NewReno partial ACK: the next hole is lost too
+                if cc.on_ack(ack_num, newly_acked, now, rtt_sample) and base < next_seq \
+                        and base not in scoreboard.sacked:
+                    log_message(f"[SERVER] Partial ACK retransmit of Packet {base}", DEBUG)
+                    stats.bytes += aio.send_packet(packets, source, base)
+                    stats.packets += 1
+                    stats.fast_retransmits += 1
+                    timer.on_send(base, time.time(), retransmit=True)
             else:
-                dup_acks[ack_num] += 1
-                if dup_acks[ack_num] >= 3:
+                stats.dup_acks += 1
+                if not params.sack and cc.on_dupack(ack_num, next_seq):
                     resend_seq = ack_num + 1
-                    if resend_seq < total_packets:
-                        log_message(f"[SERVER] Fast retransmit of Packet {resend_seq}")
-                        conn.sendall(packets[resend_seq][1])
-                        timers[resend_seq] = time.time()
-                    dup_acks[ack_num] = 0
-
-        except socket.timeout:
-            now = time.time()
-            for seq in range(base, next_seq):
-                if now - timers.get(seq, 0) >= TIMEOUT:
-                    log_message(f"[SERVER] Timeout retransmit of Packet {seq}")
-                    conn.sendall(packets[seq][1])
-                    timers[seq] = time.time()
-
-    # End 
-    conn.sendall((0xFFFFFFFF).to_bytes(4, 'big') + (0).to_bytes(4, 'big'))
-    log_message("[SERVER] Finished sending")
-
-
-def handle_client(conn, addr):
+                    if resend_seq < source.cut_count:
+                        if source.on_loss():
+                            log_message(f"[SERVER] Packet size shrunk to {source.packet_size}",
+                                        DEBUG)
+                        log_message(f"[SERVER] Fast retransmit of Packet {resend_seq}", DEBUG)
+                        stats.bytes += aio.send_packet(packets, source, resend_seq)
+                        stats.packets += 1
+                        stats.fast_retransmits += 1
+                        timer.on_send(resend_seq, time.time(), retransmit=True)
+
+        # End 
+        aio.flush_packets(packets, source)
+        writer.write(END_SEQ.to_bytes(4, 'big') + (0).to_bytes(4, 'big'))
+        await writer.drain()
+        if params.fin_ack:
+            await asyncio.wait_for(aio.drain_acks(reader, params.sack, params.rwnd), TIMEOUT)
+        ok = True
+    finally:
+        if channel:
+            channel.stop()
+        source.close()
+        METRICS.finish(stats, ok)
+    if source.stats:
+        log_message(f"[SERVER][COMPRESSION] Sent {source.stats.describe()}")
+    log_message("[SERVER] Finished sending", DEBUG)
+
+
+def normalise_job(request):
+    request['filename'] = os.path.basename(request['filename'])
+    request['output_format'] = request['output_format'].lower()
+    return request
+
+
+def job_error(filename, output_format):
+    """Why the server cannot take a job for ``filename``, or None if it can."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in ALLOWED_EXTENSIONS:
+        return f"Unsupported file type {ext}"
+    if output_format not in OUTPUT_FORMATS:
+        return f"Unsupported output format, expected one of {', '.join(OUTPUT_FORMATS)}"
+    return None
+
+
+async def read_request(reader, timeout=None):
+    """Parse either the v1 preamble or a v2 hello into one request dict.
+
+    ``timeout`` bounds only the wait for the first bytes, as on an idle
+    keep-alive connection.
+    """
+    head = await asyncio.wait_for(aio.recv_exact(reader, 4), timeout)
+    if head == HELLO_MAGIC:
+        request = await aio.recv_json(reader)
+        request['version'] = 2
+        if request.get('session') or request.get('stripe'):
+            # jobs arrive later as SUBMIT commands, stripes carry no job
+            return request
+    else:
+        name_len = int(head.decode().strip())
+        request = {
+            'version': 1,
+            'filename': (await aio.recv_exact(reader, name_len)).decode(),
+            'output_format': (await aio.recv_exact(reader, 8)).decode().strip(),
+        }
+    return normalise_job(request)
+
+
+def open_channel(request, params, addr, reply):
+    """Move packets onto a UDP channel if the client asked and both sides can (CAP_DATAGRAM).
+
+    Grants go into ``reply``; returns the channel, which the caller closes.
+    """
+    port = request.get('udp_port')
+    if request.get('transport') != 'udp' or not params.caps & CAP_DATAGRAM \
+            or DATAGRAMS is None or not isinstance(port, int) or not 0 < port < 65536:
+        return None
+    channel = DATAGRAMS.open((addr[0], port))
+    params.attach(channel)
+    reply['udp'] = channel.offer()
+    log_message(f"[DATAGRAM] Packets over UDP to {addr[0]}:{port}, "
+                f"packets of up to {params.packet_size} bytes", DEBUG)
+    return channel
+
+
+def negotiate(request):
+    cc_name = request.get('cc')
+    if cc_name not in CONGESTION_CONTROLS:
+        cc_name = CONGESTION_CONTROL
+    return TransferParams.negotiate(request, PACKET_SIZE, MAX_PACKET_SIZE,
+                                    ADAPTIVE_PACKETS, SUPPORTED_CAPS, cc_name, COMPRESSION_CODECS,
+                                    MAX_STRIPES)
+
+
+# Striped transfers waiting for, or running on, their extra connections
+STRIPED = {}
+
+
+class StripedTransfer:
+    """One transfer split into byte ranges over parallel connections (CAP_STRIPE).
+
+    Stripe 0 runs on the connection that announced the transfer. The
+    others run in the handlers of the connections the client opens for
+    them, each as a plain send_with_ack or receive_with_ack of its range
+    of ``path``. Stripes of an upload write into ``path`` at their own
+    offsets, so the file must exist before the transfer is announced.
+    """
+
+    def __init__(self, direction, path, ranges, params):
+        loop = asyncio.get_running_loop()
+        self.stripe_id = uuid.uuid4().hex
+        self.direction = direction
+        self.path = path
+        self.ranges = ranges
+        self.params = params
+        self.attached = [loop.create_future() for _ in ranges]
+        self.done = [loop.create_future() for _ in ranges]
+        STRIPED[self.stripe_id] = self
+
+    def announce(self):
+        """Fields for the JSON frame that goes ahead of the transfer."""
+        return {'stripe_id': self.stripe_id, 'ranges': self.ranges}
+
+    def attach(self, index):
+        """Claim stripe ``index`` for a new connection; False if it isn't expected."""
+        if not isinstance(index, int) or not 0 < index < len(self.ranges) \
+                or self.attached[index].done():
+            return False
+        self.attached[index].set_result(True)
+        return True
+
+    async def run_stripe(self, index, reader, writer):
+        byte_range = self.ranges[index]
+        try:
+            if self.direction == 'in':
+                await receive_with_ack(reader, writer, self.path, self.params,
+                                       byte_range=byte_range)
+            else:
+                await send_with_ack(reader, writer, self.path, self.params,
+                                    byte_range=byte_range)
+        except Exception as e:
+            self.done[index].set_exception(e)
+            raise
+        self.done[index].set_result(True)
+
+    async def run(self, reader, writer):
+        """Run stripe 0 here, then wait for the other stripes to finish."""
+        try:
+            await self.run_stripe(0, reader, writer)
+            await asyncio.wait_for(asyncio.gather(*self.attached[1:]), STRIPE_ATTACH_TIMEOUT)
+            await asyncio.gather(*self.done[1:])
+        finally:
+            STRIPED.pop(self.stripe_id, None)
+            for future in self.done[1:]:
+                if future.done() and not future.cancelled():
+                    future.exception()  # retrieved, so asyncio does not complain
+
+
+def stripe_ranges(size, params):
+    """Byte ranges to stripe ``size`` bytes over, or None to send it whole."""
+    count = min(params.stripes, size // STRIPE_MIN_BYTES) if isinstance(size, int) else 0
+    if count < 2:
+        return None
+    return [[size * i // count, size * (i + 1) // count] for i in range(count)]
+
+
+async def serve_stripe(request, reader, writer):
+    """Handle a connection opened for one stripe of a striped transfer."""
+    transfer = STRIPED.get(request['stripe'])
+    index = request.get('index')
+    if transfer is None or not transfer.attach(index):
+        aio.send_json(writer, {'status': STATUS_ERROR, 'message': "Unknown stripe"})
+        return
+    aio.send_json(writer, {'status': STATUS_SEND})
+    log_message(f"[STRIPE] {transfer.direction} stripe {index}/{len(transfer.ranges)} "
+                f"bytes {transfer.ranges[index][0]}-{transfer.ranges[index][1]}", DEBUG)
+    await transfer.run_stripe(index, reader, writer)
+
+
+def upload_path(filename):
+    return os.path.join(UPLOAD_DIR, f"{int(time.time())}_{uuid.uuid4().hex}_{filename}")
+
+
+async def store_upload(reader, writer, filename, ext, params, expected_digest=None,
+                       partial=None, striped=None):
+    """Receive an upload and move it into the content-addressed INPUTS store.
+
+    Returns ``(digest, pinned input path)``, or ``(None, None)`` if the bytes
+    don't match the digest the client announced. ``partial`` is a claimed
+    ``(transfer ID, part path, offset)`` from PARTIALS: the upload then
+    lands there, and survives a dropped connection for the client to resume.
+    A ``striped`` upload (a StripedTransfer) lands in its own path instead,
+    and is hashed once all stripes are in.
+    """
+    if partial:
+        transfer_id, received_path, offset = partial
+    else:
+        transfer_id, offset = None, 0
+        received_path = striped.path if striped else upload_path(filename)
     try:
-        log_message(f"[SERVER] Connected to {addr}")
-
-        name_len = int(conn.recv(4).decode().strip())
-        filename = conn.recv(name_len).decode()
-        output_format = conn.recv(8).decode().strip().lower()
-
-        ext = os.path.splitext(filename)[1].lower()
-        if ext not in [".pptx", ".doc", ".docx", ".odt", ".xls", ".xlsx"]:
-            conn.sendall(b"ER")
+        if striped:
+            try:
+                await striped.run(reader, writer)
+            except BaseException:
+                os.remove(received_path)
+                raise
+            digest = await asyncio.get_running_loop().run_in_executor(
+                None, file_sha256, received_path)
+        else:
+            digest = await receive_with_ack(reader, writer, received_path, params, offset)
+    finally:
+        if transfer_id:
+            PARTIALS.release(transfer_id)
+    if expected_digest is not None and digest != expected_digest:
+        log_message(f"[SERVER] Digest mismatch for {filename}: got {digest[:12]}", WARNING)
+        os.remove(received_path)
+        if transfer_id:
+            PARTIALS.finish(transfer_id)
+        return None, None
+
+    def produce(tmp_path):
+        os.replace(received_path, tmp_path)
+        return True
+
+    input_path, hit = INPUTS.get_or_create(digest, ext.lstrip('.'), produce)
+    if hit or input_path is None:
+        # already stored, or the store failed for the upload we waited on
+        os.remove(received_path)
+    if transfer_id:
+        PARTIALS.finish(transfer_id)
+    return digest, input_path
+
+
+def claim_partial(request, params, digest):
+    """PARTIALS entry for a resumable upload, or None to upload from scratch."""
+    transfer_id = request.get('transfer_id')
+    if not params.caps & CAP_RESUME or not valid_transfer_id(transfer_id):
+        return None
+    claimed = PARTIALS.open(transfer_id, f"{digest}:{request.get('size')}")
+    if claimed is None:
+        log_message(f"[SERVER] Transfer {transfer_id} is busy elsewhere, not resuming", WARNING)
+        return None
+    part_path, offset = claimed
+    if offset:
+        log_message(f"[SERVER] Resuming upload {transfer_id} at byte {offset}")
+    return transfer_id, part_path, offset
+
+
+def file_etag(path):
+    """Identifies one version of a converted file for download resumption."""
+    stat = os.stat(path)
+    return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+
+async def receive_job(reader, writer, request, params, reply):
+    """Hash-first handshake and upload for one v2 job.
+
+    Answers the job with error/busy/have/send (plus the ``reply`` fields)
+    and receives the upload when needed. Returns ``(digest, input path,
+    output path)`` with whichever of the two paths is pinned. Both paths
+    are ``None`` if the upload was corrupt, and the digest too if the job
+    was turned away before any upload.
+    """
+    filename = request['filename']
+    output_format = request['output_format']
+    ext = os.path.splitext(filename)[1].lower()
+    error = job_error(filename, output_format)
+    if error:
+        aio.send_json(writer, {'status': STATUS_ERROR, 'message': error, **reply})
+        return None, None, None
+
+    # Skip the upload if we already hold the converted result or the
+    # original bytes.
+    digest = request['digest']
+    output_path = CACHE.acquire(digest, output_format)
+    if output_path is None and SCHEDULER.full():
+        # turn the job away before the client spends time uploading
+        retry_after = SCHEDULER.backlog_seconds()
+        log_message(f"[SCHEDULER] Busy, turning away {filename} "
+                    f"retry_after={retry_after:.1f}s", WARNING)
+        aio.send_json(writer, {'status': STATUS_BUSY, 'retry_after': retry_after,
+                               'message': "Conversion queue is full", **reply})
+        return None, None, None
+    input_path = None
+    if output_path is None:
+        input_path = INPUTS.acquire(digest, ext.lstrip('.'))
+    if output_path or input_path:
+        log_message(f"[SERVER] Already have {digest[:12]}, skipping upload")
+        aio.send_json(writer, {'status': STATUS_HAVE, **reply})
+    else:
+        ranges = stripe_ranges(request.get('size'), params)
+        if ranges:
+            # striped uploads are not resumable; they start from scratch
+            striped = StripedTransfer('in', upload_path(filename), ranges, params)
+            with open(striped.path, 'wb') as f:
+                f.truncate(request['size'])
+            log_message(f"[STRIPE] Receiving {filename} over {len(ranges)} connections")
+            aio.send_json(writer, {'status': STATUS_SEND, 'resume_offset': 0,
+                                   **striped.announce(), **reply})
+            _, input_path = await store_upload(reader, writer, filename, ext, params, digest,
+                                               striped=striped)
+        else:
+            partial = claim_partial(request, params, digest)
+            aio.send_json(writer, {'status': STATUS_SEND,
+                                   'resume_offset': partial[2] if partial else 0, **reply})
+            _, input_path = await store_upload(reader, writer, filename, ext, params, digest,
+                                               partial)
+    return digest, input_path, output_path
+
+
+def release_orphaned_result(future):
+    if not future.cancelled() and future.exception() is None and future.result()[0]:
+        CACHE.release(future.result()[0])
+
+
+async def wait_for_job(job, writer=None):
+    """Wait for a scheduled conversion, sending QUEUE_STATUS frames to ``writer``."""
+    try:
+        while True:
+            if writer is not None:
+                position, eta = SCHEDULER.position(job)
+                writer.write(QUEUE_STATUS)
+                aio.send_json(writer, {'job': job.job_id, 'position': position,
+                                       'eta': round(eta, 1)})
+                await writer.drain()
+            done, _ = await asyncio.wait({job.future}, timeout=QUEUE_UPDATE_INTERVAL)
+            if done:
+                return job.future.result()
+    finally:
+        if not job.future.done():
+            # the client went away; don't convert for nobody, and don't
+            # leak the pin of a conversion that is already running
+            if SCHEDULER.cancel(job):
+                log_message(f"[SCHEDULER] Cancelled job {job.job_id}")
+            else:
+                job.future.add_done_callback(release_orphaned_result)
+
+
+async def convert_job(client, filename, output_format, digest, input_path, writer=None):
+    """Return a pinned converted file for ``digest`` (or ``None`` on failure).
+
+    Cache hits return at once; anything else goes through the scheduler,
+    which raises QueueFull when it cannot take more work.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    # another connection may have converted the same bytes meanwhile
+    output_path = CACHE.acquire(digest, output_format)
+    hit = output_path is not None
+    if output_path is None:
+        def produce(tmp_path):
+            log_message("[SERVER] Converting...")
+            return CONVERTER.convert(input_path, tmp_path, output_format)
+
+        job = SCHEDULER.submit(client, (ext, output_format), os.path.getsize(input_path),
+                               lambda: CACHE.get_or_create(digest, output_format, produce))
+        log_message(f"[SCHEDULER] Queued job {job.job_id} {filename} "
+                    f"estimate={job.estimate:.1f}s {SCHEDULER.stats()}")
+        output_path, hit = await wait_for_job(job, writer)
+        if output_path is not None and not hit:
+            SCHEDULER.record(job)
+        if job.started is not None:
+            METRICS.queue_wait.observe(job.started - job.submitted)
+            if not hit:
+                METRICS.conversion.observe(time.time() - job.started,
+                                           kind=f"{ext.lstrip('.')}->{output_format}")
+    stats = CACHE.stats()
+    log_message(f"[CACHE] {'hit' if hit else 'miss'} {digest[:12]}.{output_format} "
+                f"hits={stats['hits']} misses={stats['misses']} "
+                f"entries={stats['entries']} bytes={stats['bytes']}")
+    return output_path
+
+
+class SessionJob:
+    def __init__(self, job_id, output_filename, input_path, output_path):
+        self.job_id = job_id
+        self.output_filename = output_filename
+        self.input_path = input_path
+        self.output_path = output_path
+        self.status = None
+        self.task = None
+
+
+class Session:
+    """Multi-job session: several files over one TLS connection.
+
+    The client drives it with SUBMIT (hash-first handshake and upload) and
+    FETCH (download the next finished result) commands. Each upload is
+    handed to the scheduler as soon as it lands, so conversions run while
+    later files are still streaming in. Results are fetched in completion
+    order and tagged with the client's job ID. Only one transfer is on the
+    wire at a time; ACK_FIN keeps the stream clean between them.
+    """
+
+    def __init__(self, reader, writer, params, client):
+        self.reader = reader
+        self.writer = writer
+        self.params = params
+        self.client = client
+        self.jobs = {}
+        self.finished = asyncio.Queue()
+
+    async def run(self):
+        while True:
+            try:
+                command = await asyncio.wait_for(aio.recv_exact(self.reader, 2),
+                                                 KEEPALIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                log_message(f"[SESSION] Idle for {KEEPALIVE_TIMEOUT:g}s, closing")
+                return
+            if command == CMD_BYE:
+                return
+            body = await aio.recv_json(self.reader)
+            if command == CMD_SUBMIT:
+                await self.submit(body)
+            elif command == CMD_FETCH:
+                await self.fetch(body.get('wait', True))
+            else:
+                raise ValueError(f"Unknown session command {command!r}")
+            await self.writer.drain()
+
+    async def submit(self, body):
+        job_id = body['job']
+        if job_id in self.jobs:
+            aio.send_json(self.writer, {'job': job_id, 'status': STATUS_ERROR,
+                                        'message': "Duplicate job ID"})
             return
-
-        timestamp = int(time.time())
-        input_path = os.path.join(UPLOAD_DIR, f"{timestamp}_{filename}")
+        request = normalise_job(body)
+        digest, input_path, output_path = await receive_job(
+            self.reader, self.writer, request, self.params, {'job': job_id})
+        if input_path is None and output_path is None:
+            if digest is not None:
+                # answered have/send, so the client waits for a verdict
+                aio.send_json(self.writer, {'job': job_id, 'status': STATUS_ERROR,
+                                            'message': "Upload digest mismatch"})
+            return
+        output_filename = f"{os.path.splitext(request['filename'])[0]}.{request['output_format']}"
+        job = SessionJob(job_id, output_filename, input_path, output_path)
+        self.jobs[job_id] = job
+        job.task = asyncio.create_task(self._convert(job, request, digest))
+        aio.send_json(self.writer, {'job': job_id, 'status': STATUS_QUEUED})
+        log_message(f"[SESSION] Job {job_id} accepted ({len(self.jobs)} outstanding)")
+
+    async def _convert(self, job, request, digest):
+        try:
+            if job.output_path is None:
+                job.output_path = await convert_job(self.client, request['filename'],
+                                                     request['output_format'], digest,
+                                                     job.input_path)
+            job.status = STATUS_READY if job.output_path else STATUS_ERROR
+        except QueueFull as e:
+            log_message(f"[SCHEDULER] Rejected {request['filename']}: {e}", WARNING)
+            job.status = STATUS_BUSY
+        except Exception as e:
+            log_message(f"[SESSION] Job {job.job_id} failed: {e}", WARNING)
+            job.status = STATUS_ERROR
+        finally:
+            if job.input_path:
+                INPUTS.release(job.input_path)
+                job.input_path = None
+        self.finished.put_nowait(job)
+
+    async def fetch(self, wait):
+        if not self.jobs:
+            aio.send_json(self.writer, {'status': STATUS_IDLE})
+            return
+        if wait:
+            job = await self.finished.get()
+        else:
+            try:
+                job = self.finished.get_nowait()
+            except asyncio.QueueEmpty:
+                aio.send_json(self.writer, {'status': STATUS_PENDING,
+                                            'outstanding': len(self.jobs)})
+                return
+        del self.jobs[job.job_id]
+        if job.status != STATUS_READY:
+            aio.send_json(self.writer, {'job': job.job_id, 'status': job.status})
+            return
+        ranges = stripe_ranges(os.path.getsize(job.output_path), self.params)
+        striped = StripedTransfer('out', job.output_path, ranges, self.params) if ranges else None
+        aio.send_json(self.writer, {'job': job.job_id, 'status': STATUS_READY,
+                                    'filename': job.output_filename,
+                                    **(striped.announce() if striped else {})})
+        try:
+            if striped:
+                await striped.run(self.reader, self.writer)
+            else:
+                await send_with_ack(self.reader, self.writer, job.output_path, self.params)
+        finally:
+            CACHE.release(job.output_path)
+            job.output_path = None
+
+    async def close(self):
+        tasks = [job.task for job in self.jobs.values() if job.task and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for job in self.jobs.values():
+            if job.input_path:
+                INPUTS.release(job.input_path)
+            if job.output_path:
+                CACHE.release(job.output_path)
+        self.jobs.clear()
+
+
+def keepalive(params):
+    return bool(params.caps & CAP_KEEPALIVE)
+
+
+async def serve_job(reader, writer, request, addr):
+    """Run one single-job request; True if the connection may carry another.
+
+    That is only so with CAP_KEEPALIVE, and only once the job ended on a
+    message boundary: answered, refused or delivered.
+    """
+    input_path = None
+    output_path = None
+    channel = None
+    try:
+        filename = request['filename']
+        output_format = request['output_format']
         output_filename = f"{os.path.splitext(filename)[0]}.{output_format}"
-        output_path = os.path.join(CONVERTED_DIR, f"{timestamp}_{output_filename}")
 
-        receive_with_ack(conn, input_path)
+        if request['version'] == 2:
+            params = negotiate(request)
+            reply = {'max_packet': MAX_PACKET_SIZE, 'caps': params.caps,
+                     'compression': params.compression}
+            if params.caps & CAP_KEEPALIVE:
+                reply['keepalive'] = KEEPALIVE_TIMEOUT
+            channel = open_channel(request, params, addr, reply)
+            digest, input_path, output_path = await receive_job(reader, writer, request,
+                                                                params, reply)
+            if input_path is None and output_path is None:
+                if digest is not None:
+                    writer.write(RESULT_ERROR)
+                return keepalive(params)
+        else:
+            ext = os.path.splitext(filename)[1].lower()
+            if job_error(filename, output_format):
+                writer.write(RESULT_ERROR)
+                return False
+            params = TransferParams(cc=CONGESTION_CONTROL)
+            digest, input_path = await store_upload(reader, writer, filename, ext, params)
+            if input_path is None:
+                # the upload arrived but could not be stored
+                writer.write(RESULT_ERROR)
+                return False
+
+        if output_path is None:
+            try:
+                output_path = await convert_job(
+                    addr[0], filename, output_format, digest, input_path,
+                    writer if params.caps & CAP_QUEUE_STATUS else None)
+            except QueueFull as e:
+                log_message(f"[SCHEDULER] Rejected {filename}: {e}", WARNING)
+                writer.write(RESULT_BUSY)
+                return keepalive(params)
+        if output_path is None:
+            writer.write(RESULT_ERROR)
+            return keepalive(params)
+
+        writer.write(RESULT_OK)
+        writer.write(str(len(output_filename)).encode().ljust(4))
+        writer.write(output_filename.encode())
+
+        start = 0
+        striped = None
+        if params.caps & (CAP_RESUME | CAP_STRIPE):
+            info = {}
+            if params.caps & CAP_RESUME:
+                # resume only into the very file the client already holds part of
+                etag = file_etag(output_path)
+                held = request.get('download') or {}
+                if held.get('etag') == etag and isinstance(held.get('offset'), int) \
+                        and 0 <= held['offset'] <= os.path.getsize(output_path):
+                    start = held['offset']
+                info = {'offset': start, 'etag': etag}
+            ranges = None if start else stripe_ranges(os.path.getsize(output_path), params)
+            if ranges:
+                striped = StripedTransfer('out', output_path, ranges, params)
+                info.update(striped.announce())
+            aio.send_json(writer, info)
+
+        if striped:
+            log_message(f"[STRIPE] Sending {output_filename} over {len(ranges)} connections")
+            await striped.run(reader, writer)
+        else:
+            await send_with_ack(reader, writer, output_path, params, start)
+        return keepalive(params)
+    finally:
+        if channel:
+            channel.close()
+        if input_path:
+            INPUTS.release(input_path)
+        if output_path:
+            CACHE.release(output_path)
+
+
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info('peername')
+    bind_connection(f"{addr[0]}:{addr[1]}")
+    METRICS.connections.inc()
+    METRICS.open_connections.inc()
+    try:
+        log_message(f"[SERVER] Connected to {addr}")
 
-        log_message("[SERVER] Converting...")
-        success = convert_with_libreoffice(input_path, output_path, output_format)
-        if not success:
-            conn.sendall(b"ER")
+        request = await read_request(reader)
+        if request.get('session'):
+            params = negotiate(request)
+            reply = {'status': STATUS_SESSION, 'max_packet': MAX_PACKET_SIZE,
+                     'caps': params.caps, 'compression': params.compression}
+            channel = open_channel(request, params, addr, reply)
+            aio.send_json(writer, reply)
+            log_message(f"[SESSION] Opened for {addr}")
+            session = Session(reader, writer, params, addr[0])
+            try:
+                await session.run()
+            finally:
+                await session.close()
+                if channel:
+                    channel.close()
+            return
+        if request.get('stripe'):
+            await serve_stripe(request, reader, writer)
             return
 
-        conn.sendall(b"OK")
-        conn.sendall(str(len(output_filename)).encode().ljust(4))
-        conn.sendall(output_filename.encode())
-
-        send_with_ack(conn, output_path)
+        while await serve_job(reader, writer, request, addr):
+            try:
+                await writer.drain()
+                request = await read_request(reader, KEEPALIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                log_message(f"[SERVER] Idle for {KEEPALIVE_TIMEOUT:g}s, closing", DEBUG)
+                return
+            except ConnectionError:
+                # the client closed its keep-alive connection between jobs
+                return
+            if request.get('session') or request.get('stripe'):
+                raise ValueError("Only single jobs can follow on a keep-alive connection")
+            log_message(f"[SERVER] Next job on keep-alive connection {addr}", DEBUG)
 
     except Exception as e:
-        log_message(f"[SERVER ERROR] {e}")
+        log_message(f"[SERVER ERROR] {e}", ERROR)
     finally:
-        conn.close()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+        METRICS.open_connections.inc(-1)
         log_message(f"[SERVER] Connection closed {addr}")
 
-def start_server():
+async def start_datagrams(host, port):
+    """Open the UDP endpoint for CAP_DATAGRAM on the running loop (``port`` 0: any free one).
+
+    Returns None without the cryptography package.
+    """
+    global DATAGRAMS
+    if not HAVE_AESGCM:
+        return None
+    DATAGRAMS = await start_datagram_endpoint(
+        host, port, lambda m: log_message(f"[DATAGRAM] {m}", DEBUG))
+    return DATAGRAMS
+
+
+async def start_server():
+    CONVERTER.start()
     context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     context.load_cert_chain(certfile='cert.pem', keyfile='key.pem')
-    raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    raw_sock.bind((HOST, PORT))
-    raw_sock.listen(5)
+    server = await asyncio.start_server(handle_client, HOST, PORT, ssl=context,
+                                        backlog=LISTEN_BACKLOG)
     log_message(f"[SERVER] Listening securely on {HOST}:{PORT}")
-    while True:
-        raw_conn, addr = raw_sock.accept()
-        try:
-            conn = context.wrap_socket(raw_conn, server_side=True)
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
-        except ssl.SSLError as e:
-            print(f"[SSL ERROR] {e}")
-    return  
+    if UDP_PORT and await start_datagrams(HOST, UDP_PORT):
+        log_message(f"[SERVER] Datagram transport on UDP {HOST}:{DATAGRAMS.port}")
+    if await start_metrics_server(METRICS):
+        log_message(f"[SERVER] Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    async with server:
+        await server.serve_forever()
     
 
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    asyncio.run(start_server())
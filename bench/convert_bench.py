@@ -0,0 +1,451 @@
+import argparse
+import csv
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+try:
+    from pptx import Presentation
+    from pptx.util import Inches, Pt
+    HAVE_PPTX = True
+except ImportError:
+    HAVE_PPTX = False
+
+from transfer_bench import git_revision, parse_list
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'backend'))
+import converter
+from converter import LibreOfficePool
+from common.transfer import percentile
+
+# input:output pairs the server is asked for most
+DEFAULT_PAIRS = "pptx:pdf,docx:pdf,xlsx:pdf,doc:docx,odt:pdf,xls:xlsx"
+# Document size multipliers: slides, pages of text or screens of rows
+DEFAULT_SCALES = "1,10,50"
+DEFAULT_CONCURRENCY = "1,2,4"
+PARAGRAPHS_PER_SCALE = 40
+ROWS_PER_SCALE = 200
+# Formats made by converting a generated document with LibreOffice itself
+DERIVED_FROM = {'doc': 'docx', 'odt': 'docx', 'xls': 'xlsx'}
+# How often the RSS sampler walks /proc
+SAMPLE_INTERVAL = 0.05
+LOREM = ("FileFusion converts office documents between formats over a secure transport. "
+         "This paragraph is filler text so that the benchmark documents have realistic "
+         "amounts of text to lay out, hyphenate and render on every page. ")
+SUMMARY_FIELDS = ('phase', 'engine', 'pair', 'scale', 'concurrency', 'jobs', 'failed',
+                  'input_bytes', 'startup_s', 'cold_s', 'warm_p50', 'warm_p95', 'wall_s',
+                  'jobs_per_s', 'peak_rss_mb')
+
+DOCX_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml"
+ ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+</Types>"""
+DOCX_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Target="word/document.xml"
+ Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>
+</Relationships>"""
+XLSX_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml"
+ ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml"
+ ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+</Types>"""
+XLSX_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Target="xl/workbook.xml"
+ Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>
+</Relationships>"""
+XLSX_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+ xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Data" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+XLSX_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Target="worksheets/sheet1.xml"
+ Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>
+</Relationships>"""
+
+
+def write_docx(path, scale):
+    paragraphs = []
+    for i in range(scale * PARAGRAPHS_PER_SCALE):
+        if i % PARAGRAPHS_PER_SCALE == 0:
+            paragraphs.append(f'<w:p><w:r><w:rPr><w:b/><w:sz w:val="32"/></w:rPr>'
+                              f'<w:t>Section {i // PARAGRAPHS_PER_SCALE + 1}</w:t></w:r></w:p>')
+        paragraphs.append(f'<w:p><w:r><w:t>{escape(LOREM * 2)}</w:t></w:r></w:p>')
+    document = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<w:document'
+                ' xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                f'<w:body>{"".join(paragraphs)}</w:body></w:document>')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', DOCX_TYPES)
+        z.writestr('_rels/.rels', DOCX_RELS)
+        z.writestr('word/document.xml', document)
+
+
+def write_xlsx(path, scale):
+    rows = ['<row r="1"><c r="A1" t="inlineStr"><is><t>Item</t></is></c>'
+            '<c r="B1" t="inlineStr"><is><t>Quantity</t></is></c>'
+            '<c r="C1" t="inlineStr"><is><t>Price</t></is></c>'
+            '<c r="D1" t="inlineStr"><is><t>Total</t></is></c></row>']
+    for r in range(2, scale * ROWS_PER_SCALE + 2):
+        rows.append(f'<row r="{r}"><c r="A{r}" t="inlineStr"><is><t>Item {r - 1}</t></is></c>'
+                    f'<c r="B{r}"><v>{r % 17 + 1}</v></c>'
+                    f'<c r="C{r}"><v>{(r * 7919) % 1000 / 10}</v></c>'
+                    f'<c r="D{r}"><f>B{r}*C{r}</f></c></row>')
+    sheet = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+             f'<sheetData>{"".join(rows)}</sheetData></worksheet>')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', XLSX_TYPES)
+        z.writestr('_rels/.rels', XLSX_RELS)
+        z.writestr('xl/workbook.xml', XLSX_WORKBOOK)
+        z.writestr('xl/_rels/workbook.xml.rels', XLSX_WORKBOOK_RELS)
+        z.writestr('xl/worksheets/sheet1.xml', sheet)
+
+
+def write_pptx(path, scale):
+    deck = Presentation()
+    for i in range(scale):
+        slide = deck.slides.add_slide(deck.slide_layouts[1])
+        slide.shapes.title.text = f"Slide {i + 1}"
+        body = slide.placeholders[1].text_frame
+        body.text = LOREM[:80]
+        for line in range(4):
+            body.add_paragraph().text = f"Point {line + 1}: {LOREM[line * 40:line * 40 + 60]}"
+        box = slide.shapes.add_textbox(Inches(1), Inches(6), Inches(8), Inches(1))
+        box.text_frame.text = LOREM
+        box.text_frame.paragraphs[0].font.size = Pt(10)
+    deck.save(path)
+
+
+GENERATORS = {'docx': write_docx, 'xlsx': write_xlsx}
+if HAVE_PPTX:
+    GENERATORS['pptx'] = write_pptx
+
+
+def convert_with_libreoffice(input_path: str, output_path: str, output_format: str) -> bool:
+    """The server's converter before the worker pool: a fresh soffice for every job."""
+    try:
+        # Check if soffice is available
+        result = subprocess.run(['soffice', '--version'], capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"[ERROR] LibreOffice not found: {result.stderr}")
+            return False
+
+        print(f"[INFO] Converting: {input_path} -> {output_path} as {output_format}")
+        subprocess.run([
+            'soffice',
+            '--headless',
+            '--convert-to', output_format,
+            '--outdir', os.path.dirname(output_path),
+            input_path
+        ], check=True, capture_output=True, text=True)
+
+        base_name = os.path.splitext(os.path.basename(input_path))[0]
+        generated_file = os.path.join(os.path.dirname(output_path), f"{base_name}.{output_format}")
+
+        if not os.path.exists(generated_file):
+            print(f"[ERROR] Conversion failed: Output file {generated_file} not created")
+            return False
+
+        if generated_file != output_path:
+            os.rename(generated_file, output_path)
+
+        print(f"[INFO] Conversion successful: {output_path}")
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"[ERROR] LibreOffice conversion failed: {e.stderr}")
+        return False
+    except Exception as e:
+        print(f"[ERROR] Conversion error: {e}")
+        return False
+
+
+def build_corpus(directory, kinds, scales):
+    """``{(kind, scale): path}`` for every kind that can be made here."""
+    kinds = set(kinds) | {DERIVED_FROM[kind] for kind in kinds if kind in DERIVED_FROM}
+    corpus = {}
+    for scale in scales:
+        for kind in sorted(kinds, key=lambda k: k in DERIVED_FROM):
+            path = os.path.join(directory, f"bench_{scale}.{kind}")
+            if kind in GENERATORS:
+                GENERATORS[kind](path, scale)
+            elif kind in DERIVED_FROM and (DERIVED_FROM[kind], scale) in corpus:
+                source = corpus[(DERIVED_FROM[kind], scale)]
+                if not convert_with_libreoffice(source, path, kind):
+                    continue
+            else:
+                continue
+            corpus[(kind, scale)] = path
+    return corpus
+
+
+def descendants(pid):
+    """PIDs of every process below ``pid``, read from /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the command name may hold spaces, so split after its closing paren
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    found, stack = [], [pid]
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            found.append(child)
+            stack.append(child)
+    return found
+
+
+def resident_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class RssSampler:
+    """Peak combined RSS of our child processes (the soffice instances).
+
+    A thread adds up the resident memory of everything below this process
+    every SAMPLE_INTERVAL, so short spikes between samples can be missed.
+    Without /proc the peak stays None.
+    """
+
+    def __init__(self):
+        self.peak = None
+        self.running = False
+        self.thread = None
+
+    def __enter__(self):
+        if os.path.isdir('/proc'):
+            self.peak = 0
+            self.running = True
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while self.running:
+            total = sum(resident_bytes(pid) for pid in descendants(os.getpid()))
+            self.peak = max(self.peak, total)
+            time.sleep(SAMPLE_INTERVAL)
+
+
+class Engine:
+    """A conversion backend under test.
+
+    ``pool`` is the server's LibreOfficePool with one warm worker per
+    concurrent job; ``cli`` is convert_with_libreoffice, which starts a
+    fresh soffice for every job.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.pool = LibreOfficePool(workers) if name == 'pool' else None
+
+    def start(self):
+        """Seconds the engine took to come up, or None if it failed to."""
+        started = time.perf_counter()
+        if self.pool and not self.pool.start():
+            return None
+        return time.perf_counter() - started
+
+    def convert(self, input_path, output_path, output_format):
+        if self.pool:
+            return self.pool.convert(input_path, output_path, output_format)
+        return convert_with_libreoffice(input_path, output_path, output_format)
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown()
+
+
+def timed_convert(engine, input_path, outdir, output_format):
+    output_path = os.path.join(outdir, f"{threading.get_ident()}_{time.perf_counter_ns()}"
+                                       f".{output_format}")
+    started = time.perf_counter()
+    ok = engine.convert(input_path, output_path, output_format)
+    wall = time.perf_counter() - started
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    return ok, wall
+
+
+def latency_phase(engine_name, corpus, pairs, scales, repeat, outdir):
+    """Serial conversions on a fresh engine: the first job of each pair is cold."""
+    engine = Engine(engine_name, 1)
+    startup = engine.start()
+    if startup is None:
+        raise RuntimeError("LibreOffice did not start")
+    jobs, summary = [], []
+    try:
+        for source, target in pairs:
+            for scale in scales:
+                path = corpus.get((source, scale))
+                if path is None:
+                    continue
+                with RssSampler() as rss:
+                    runs = []
+                    for attempt in range(repeat):
+                        ok, wall = timed_convert(engine, path, outdir, target)
+                        first = not runs and not any(j['pair'] == f"{source}->{target}"
+                                                     for j in jobs)
+                        runs.append({'phase': 'latency', 'engine': engine_name,
+                                     'pair': f"{source}->{target}", 'scale': scale,
+                                     'input_bytes': os.path.getsize(path), 'attempt': attempt,
+                                     'cold': first, 'ok': ok, 'wall_s': round(wall, 4)})
+                        print(f"{runs[-1]}", flush=True)
+                jobs += runs
+                warm = [r['wall_s'] for r in runs if r['ok'] and not r['cold']]
+                cold = [r['wall_s'] for r in runs if r['ok'] and r['cold']]
+                summary.append({
+                    'phase': 'latency', 'engine': engine_name, 'pair': f"{source}->{target}",
+                    'scale': scale, 'concurrency': 1, 'jobs': len(runs),
+                    'failed': sum(not r['ok'] for r in runs),
+                    'input_bytes': os.path.getsize(path), 'startup_s': round(startup, 4),
+                    'cold_s': cold[0] if cold else None,
+                    'warm_p50': percentile(warm, 0.5), 'warm_p95': percentile(warm, 0.95),
+                    'peak_rss_mb': megabytes(rss.peak),
+                })
+    finally:
+        engine.shutdown()
+    return jobs, summary
+
+
+def throughput_phase(engine_name, corpus, pairs, scale, concurrency, jobs_per_worker, outdir):
+    """``concurrency`` jobs at a time, round-robin over the pairs, on a fresh engine."""
+    work = [(corpus[(source, scale)], target) for source, target in pairs
+            if (source, scale) in corpus]
+    if not work:
+        return [], []
+    engine = Engine(engine_name, concurrency)
+    startup = engine.start()
+    if startup is None:
+        raise RuntimeError("LibreOffice did not start")
+    total = concurrency * jobs_per_worker
+    try:
+        with RssSampler() as rss, ThreadPoolExecutor(concurrency) as executor:
+            started = time.perf_counter()
+            results = list(executor.map(
+                lambda i: timed_convert(engine, work[i % len(work)][0], outdir,
+                                        work[i % len(work)][1]),
+                range(total)))
+            wall = time.perf_counter() - started
+    finally:
+        engine.shutdown()
+    walls = [round(w, 4) for ok, w in results if ok]
+    row = {
+        'phase': 'throughput', 'engine': engine_name, 'pair': 'mixed', 'scale': scale,
+        'concurrency': concurrency, 'jobs': total,
+        'failed': sum(not ok for ok, _ in results),
+        'input_bytes': sum(os.path.getsize(work[i % len(work)][0]) for i in range(total)),
+        'startup_s': round(startup, 4), 'warm_p50': percentile(walls, 0.5),
+        'warm_p95': percentile(walls, 0.95), 'wall_s': round(wall, 4),
+        'jobs_per_s': round(len(walls) / wall, 3) if wall > 0 else None,
+        'peak_rss_mb': megabytes(rss.peak),
+    }
+    print(row, flush=True)
+    jobs = [{'phase': 'throughput', 'engine': engine_name, 'concurrency': concurrency,
+             'ok': ok, 'wall_s': round(w, 4)} for ok, w in results]
+    return jobs, [row]
+
+
+def megabytes(size):
+    return None if size is None else round(size / (1 << 20), 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Profile LibreOffice conversion time, memory and throughput per format.")
+    parser.add_argument('--pairs', default=DEFAULT_PAIRS, help="input:output format pairs")
+    parser.add_argument('--scales', default=DEFAULT_SCALES,
+                        help="document sizes (slides, pages of text, screens of rows)")
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY,
+                        help="concurrent jobs (and pool workers) to measure throughput at")
+    parser.add_argument('--repeat', type=int, default=3, help="serial runs per pair and size")
+    parser.add_argument('--jobs-per-worker', type=int, default=4)
+    parser.add_argument('--engine', choices=('pool', 'cli'), default='pool',
+                        help="pool: warm workers as in the server; cli: soffice per job")
+    parser.add_argument('--corpus', help="keep the generated documents in this directory")
+    parser.add_argument('-o', '--output', default='convert_bench',
+                        help="report path without extension; writes .json and .csv")
+    args = parser.parse_args(argv)
+
+    pairs = [tuple(p.split(':')) for p in parse_list(args.pairs, str)]
+    scales = parse_list(args.scales, int)
+    if shutil.which(converter.SOFFICE_BIN) is None:
+        parser.error("soffice is not on PATH; install LibreOffice first")
+    if not HAVE_PPTX and any(source == 'pptx' for source, _ in pairs):
+        print("python-pptx is not installed; skipping pptx inputs")
+
+    scratch = tempfile.mkdtemp(prefix='filefusion_convert_bench_')
+    corpus_dir = args.corpus or os.path.join(scratch, 'corpus')
+    outdir = os.path.join(scratch, 'out')
+    os.makedirs(corpus_dir, exist_ok=True)
+    os.makedirs(outdir)
+    try:
+        corpus = build_corpus(corpus_dir, {source for source, _ in pairs}, scales)
+        corpus_sizes = {f"{kind}@{scale}": os.path.getsize(path)
+                        for (kind, scale), path in corpus.items()}
+        jobs, summary = latency_phase(args.engine, corpus, pairs, scales, args.repeat, outdir)
+        for concurrency in parse_list(args.concurrency, int):
+            more_jobs, rows = throughput_phase(args.engine, corpus, pairs, scales[0],
+                                               concurrency, args.jobs_per_worker, outdir)
+            jobs += more_jobs
+            summary += rows
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = {
+        'revision': git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'engine': args.engine,
+        'uno': converter.HAVE_UNO,
+        'corpus': corpus_sizes,
+        'summary': summary,
+        'jobs': jobs,
+    }
+    output = os.path.abspath(args.output)
+    with open(f"{output}.json", 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(f"{output}.csv", 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(summary)
+    print(f"Wrote {output}.json and {output}.csv")
+    return 1 if any(row['failed'] for row in summary) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
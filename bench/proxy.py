@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import random
+
+# Bytes read per chunk; each chunk is delayed and paced as one unit
+CHUNK_SIZE = 16 * 1024
+# Chunks a direction may have in flight, like a router queue. Once full the
+# proxy stops reading, and the sender feels the bandwidth cap as TCP backpressure.
+QUEUE_CHUNKS = 256
+
+
+class LinkProxy:
+    """TCP proxy that makes loopback look like a slower, farther link.
+
+    Each direction adds ``delay`` plus up to ``jitter`` seconds either way
+    and is capped at ``bandwidth`` bytes per second (0 for no cap). TLS
+    passes straight through. The stream stays in order, as TCP would keep
+    it, so jitter shows up as bursts rather than reordering. Packet loss and
+    reordering are simulated by the senders themselves (common/impair.py),
+    because a proxy cannot drop part of a TLS stream without breaking it.
+    """
+
+    def __init__(self, target_host, target_port, delay=0.0, jitter=0.0, bandwidth=0, seed=None):
+        self.target_host = target_host
+        self.target_port = target_port
+        self.delay = delay
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start listening; returns the port (a free one when ``port`` is 0)."""
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, client_reader, client_writer):
+        try:
+            server_reader, server_writer = await asyncio.open_connection(
+                self.target_host, self.target_port)
+        except OSError:
+            client_writer.close()
+            return
+        await asyncio.gather(self._pipe(client_reader, server_writer),
+                             self._pipe(server_reader, client_writer))
+
+    async def _pipe(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(QUEUE_CHUNKS)
+        pump = loop.create_task(self._pump(chunks, writer))
+        link_free = 0.0
+        last_due = 0.0
+        try:
+            while True:
+                chunk = await reader.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                now = loop.time()
+                if self.bandwidth:
+                    # serialisation: the link is busy until the chunk is through
+                    link_free = max(link_free, now) + len(chunk) / self.bandwidth
+                    now = link_free
+                due = now + self.delay
+                if self.jitter:
+                    due += self.random.uniform(-self.jitter, self.jitter)
+                last_due = max(due, last_due)
+                await chunks.put((last_due, chunk))
+        except ConnectionError:
+            pass
+        finally:
+            await chunks.put(None)
+            await pump
+
+    async def _pump(self, chunks, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                item = await chunks.get()
+                if item is None:
+                    break
+                due, chunk = item
+                wait = due - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                writer.write(chunk)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    host, _, port = args.target.rpartition(':')
+    proxy = LinkProxy(host or '127.0.0.1', int(port), args.delay / 1000, args.jitter / 1000,
+                      args.rate * 125_000, args.seed)
+    listen = await proxy.start(args.host, args.port)
+    print(f"Forwarding {args.host}:{listen} -> {args.target} with {args.delay}ms "
+          f"+/- {args.jitter}ms, {args.rate or 'unlimited'} Mbit/s")
+    await proxy.server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Delay and rate-limit TCP traffic to a server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65433)
+    parser.add_argument('--target', default='127.0.0.1:65432', help="host:port to forward to")
+    parser.add_argument('--delay', type=float, default=0.0, help="one-way delay in ms")
+    parser.add_argument('--jitter', type=float, default=0.0, help="+/- ms around the delay")
+    parser.add_argument('--rate', type=float, default=0.0, help="Mbit/s per direction, 0 for no cap")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
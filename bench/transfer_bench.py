@@ -0,0 +1,342 @@
+import argparse
+import asyncio
+import csv
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from proxy import LinkProxy
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for path in (REPO_DIR, os.path.join(REPO_DIR, 'backend'), os.path.join(REPO_DIR, 'frontend')):
+    sys.path.insert(0, path)
+from common import impair
+from common.congestion import CONGESTION_CONTROLS
+from common.datagram import HAVE_AESGCM
+from common.protocol import CMD_FETCH, STATUS_QUEUED, STATUS_READY, recv_json, send_json
+from common.transfer import TransferStats, percentile
+
+# The runs end-to-end over loopback, through LinkProxy:
+#   client (frontend/transport.py) -> proxy -> server.handle_client (backend/server.py)
+# Sizes accept K/M/G suffixes, e.g. "256K,4M"
+DEFAULT_SIZES = "1M,8M"
+DEFAULT_PACKET_SIZES = "16K,64K"
+DEFAULT_LOSS = "0,0.01"
+# Transports when --transport is not given: UDP too whenever it can run, so
+# the lossy defaults cover both
+DEFAULT_TRANSPORTS = "tcp,udp"
+SEED = 1
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+SUMMARY_FIELDS = ('size', 'packet_size', 'loss', 'cc', 'stripes', 'transport', 'runs', 'failed',
+                  'upload_mbps',
+                  'download_mbps', 'latency_p50', 'latency_p90', 'latency_p99', 'convert_p50',
+                  'upload_rtt_p50', 'upload_rtt_p99', 'download_rtt_p50', 'download_rtt_p99',
+                  'upload_retransmits', 'download_retransmits')
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def parse_list(text, kind):
+    return [kind(item) for item in text.split(',') if item.strip()]
+
+
+def rounded(seconds):
+    return None if seconds is None else round(seconds, 6)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def stub_convert(input_path, output_path, output_format):
+    """Stands in for LibreOffice so a run measures the transfers alone."""
+    shutil.copyfile(input_path, output_path)
+    return True
+
+
+class BenchServer:
+    """The real server's connection handler on a private event loop thread.
+
+    Imported from a scratch working directory, so uploads, the cache and
+    the logs of a run never touch the real ones.
+    """
+
+    def __init__(self, workdir, convert='stub', delay=0.0, jitter=0.0, bandwidth=0):
+        backend_dir = os.path.join(workdir, 'backend')
+        os.makedirs(backend_dir)
+        for name in ('cert.pem', 'key.pem'):
+            shutil.copy(os.path.join(REPO_DIR, 'backend', name), backend_dir)
+        os.chdir(backend_dir)
+        import server
+        import transport
+        self.server = server
+        self.stub = convert == 'stub'
+        server.LOG.echo = False
+        transport.LOG.echo = False
+        if convert == 'stub':
+            server.CONVERTER.convert = stub_convert
+        else:
+            server.CONVERTER.start()
+        self.loop = asyncio.new_event_loop()
+        self.proxy = LinkProxy('127.0.0.1', 0, delay, jitter, bandwidth, SEED)
+        started = threading.Event()
+        threading.Thread(target=self._run, args=(started,), daemon=True).start()
+        started.wait()
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile='cert.pem', keyfile='key.pem')
+        listener = self.loop.run_until_complete(
+            asyncio.start_server(self.server.handle_client, '127.0.0.1', 0, ssl=context))
+        self.proxy.target_port = listener.sockets[0].getsockname()[1]
+        self.port = self.loop.run_until_complete(self.proxy.start())
+        # datagrams go straight to the server, not through the proxy
+        self.loop.run_until_complete(self.server.start_datagrams('127.0.0.1', 0))
+        started.set()
+        self.loop.run_forever()
+
+    def forget(self, tag):
+        """Empty upload and conversion caches, so a repeated document goes all the way."""
+        from cache import ConversionCache
+        self.server.INPUTS = ConversionCache(f"uploads_{tag}")
+        self.server.CACHE = ConversionCache(f"converted_{tag}")
+
+    def last_transfer(self, direction, previous=None, timeout=5.0):
+        """Newest finished transfer in ``direction``, waiting until it is not ``previous``.
+
+        The server files a download only after the client's final ACK, which
+        can be a moment after the client itself is done.
+        """
+        deadline = time.time() + timeout
+        while True:
+            latest = next((snapshot for snapshot in reversed(self.server.METRICS.recent)
+                           if snapshot['direction'] == direction), None)
+            if latest is not previous or time.time() > deadline:
+                return latest
+            time.sleep(0.005)
+
+
+def run_job(bench, data, name, output_format, cc, packets='tcp'):
+    """One upload, conversion and download; returns the measurements of each phase.
+
+    ``packets`` is the transport the data packets take, "tcp" or "udp".
+    """
+    import transport
+    up = TransferStats(None, 'out', cc)
+    previous = bench.last_transfer('out', timeout=0)
+    sock = transport.connect('127.0.0.1', bench.port)
+    params = None
+    try:
+        params = transport.open_session(sock, cc, packets)
+        if packets == 'udp' and not params.channel:
+            raise RuntimeError("server did not grant the UDP transport")
+        started = time.perf_counter()
+        status = transport.submit_job(sock, params, 1, name, data, output_format, stats=up)
+        uploaded = time.perf_counter()
+        if status != STATUS_QUEUED:
+            raise RuntimeError(f"server answered {status}")
+        sock.sendall(CMD_FETCH)
+        send_json(sock, {'wait': True})
+        reply = recv_json(sock)
+        converted = time.perf_counter()
+        if reply['status'] != STATUS_READY:
+            raise RuntimeError(f"job ended {reply['status']}: {reply.get('message')}")
+        dest = os.path.join(os.getcwd(), 'result.bin')
+        if reply.get('ranges'):
+            transport.receive_striped(sock, dest, reply, params=params)
+        else:
+            transport.receive_with_ack(sock, dest, params=params)
+        finished = time.perf_counter()
+        transport.close_session(sock)
+    finally:
+        if params and params.channel:
+            params.channel.close()
+        sock.close()
+    down = bench.last_transfer('out', previous) or {}
+    if bench.stub:
+        with open(dest, 'rb') as f:
+            if hashlib.sha256(f.read()).digest() != hashlib.sha256(data).digest():
+                raise RuntimeError("downloaded bytes differ from the upload")
+    upload_s = uploaded - started
+    download_s = finished - converted
+    return {
+        'upload_s': round(upload_s, 4),
+        'convert_s': round(converted - uploaded, 4),
+        'download_s': round(download_s, 4),
+        'latency_s': round(finished - started, 4),
+        'upload_mbps': round(len(data) * 8 / upload_s / 1e6, 2) if upload_s > 0 else None,
+        'download_mbps': round(os.path.getsize(dest) * 8 / download_s / 1e6, 2)
+        if download_s > 0 else None,
+        'upload_retransmits': up.fast_retransmits + up.timeout_retransmits + up.sack_retransmits,
+        'download_retransmits': sum(down.get('retransmits', {}).values()),
+        'upload_rtt_p50': rounded(percentile(up.rtt_samples, 0.5)),
+        'upload_rtt_p99': rounded(percentile(up.rtt_samples, 0.99)),
+        'download_rtt_p50': rounded(down.get('rtt_p50')),
+        'download_rtt_p99': rounded(down.get('rtt_p99')),
+    }
+
+
+def summarise(config, runs):
+    ok = [r for r in runs if 'error' not in r]
+
+    def median(key):
+        return percentile([r[key] for r in ok if r.get(key) is not None], 0.5)
+
+    latencies = [r['latency_s'] for r in ok]
+    return {
+        **config,
+        'runs': len(runs),
+        'failed': len(runs) - len(ok),
+        'upload_mbps': median('upload_mbps'),
+        'download_mbps': median('download_mbps'),
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p90': percentile(latencies, 0.9),
+        'latency_p99': percentile(latencies, 0.99),
+        'convert_p50': median('convert_s'),
+        'upload_rtt_p50': median('upload_rtt_p50'),
+        'upload_rtt_p99': median('upload_rtt_p99'),
+        'download_rtt_p50': median('download_rtt_p50'),
+        'download_rtt_p99': median('download_rtt_p99'),
+        'upload_retransmits': median('upload_retransmits'),
+        'download_retransmits': median('download_retransmits'),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure FileFusion transfers over an impaired loopback link.")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="file sizes, e.g. 256K,4M")
+    parser.add_argument('--packet-sizes', default=DEFAULT_PACKET_SIZES,
+                        help="sender packet sizes, i.e. bytes per congestion window slot")
+    parser.add_argument('--loss', default=DEFAULT_LOSS, help="loss rates, e.g. 0,0.01,0.05")
+    parser.add_argument('--reorder', type=float, default=0.0, help="reordering rate")
+    parser.add_argument('--cc', default='reno', help="congestion controls, comma-separated")
+    parser.add_argument('--stripes', default='1',
+                        help="connections per transfer, e.g. 1,4 (files need "
+                             "FILEFUSION_STRIPE_MIN_BYTES per stripe)")
+    parser.add_argument('--transport',
+                        help="packet transports, e.g. tcp,udp (udp needs cryptography; "
+                             "both by default unless the link is shaped)")
+    parser.add_argument('--delay', type=float, default=0.0, help="one-way delay in ms")
+    parser.add_argument('--jitter', type=float, default=0.0, help="+/- ms around the delay")
+    parser.add_argument('--rate', type=float, default=0.0, help="Mbit/s per direction, 0 for no cap")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per combination")
+    parser.add_argument('--convert', choices=('stub', 'real'), default='stub',
+                        help="stub copies the upload back; real runs LibreOffice")
+    parser.add_argument('--input', help="document to send with --convert real (sizes are ignored)")
+    parser.add_argument('--format', default='pdf', help="output format with --convert real")
+    parser.add_argument('-o', '--output', default='transfer_bench',
+                        help="report path without extension; writes .json and .csv")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory")
+    args = parser.parse_args(argv)
+
+    ccs = parse_list(args.cc, str)
+    for cc in ccs:
+        if cc not in CONGESTION_CONTROLS:
+            parser.error(f"unknown congestion control {cc}")
+    if args.transport is None:
+        shaped = args.delay or args.jitter or args.rate
+        args.transport = 'tcp' if shaped or not HAVE_AESGCM else DEFAULT_TRANSPORTS
+    transports = parse_list(args.transport, str)
+    for kind in transports:
+        if kind not in ('tcp', 'udp'):
+            parser.error(f"unknown transport {kind}")
+    if 'udp' in transports:
+        if not HAVE_AESGCM:
+            parser.error("--transport udp needs the cryptography package")
+        if args.delay or args.jitter or args.rate:
+            # the proxy only relays TCP, so the two would not see the same link
+            parser.error("--delay, --jitter and --rate only shape TCP; compare udp without them")
+    if args.convert == 'real' and not args.input:
+        parser.error("--convert real needs --input, a document LibreOffice can open")
+    if args.input:
+        with open(args.input, 'rb') as f:
+            document = f.read()
+        sizes = [len(document)]
+        name, output_format = os.path.basename(args.input), args.format
+    else:
+        document = None
+        sizes = parse_list(args.sizes, parse_size)
+        # the stub only copies, so any pair the server accepts will do
+        name, output_format = 'bench.docx', 'pdf'
+    output = os.path.abspath(args.output)
+
+    workdir = tempfile.mkdtemp(prefix='filefusion_bench_')
+    bench = BenchServer(workdir, args.convert, args.delay / 1000, args.jitter / 1000,
+                        args.rate * 125_000)
+    import server
+    import transport
+    impair.REORDER = args.reorder
+    impair.SEED = SEED
+    data_random = random.Random(SEED)
+
+    runs = []
+    summary = []
+    combos = list(itertools.product(sizes, parse_list(args.packet_sizes, parse_size),
+                                    parse_list(args.loss, float), ccs,
+                                    parse_list(args.stripes, int), transports))
+    try:
+        for size, packet_size, loss, cc, stripes, packets in combos:
+            config = {'size': size, 'packet_size': packet_size, 'loss': loss, 'cc': cc,
+                      'stripes': stripes, 'transport': packets}
+            server.PACKET_SIZE = transport.PACKET_SIZE = packet_size
+            server.MAX_STRIPES = transport.STRIPES = stripes
+            impair.LOSS = loss
+            config_runs = []
+            for attempt in range(args.repeat):
+                # fresh bytes each run so the conversion cache never answers
+                data = document or data_random.getrandbits(size * 8).to_bytes(size, 'little')
+                if document:
+                    bench.forget(len(runs) + attempt)
+                try:
+                    result = run_job(bench, data, name, output_format, cc, packets)
+                except Exception as e:
+                    result = {'error': str(e)}
+                config_runs.append({**config, 'attempt': attempt, **result})
+                print(f"{config} #{attempt}: {result}", flush=True)
+            runs += config_runs
+            summary.append(summarise(config, config_runs))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'revision': git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'link': {'delay_ms': args.delay, 'jitter_ms': args.jitter, 'rate_mbit': args.rate,
+                 'reorder': args.reorder},
+        'convert': args.convert,
+        'summary': summary,
+        'runs': runs,
+    }
+    with open(f"{output}.json", 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(f"{output}.csv", 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(summary)
+    print(f"Wrote {output}.json and {output}.csv")
+    return 1 if any(row['failed'] for row in summary) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
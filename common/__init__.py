@@ -0,0 +1 @@
+"""Wire protocol pieces shared by the FileFusion server and client."""
@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+from common.protocol import ACK_FIN, PACKET_HEADER_SIZE, decode_ack
+
+# asyncio StreamReader/StreamWriter versions of the blocking helpers in
+# protocol.py and transfer.py; the framing is identical.
+
+
+async def recv_exact(reader, n):
+    try:
+        return await reader.readexactly(n)
+    except asyncio.IncompleteReadError:
+        raise ConnectionResetError("Connection closed mid-message") from None
+
+
+async def recv_ack(reader, sack=False, timeout=None, rwnd=False):
+    """Read one ACK; returns ``(cumulative ack, list of SACK blocks, window)``.
+
+    ``timeout`` only covers the wait for the first four bytes: readexactly
+    consumes nothing until it completes, so a timeout there never leaves a
+    half-read ACK behind, and the rest of the ACK follows right behind.
+    """
+    ack_num = decode_ack(await asyncio.wait_for(recv_exact(reader, 4), timeout))
+    window = int.from_bytes(await recv_exact(reader, 4), 'big') if rwnd else None
+    if not sack:
+        return ack_num, [], window
+    count = (await recv_exact(reader, 1))[0]
+    raw = await recv_exact(reader, 8 * count) if count else b''
+    blocks = [(int.from_bytes(raw[i:i + 4], 'big'), int.from_bytes(raw[i + 4:i + 8], 'big'))
+              for i in range(0, len(raw), 8)]
+    return ack_num, blocks, window
+
+
+async def drain_acks(reader, sack=False, rwnd=False):
+    """Discard late duplicate ACKs up to and including ACK_FIN."""
+    while (await recv_ack(reader, sack, rwnd=rwnd))[0] != ACK_FIN:
+        pass
+
+
+def send_json(writer, obj):
+    payload = json.dumps(obj).encode()
+    writer.write(len(payload).to_bytes(4, 'big') + payload)
+
+
+async def recv_json(reader):
+    length = int.from_bytes(await recv_exact(reader, 4), 'big')
+    return json.loads((await recv_exact(reader, length)).decode())
+
+
+async def read_packet(reader, receiver, timeout=None):
+    """StreamingReceiver.read_packet for a StreamReader.
+
+    As with ``recv_ack``, ``timeout`` only covers the header, so a timeout
+    leaves the stream untouched.
+    """
+    header = await asyncio.wait_for(recv_exact(reader, PACKET_HEADER_SIZE), timeout)
+    seq_num, data_len = receiver.parse_header(header)
+    if seq_num is None:
+        return None, None
+    return seq_num, receiver.decode(memoryview(await recv_exact(reader, data_len)))
+
+
+def send_packet(writer, source, seq_num):
+    """Queue packet ``seq_num`` of a PacketSource on the writer.
+
+    The transport may keep what it is given until it is flushed, so the
+    payload is copied out of the (possibly mmap-backed) source once; the
+    blocking path pays the same copy for its TLS scratch buffer. Returns the
+    number of bytes queued. With batching on, packets collect in the
+    source's batch and are written as one buffer once it is full or at
+    ``flush_packets``.
+    """
+    if source.batch_bytes:
+        size = source.queue(seq_num)
+        if len(source.batch) >= source.batch_bytes:
+            writer.write(source.take_batch())
+        return size
+    header, payload = source.frame(seq_num)
+    writer.writelines((header, payload.tobytes()))
+    return len(header) + len(payload)
+
+
+def flush_packets(writer, source):
+    """Hand the source's batched packets to the writer."""
+    if source.batch:
+        writer.write(source.take_batch())
@@ -0,0 +1,158 @@
+import math
+import os
+import time
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+
+try:
+    import lz4.frame
+    HAVE_LZ4 = True
+except ImportError:
+    HAVE_LZ4 = False
+
+# "auto" offers every codec available here, "off" none; otherwise a
+# comma-separated preference list such as "lz4,zlib"
+COMPRESSION = os.environ.get('FILEFUSION_COMPRESSION', 'auto')
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+# docx/xlsx/pptx/odt are ZIP containers and will not shrink any further
+ZIP_MAGIC = b"PK\x03\x04"
+# Samples spread over the file for the entropy probe
+PROBE_SAMPLES = 4
+PROBE_SAMPLE_SIZE = 16 * 1024
+# Above this many bits per byte the data is treated as incompressible
+ENTROPY_LIMIT = 7.5
+
+
+class ZlibCodec:
+    name = "zlib"
+
+    def compress(self, data):
+        return zlib.compress(data, ZLIB_LEVEL)
+
+    def decompress(self, data, max_size):
+        d = zlib.decompressobj()
+        out = d.decompress(data, max_size)
+        if d.unconsumed_tail or not d.eof:
+            raise ValueError(f"zlib packet does not fit in {max_size} bytes")
+        return out
+
+
+class ZstdCodec:
+    name = "zstd"
+
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def decompress(self, data, max_size):
+        # compress() records the content size, so the output is bounded up front
+        if zstandard.frame_content_size(data) > max_size:
+            raise ValueError(f"zstd packet does not fit in {max_size} bytes")
+        return self.decompressor.decompress(data, max_output_size=max_size)
+
+
+class Lz4Codec:
+    name = "lz4"
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompress(self, data, max_size):
+        d = lz4.frame.LZ4FrameDecompressor()
+        out = d.decompress(data, max_length=max_size)
+        if not d.eof:
+            raise ValueError(f"lz4 packet does not fit in {max_size} bytes")
+        return out
+
+
+CODECS = {'zlib': ZlibCodec}
+if HAVE_ZSTD:
+    CODECS['zstd'] = ZstdCodec
+if HAVE_LZ4:
+    CODECS['lz4'] = Lz4Codec
+# best ratio per CPU second first
+PREFERENCE = ('zstd', 'lz4', 'zlib')
+
+
+def offered_codecs(setting=COMPRESSION):
+    """Codec names to offer in the hello, most preferred first."""
+    if setting == 'off':
+        return []
+    if setting == 'auto':
+        return [name for name in PREFERENCE if name in CODECS]
+    return [name for name in (n.strip() for n in setting.split(',')) if name in CODECS]
+
+
+def make_codec(name):
+    return CODECS[name]() if name in CODECS else None
+
+
+def entropy(sample):
+    """Shannon entropy of ``sample`` in bits per byte."""
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(n / total * math.log2(n / total) for n in Counter(sample).values())
+
+
+def probe(view):
+    """``(worth compressing, reason)`` for the bytes in ``view``."""
+    if bytes(view[:4]) == ZIP_MAGIC:
+        return False, "ZIP container"
+    step = max(len(view) // PROBE_SAMPLES, PROBE_SAMPLE_SIZE)
+    sample = b''.join(bytes(view[i:i + PROBE_SAMPLE_SIZE]) for i in range(0, len(view), step))
+    bits = entropy(sample)
+    if bits > ENTROPY_LIMIT:
+        return False, f"entropy {bits:.2f} bits/byte"
+    return True, f"entropy {bits:.2f} bits/byte"
+
+
+class CompressionStats:
+    """Bytes before and after a codec, and the CPU time it took."""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_seconds = 0.0
+        self.packets = 0
+        self.stored = 0
+
+    def compress(self, payload):
+        """Compressed payload, or None if that would not be smaller."""
+        start = time.thread_time()
+        packed = self.codec.compress(payload)
+        self.cpu_seconds += time.thread_time() - start
+        self.packets += 1
+        self.raw_bytes += len(payload)
+        if len(packed) >= len(payload):
+            self.stored += 1
+            self.wire_bytes += len(payload)
+            return None
+        self.wire_bytes += len(packed)
+        return packed
+
+    def decompress(self, payload, max_size):
+        start = time.thread_time()
+        data = self.codec.decompress(payload, max_size)
+        self.cpu_seconds += time.thread_time() - start
+        self.packets += 1
+        self.wire_bytes += len(payload)
+        self.raw_bytes += len(data)
+        return data
+
+    def describe(self):
+        ratio = self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+        return (f"{self.codec.name} raw={self.raw_bytes} wire={self.wire_bytes} "
+                f"ratio={ratio:.2f} cpu={self.cpu_seconds * 1000:.1f}ms "
+                f"packets={self.packets} stored={self.stored}")
@@ -0,0 +1,306 @@
+import collections
+
+SLOW_START = "Slow Start"
+CONGESTION_AVOIDANCE = "Congestion Avoidance"
+FAST_RECOVERY = "Fast Recovery"
+
+INITIAL_CWND = 1
+INITIAL_SSTHRESH = 16
+DUPACK_THRESHOLD = 3
+# Windows grow by the packets an ACK covers, up to this many (RFC 3465), so
+# delayed ACKs do not halve the growth
+ABC_LIMIT = 2
+
+
+class CongestionControl:
+    """Common interface for the sender-side congestion controllers.
+
+    The send loops call ``on_ack`` for every new cumulative ACK,
+    ``on_dupack`` for duplicate cumulative ACKs, ``on_loss`` when the SACK
+    scoreboard reports a hole and ``on_timeout`` when retransmission timers
+    fire, and keep at most ``window()`` packets in flight. Paced
+    controllers also space new packets via ``pacing_wait``/``on_send``.
+    Every change is logged as ``cwnd= ssthresh= state=`` for
+    logs_dashboard.py.
+    """
+
+    name = None
+
+    def __init__(self, log=None, initial_cwnd=INITIAL_CWND, ssthresh=INITIAL_SSTHRESH):
+        self.cwnd = float(initial_cwnd)
+        self.ssthresh = float(ssthresh)
+        self.state = SLOW_START
+        self.recover_point = None
+        self.dup_count = 0
+        self.next_send_at = 0.0
+        self._log = log or (lambda message: None)
+        self.log_state()
+
+    def describe(self):
+        return f"cwnd={self.cwnd:.2f} ssthresh={self.ssthresh:.2f} state={self.state}"
+
+    def log_state(self, event=None):
+        self._log(f"{event}: {self.describe()}" if event else self.describe())
+
+    def window(self):
+        return max(1, int(self.cwnd))
+
+    def pacing_delay(self):
+        """Seconds to wait between new packets; 0 for window-only controllers."""
+        return 0.0
+
+    def pacing_wait(self, now):
+        """How long the sender must hold off before its next new packet."""
+        if not self.pacing_delay():
+            return 0.0
+        return max(self.next_send_at - now, 0.0)
+
+    def on_send(self, now):
+        delay = self.pacing_delay()
+        if delay:
+            self.next_send_at = max(self.next_send_at, now) + delay
+
+    def reduced_ssthresh(self):
+        return max(self.cwnd / 2, 2)
+
+    def on_ack(self, ack_num, newly_acked, now, rtt=None):
+        """New cumulative ACK; returns True if ``ack_num + 1`` should be resent."""
+        self.dup_count = 0
+        if self.state == FAST_RECOVERY and ack_num >= self.recover_point:
+            self.cwnd = self.ssthresh
+            self.state = CONGESTION_AVOIDANCE
+            self.log_state("Exit FR")
+        acked = min(newly_acked, ABC_LIMIT)
+        if self.state == SLOW_START:
+            self.cwnd += acked
+            if self.cwnd >= self.ssthresh:
+                self.state = CONGESTION_AVOIDANCE
+        elif self.state == CONGESTION_AVOIDANCE:
+            self.grow(now, rtt, acked)
+        self.log_state()
+        return False
+
+    def grow(self, now, rtt, acked=1):
+        self.cwnd += acked / self.cwnd
+
+    def enter_recovery(self, next_seq, event):
+        self.ssthresh = self.reduced_ssthresh()
+        self.cwnd = self.ssthresh + DUPACK_THRESHOLD
+        self.state = FAST_RECOVERY
+        self.recover_point = next_seq - 1
+        self.log_state(event)
+
+    def on_dupack(self, ack_num, next_seq):
+        """Duplicate ACK; returns True if ``ack_num + 1`` should be fast-retransmitted."""
+        self.dup_count += 1
+        if self.dup_count >= DUPACK_THRESHOLD and self.state != FAST_RECOVERY:
+            self.enter_recovery(next_seq, "DUPACK threshold")
+            self.dup_count = 0
+            return True
+        return False
+
+    def on_loss(self, next_seq):
+        """Loss reported by the SACK scoreboard; reduces at most once per window."""
+        if self.state != FAST_RECOVERY:
+            self.enter_recovery(next_seq, "SACK loss")
+
+    def on_timeout(self):
+        self.ssthresh = self.reduced_ssthresh()
+        self.cwnd = self.ssthresh
+        self.state = SLOW_START
+        self.dup_count = 0
+        self.log_state("TIMEOUT")
+
+
+class Reno(CongestionControl):
+    name = "reno"
+
+
+class NewReno(CongestionControl):
+    """Reno that stays in Fast Recovery across partial ACKs (RFC 6582)."""
+
+    name = "newreno"
+
+    def on_ack(self, ack_num, newly_acked, now, rtt=None):
+        if self.state == FAST_RECOVERY and ack_num < self.recover_point:
+            # partial ACK: deflate by what was acked, resend the next hole
+            self.dup_count = 0
+            self.cwnd = max(self.cwnd - newly_acked + 1, 1)
+            self.log_state("Partial ACK")
+            return True
+        return super().on_ack(ack_num, newly_acked, now, rtt)
+
+
+class Cubic(CongestionControl):
+    """CUBIC window growth (RFC 8312) on top of Reno's loss handling."""
+
+    name = "cubic"
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, log=None, initial_cwnd=INITIAL_CWND, ssthresh=INITIAL_SSTHRESH):
+        self.w_max = 0.0
+        self.epoch_start = None
+        self.k = 0.0
+        self.origin = 0.0
+        super().__init__(log, initial_cwnd, ssthresh)
+
+    def reduced_ssthresh(self):
+        # fast convergence: release bandwidth if the last peak was higher
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.epoch_start = None
+        return max(self.cwnd * self.BETA, 2)
+
+    def grow(self, now, rtt, acked=1):
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+                self.origin = self.w_max
+            else:
+                self.k = 0.0
+                self.origin = self.cwnd
+        t = now - self.epoch_start + (rtt or 0.0)
+        target = self.origin + self.C * (t - self.k) ** 3
+        if rtt:
+            # never grow slower than Reno would (TCP-friendly region)
+            reno_estimate = (self.w_max * self.BETA
+                             + 3 * (1 - self.BETA) / (1 + self.BETA) * t / rtt)
+            target = max(target, reno_estimate)
+        if target > self.cwnd:
+            self.cwnd += acked * (target - self.cwnd) / self.cwnd
+        else:
+            self.cwnd += acked * 0.01 / self.cwnd
+
+
+class BBRLite(CongestionControl):
+    """Model-based controller in the style of BBR v1.
+
+    Tracks the bottleneck bandwidth (max delivery rate over recent rounds)
+    and the minimum RTT, sizes cwnd to twice their product and paces new
+    packets at ``pacing_gain * bandwidth``. Losses trigger retransmission
+    but do not shrink the model. ProbeRTT is left out.
+    """
+
+    name = "bbr"
+    STARTUP_GAIN = 2.89
+    PROBE_GAINS = (1.25, 0.75, 1, 1, 1, 1, 1, 1)
+    CWND_GAIN = 2.0
+    BW_WINDOW_ROUNDS = 10
+    # on loopback ten rounds is well under a millisecond; keep a sane floor
+    MIN_BW_WINDOW = 0.1
+
+    def __init__(self, log=None, initial_cwnd=4, ssthresh=INITIAL_SSTHRESH):
+        self.delivered = 0
+        self.history = collections.deque()
+        self.bw_samples = collections.deque()
+        self.btl_bw = 0.0
+        self.min_rtt = None
+        self.pacing_gain = self.STARTUP_GAIN
+        self.round_start = None
+        self.full_bw = 0.0
+        self.full_bw_rounds = 0
+        self.cycle_index = 0
+        super().__init__(log, initial_cwnd, ssthresh)
+        self.state = "Startup"
+
+    def pacing_delay(self):
+        if self.btl_bw <= 0:
+            return 0.0
+        return 1.0 / (self.pacing_gain * self.btl_bw)
+
+    def _bdp(self):
+        return self.btl_bw * self.min_rtt
+
+    def on_ack(self, ack_num, newly_acked, now, rtt=None):
+        self.dup_count = 0
+        if self.state == FAST_RECOVERY:
+            if ack_num < self.recover_point:
+                return True
+            self.state = "ProbeBW"
+        if rtt is not None:
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+
+        self.delivered += newly_acked
+        self.history.append((now, self.delivered))
+        if self.min_rtt:
+            # delivery rate over roughly one min RTT
+            while len(self.history) > 2 and now - self.history[1][0] >= self.min_rtt:
+                self.history.popleft()
+            then, delivered_then = self.history[0]
+            if now > then:
+                self.bw_samples.append((now, (self.delivered - delivered_then) / (now - then)))
+            horizon = max(self.BW_WINDOW_ROUNDS * self.min_rtt, self.MIN_BW_WINDOW)
+            while self.bw_samples and now - self.bw_samples[0][0] > horizon:
+                self.bw_samples.popleft()
+            self.btl_bw = max((bw for _, bw in self.bw_samples), default=0.0)
+
+        if self.round_start is None:
+            self.round_start = now
+        if self.min_rtt and now - self.round_start >= self.min_rtt:
+            self.round_start = now
+            self._next_round()
+
+        if self.btl_bw > 0 and self.min_rtt:
+            self.cwnd = max(4.0, self.CWND_GAIN * self._bdp())
+            if self.state == "Startup":
+                self.cwnd = max(self.cwnd, self.STARTUP_GAIN * self._bdp())
+        else:
+            self.cwnd += 1
+        self.log_state()
+        return False
+
+    def _next_round(self):
+        if self.state == "Startup":
+            if self.btl_bw >= self.full_bw * 1.25:
+                self.full_bw = self.btl_bw
+                self.full_bw_rounds = 0
+            else:
+                self.full_bw_rounds += 1
+                if self.full_bw_rounds >= 3:
+                    self.state = "Drain"
+                    self.pacing_gain = 1 / self.STARTUP_GAIN
+        elif self.state == "Drain":
+            self.state = "ProbeBW"
+            self.cycle_index = 0
+            self.pacing_gain = self.PROBE_GAINS[0]
+        elif self.state == "ProbeBW":
+            self.cycle_index = (self.cycle_index + 1) % len(self.PROBE_GAINS)
+            self.pacing_gain = self.PROBE_GAINS[self.cycle_index]
+
+    def on_dupack(self, ack_num, next_seq):
+        self.dup_count += 1
+        if self.dup_count >= DUPACK_THRESHOLD and self.state != FAST_RECOVERY:
+            self.on_loss(next_seq)
+            self.dup_count = 0
+            return True
+        return False
+
+    def on_loss(self, next_seq):
+        if self.state != FAST_RECOVERY:
+            self.state = FAST_RECOVERY
+            self.recover_point = next_seq - 1
+            self.log_state("Loss")
+
+    def on_timeout(self):
+        # rate samples spanning the stall would drag the max filter down
+        self.history.clear()
+        self.bw_samples.clear()
+        self.btl_bw = 0.0
+        self.cwnd = 4.0
+        self.state = "ProbeBW"
+        self.pacing_gain = 1.0
+        self.dup_count = 0
+        self.log_state("TIMEOUT")
+
+
+CONGESTION_CONTROLS = {cls.name: cls for cls in (Reno, NewReno, Cubic, BBRLite)}
+DEFAULT_CONGESTION_CONTROL = "reno"
+
+
+def make_congestion_control(name, log=None):
+    cls = CONGESTION_CONTROLS.get(name, CONGESTION_CONTROLS[DEFAULT_CONGESTION_CONTROL])
+    return cls(log=log)
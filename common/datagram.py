@@ -0,0 +1,377 @@
+import asyncio
+import os
+import select
+import socket
+import ssl
+import time
+
+from common.protocol import PACKET_HEADER_SIZE, recv_exact
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    HAVE_AESGCM = True
+except ImportError:
+    HAVE_AESGCM = False
+
+# Largest datagram we send. The default fits a 1500-byte Ethernet MTU after
+# IP and UDP headers; loopback and jumbo-frame links can go up to 65507.
+DATAGRAM_SIZE = min(int(os.environ.get('FILEFUSION_UDP_DATAGRAM', '1472')), 65507)
+# A transfer gives up after this many seconds without an authentic datagram
+IDLE_TIMEOUT = float(os.environ.get('FILEFUSION_UDP_IDLE_TIMEOUT', '30'))
+# Socket buffers asked for; the kernel may grant less (net.core.rmem_max)
+SOCKET_BUFFER = 4 << 20
+KEY_SIZE = 32
+CHANNEL_ID_SIZE = 8
+EPOCH_SIZE = 4
+COUNTER_SIZE = 8
+TAG_SIZE = 16
+# channel ID, epoch and counter go in the clear, authenticated as associated data
+DATAGRAM_HEADER_SIZE = CHANNEL_ID_SIZE + EPOCH_SIZE + COUNTER_SIZE
+OVERHEAD = DATAGRAM_HEADER_SIZE + TAG_SIZE
+# Nonce prefixes, so the two directions never share a nonce under one key
+CLIENT_ROLE = 0
+SERVER_ROLE = 1
+# Counters this far behind the newest one are still accepted once each
+REPLAY_WINDOW = 64
+# Datagrams a server channel queues for its transfer; more are dropped, as
+# a full socket buffer would
+CHANNEL_QUEUE = 1024
+
+
+class DatagramCipher:
+    """AES-GCM sealing of one channel's datagrams, with replay protection.
+
+    A datagram is the channel ID, the epoch, an 8-byte counter and the
+    sealed payload. The epoch numbers the transfers on a channel, so a late
+    datagram from one is never taken for part of the next. The nonce is our
+    role followed by the counter, so each key (one per channel, handed out
+    over TLS) never sees a nonce twice. Incoming counters are checked
+    against a sliding window as in IPsec: reordering is fine, a replayed
+    datagram is dropped like a forged one.
+    """
+
+    def __init__(self, key, channel_id, role):
+        self.aead = AESGCM(key)
+        self.channel_id = channel_id
+        self.role = role
+        self.epoch = 0
+        self.counter = 0
+        self.highest = 0
+        self.seen = 0
+
+    def seal(self, plaintext):
+        self.counter += 1
+        header = (self.channel_id + self.epoch.to_bytes(EPOCH_SIZE, 'big')
+                  + self.counter.to_bytes(COUNTER_SIZE, 'big'))
+        return header + self.aead.encrypt(self._nonce(self.role, self.counter), plaintext, header)
+
+    def open(self, datagram):
+        """``(epoch, payload)`` of an authentic, fresh datagram; None for anything else."""
+        if len(datagram) < OVERHEAD or datagram[:CHANNEL_ID_SIZE] != self.channel_id:
+            return None
+        header = bytes(datagram[:DATAGRAM_HEADER_SIZE])
+        epoch = int.from_bytes(header[CHANNEL_ID_SIZE:CHANNEL_ID_SIZE + EPOCH_SIZE], 'big')
+        counter = int.from_bytes(header[CHANNEL_ID_SIZE + EPOCH_SIZE:], 'big')
+        if not self._fresh(counter):
+            return None
+        try:
+            plaintext = self.aead.decrypt(self._nonce(1 - self.role, counter),
+                                          bytes(datagram[DATAGRAM_HEADER_SIZE:]), header)
+        except InvalidTag:
+            return None
+        self._mark(counter)
+        return epoch, plaintext
+
+    @staticmethod
+    def _nonce(role, counter):
+        return role.to_bytes(4, 'big') + counter.to_bytes(COUNTER_SIZE, 'big')
+
+    def _fresh(self, counter):
+        if counter > self.highest:
+            return True
+        behind = self.highest - counter
+        return 0 < counter and behind < REPLAY_WINDOW and not self.seen >> behind & 1
+
+    def _mark(self, counter):
+        if counter > self.highest:
+            self.seen = (self.seen << (counter - self.highest) | 1) & ((1 << REPLAY_WINDOW) - 1)
+            self.highest = counter
+        else:
+            self.seen |= 1 << (self.highest - counter)
+
+
+def new_channel():
+    """Random ``(channel ID, key)`` for a channel, both sent to the client over TLS."""
+    return os.urandom(CHANNEL_ID_SIZE), os.urandom(KEY_SIZE)
+
+
+def max_payload(datagram_size=DATAGRAM_SIZE):
+    """Largest packet payload that fits in one datagram with its header."""
+    return datagram_size - OVERHEAD - PACKET_HEADER_SIZE
+
+
+class DatagramChannel:
+    """Client end of a UDP channel, standing in for the TLS socket during a transfer.
+
+    Data packets and ACKs go one per datagram; ``recv``/``recv_into`` hand
+    out one datagram at a time, so the transfer code reads packets and ACKs
+    from it as from the stream. The size header, END and ACK_FIN stay on
+    the TLS connection, which makes the end of a transfer reliable. While a
+    receive is ``start``ed with the TLS socket, END arriving there is read
+    as the next datagram.
+    """
+
+    def __init__(self, local_host, log=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            self.sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        self.sock.bind((local_host, 0))
+        self.port = self.sock.getsockname()[1]
+        self.cipher = None
+        self.peer = None
+        self.max_payload = max_payload()
+        self.buffer = memoryview(b'')
+        self.timeout = None
+        self.control = None
+        self.heard = time.monotonic()
+        self.rejected = 0
+        self.log = log or (lambda message: None)
+
+    def hello(self):
+        """Hello fields that ask the server for this channel (CAP_DATAGRAM)."""
+        return {'transport': 'udp', 'udp_port': self.port}
+
+    def connect(self, host, offer):
+        """Key the channel with the server's ``offer`` from its reply."""
+        self.cipher = DatagramCipher(bytes.fromhex(offer['key']),
+                                     bytes.fromhex(offer['channel']), CLIENT_ROLE)
+        self.peer = (host, int(offer['port']))
+
+    def start(self, control=None):
+        """Begin a transfer; a receiver passes the TLS socket its END comes on.
+
+        Both ends start every transfer on the channel, in the same order, so
+        their epochs stay in step. Reads block until the sender sets a timeout.
+        """
+        self.cipher.epoch += 1
+        self.control = control
+        self.buffer = memoryview(b'')
+        self.timeout = None
+        self.heard = time.monotonic()
+
+    def stop(self):
+        self.control = None
+        self.buffer = memoryview(b'')
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def pending(self):
+        return len(self.buffer)
+
+    def sendall(self, data):
+        self.sock.sendto(self.cipher.seal(bytes(data)), self.peer)
+
+    def sendmsg(self, buffers):
+        data = b''.join(buffers)
+        self.sendall(data)
+        return len(data)
+
+    def recv(self, n):
+        if not self.buffer:
+            self._next()
+        data = bytes(self.buffer[:n])
+        self.buffer = self.buffer[len(data):]
+        return data
+
+    def recv_into(self, view):
+        if not self.buffer:
+            self._next()
+        n = min(len(view), len(self.buffer))
+        view[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def _next(self):
+        """Wait for the next authentic datagram, or for END on the control socket."""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        watched = [self.sock] if self.control is None else [self.sock, self.control]
+        while True:
+            now = time.monotonic()
+            if now - self.heard > IDLE_TIMEOUT:
+                raise ConnectionError(f"No datagrams from the server for {IDLE_TIMEOUT:g}s")
+            if isinstance(self.control, ssl.SSLSocket) and self.control.pending():
+                readable = [self.control]
+            else:
+                wait = IDLE_TIMEOUT if deadline is None else max(deadline - now, 0.0)
+                readable = select.select(watched, [], [], wait)[0]
+            if not readable:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise socket.timeout("timed out")
+                continue
+            if self.control is not None and self.control in readable:
+                self.buffer = memoryview(recv_exact(self.control, PACKET_HEADER_SIZE))
+                return
+            opened = self.cipher.open(self.sock.recv(65535))
+            if opened is None:
+                self.rejected += 1
+                continue
+            epoch, plaintext = opened
+            if epoch != self.cipher.epoch:
+                continue  # a straggler from an earlier transfer
+            self.heard = time.monotonic()
+            self.buffer = memoryview(plaintext)
+            return
+
+    def close(self):
+        if self.rejected:
+            self.log(f"Dropped {self.rejected} forged, replayed or stray datagrams")
+        self.sock.close()
+
+
+class ServerChannel:
+    """Server end of a UDP channel: StreamReader and StreamWriter in one.
+
+    The endpoint hands it the channel's datagrams, and the asyncio transfer
+    code reads packets and ACKs with ``readexactly`` and writes them with
+    ``write``, one per datagram. Replies go wherever the client's latest
+    authentic datagram came from.
+    """
+
+    def __init__(self, endpoint, channel_id, key, peer):
+        self.endpoint = endpoint
+        self.channel_id = channel_id
+        self.key = key
+        self.cipher = DatagramCipher(key, channel_id, SERVER_ROLE)
+        self.peer = peer
+        self.max_payload = max_payload()
+        self.queue = asyncio.Queue(CHANNEL_QUEUE)
+        self.buffer = memoryview(b'')
+        self.watcher = None
+        self.rejected = 0
+        self.dropped = 0
+
+    def offer(self):
+        """The reply's 'udp' field: where to send and how to seal."""
+        return {'port': self.endpoint.port, 'channel': self.channel_id.hex(),
+                'key': self.key.hex()}
+
+    def deliver(self, datagram, addr):
+        opened = self.cipher.open(datagram)
+        if opened is None:
+            self.rejected += 1
+            return
+        self.peer = addr
+        # a client may send the first packets of a transfer before we start it
+        if opened[0] < self.cipher.epoch:
+            return
+        try:
+            self.queue.put_nowait(opened)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self, control=None):
+        """Begin a transfer; a receiver passes the TLS reader its END comes on.
+
+        Both ends start every transfer on the channel, in the same order, so
+        their epochs stay in step.
+        """
+        self.cipher.epoch += 1
+        self.buffer = memoryview(b'')
+        if control is not None:
+            self.watcher = asyncio.ensure_future(self._watch(control))
+
+    def stop(self):
+        if self.watcher:
+            self.watcher.cancel()
+            self.watcher = None
+
+    async def _watch(self, reader):
+        try:
+            item = await reader.readexactly(PACKET_HEADER_SIZE)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            item = b''
+        await self.queue.put((self.cipher.epoch, item))
+
+    async def readexactly(self, n):
+        while not self.buffer:
+            try:
+                epoch, item = await asyncio.wait_for(self.queue.get(), IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise ConnectionError(
+                    f"No datagrams from the client for {IDLE_TIMEOUT:g}s") from None
+            if epoch != self.cipher.epoch:
+                continue  # a straggler from an earlier transfer
+            if not item:
+                raise ConnectionResetError("Connection closed mid-transfer")
+            self.buffer = memoryview(item)
+        if len(self.buffer) < n:
+            raise ValueError(f"Datagram ends {n - len(self.buffer)} bytes short")
+        data = bytes(self.buffer[:n])
+        self.buffer = self.buffer[n:]
+        return data
+
+    def write(self, data):
+        self.endpoint.send(self.cipher.seal(bytes(data)), self.peer)
+
+    def writelines(self, buffers):
+        self.write(b''.join(buffers))
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.stop()
+        self.endpoint.channels.pop(self.channel_id, None)
+        if self.rejected or self.dropped:
+            self.endpoint.log(f"Channel {self.channel_id.hex()}: rejected {self.rejected}, "
+                              f"dropped {self.dropped} datagrams")
+
+
+class DatagramEndpoint(asyncio.DatagramProtocol):
+    """The server's UDP socket, shared by every channel and split up by channel ID."""
+
+    def __init__(self, log=None):
+        self.transport = None
+        self.port = None
+        self.channels = {}
+        self.log = log or (lambda message: None)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        self.port = sock.getsockname()[1]
+
+    def datagram_received(self, data, addr):
+        channel = self.channels.get(data[:CHANNEL_ID_SIZE])
+        if channel is not None:
+            channel.deliver(data, addr)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable once a client has gone; the transfer times out
+        self.log(f"UDP error: {exc}")
+
+    def send(self, datagram, addr):
+        self.transport.sendto(datagram, addr)
+
+    def open(self, peer):
+        """A fresh channel to the client's UDP socket at ``peer``."""
+        channel_id, key = new_channel()
+        channel = ServerChannel(self, channel_id, key, peer)
+        self.channels[channel_id] = channel
+        return channel
+
+
+async def start_datagram_endpoint(host, port, log=None):
+    """Listen for channel datagrams on ``host``:``port`` (0 for any free port)."""
+    loop = asyncio.get_running_loop()
+    _, endpoint = await loop.create_datagram_endpoint(lambda: DatagramEndpoint(log),
+                                                      local_addr=(host, port))
+    return endpoint
@@ -0,0 +1,52 @@
+import os
+import random
+
+# Simulated loss and reordering of data packets for tests and benchmarks,
+# off unless set. TLS over TCP never loses or reorders a byte, so this is
+# done by the sender where packets are still visible; delay, jitter and
+# bandwidth are the job of bench/proxy.py.
+LOSS = float(os.environ.get('FILEFUSION_LOSS', '0'))
+REORDER = float(os.environ.get('FILEFUSION_REORDER', '0'))
+# Same seed, same drops: makes benchmark runs comparable across commits
+SEED = os.environ.get('FILEFUSION_IMPAIR_SEED')
+
+
+class Impairment:
+    """Decides what happens to each first transmission of a packet.
+
+    A lost packet is simply not sent, so only the retransmission logic can
+    recover it. A reordered one is held back and goes out after the next
+    packet (or at ``flush``). Retransmissions are never impaired, as with
+    the fixed drop lists this replaces.
+    """
+
+    def __init__(self, loss=None, reorder=None, seed=None, log=None):
+        self.loss = LOSS if loss is None else loss
+        self.reorder = REORDER if reorder is None else reorder
+        seed = SEED if seed is None else seed
+        self.random = random.Random(None if seed is None else int(seed))
+        self.held = []
+        self.dropped = 0
+        self.reordered = 0
+        self.log = log or (lambda message: None)
+
+    def outgoing(self, seq_num):
+        """Packets to put on the wire now in place of the first send of ``seq_num``."""
+        if not (self.loss or self.reorder):
+            return (seq_num,)
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            self.log(f"Dropping Packet {seq_num}")
+            return ()
+        if self.reorder and not self.held and self.random.random() < self.reorder:
+            self.held.append(seq_num)
+            self.reordered += 1
+            self.log(f"Holding back Packet {seq_num}")
+            return ()
+        out, self.held = [seq_num] + self.held, []
+        return out
+
+    def flush(self):
+        """Held-back packets, due before the sender waits for ACKs."""
+        held, self.held = self.held, []
+        return held
@@ -0,0 +1,179 @@
+import atexit
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+TRACE = 5
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {TRACE: 'trace', DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+# Per-packet lines are TRACE; DEBUG keeps congestion control and
+# retransmits (what the dashboard graphs). Use "info" in production.
+LOG_LEVEL = LEVELS.get(os.environ.get('FILEFUSION_LOG_LEVEL', 'debug').lower(), DEBUG)
+# The writer wakes up this often, or as soon as BATCH_SIZE records queue up
+FLUSH_INTERVAL = 0.2
+BATCH_SIZE = 512
+# Records beyond this are dropped (and counted) rather than eating memory
+MAX_PENDING = 100_000
+
+# Tags every record logged from the current thread or asyncio task
+CONNECTION = contextvars.ContextVar('connection', default=None)
+
+
+def bind_connection(conn_id):
+    CONNECTION.set(conn_id)
+
+
+class AsyncLog:
+    """JSON-lines log written in batches by a background thread.
+
+    ``log()`` only appends a tuple to a deque (atomic, no lock taken), so
+    the transfer loops never wait on the filesystem or the console. The
+    writer thread drains the deque every FLUSH_INTERVAL, or sooner once a
+    batch has built up, and writes it with one call. Each line holds
+    ``ts``, ``level``, ``src``, ``conn`` and ``msg``.
+    """
+
+    def __init__(self, path, source, level=LOG_LEVEL, echo=True, mode='a'):
+        self.path = path
+        self.source = source
+        self.level = level
+        self.echo = echo
+        self.pending = deque()
+        self.dropped = 0
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.file = open(path, mode)
+        self.thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, message, level=INFO):
+        if level < self.level or self.closed:
+            return
+        if len(self.pending) >= MAX_PENDING:
+            self.dropped += 1
+            return
+        self.pending.append((time.time(), level, CONNECTION.get(), message))
+        if len(self.pending) >= BATCH_SIZE:
+            self.wakeup.set()
+
+    def flush(self):
+        """Block until everything logged so far is written."""
+        if self.closed or not self.thread.is_alive():
+            return
+        done = threading.Event()
+        self.pending.append(done)
+        self.wakeup.set()
+        done.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.file.close()
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self._drain()
+
+    def _drain(self):
+        lines = []
+        echoed = []
+        waiters = []
+        while True:
+            try:
+                record = self.pending.popleft()
+            except IndexError:
+                break
+            if isinstance(record, threading.Event):
+                waiters.append(record)
+                continue
+            ts, level, conn, message = record
+            lines.append(json.dumps({'ts': round(ts, 6), 'level': LEVEL_NAMES[level],
+                                     'src': self.source, 'conn': conn, 'msg': message}))
+            if self.echo:
+                echoed.append(message)
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append(json.dumps({'ts': round(time.time(), 6), 'level': 'warning',
+                                     'src': self.source, 'conn': None,
+                                     'msg': f"[LOG] Dropped {dropped} records"}))
+        if lines:
+            self.file.write('\n'.join(lines) + '\n')
+            self.file.flush()
+        if echoed:
+            sys.stdout.write('\n'.join(echoed) + '\n')
+            sys.stdout.flush()
+        for waiter in waiters:
+            waiter.set()
+
+
+def parse_line(line):
+    """One log record; plain-text lines (older logs) come back as info messages."""
+    try:
+        return json.loads(line)
+    except ValueError:
+        return {'ts': None, 'level': 'info', 'src': None, 'conn': None, 'msg': line}
+
+
+def read_records(path):
+    with open(path) as f:
+        return [parse_line(line.rstrip('\n')) for line in f if line.strip()]
+
+
+class LogTail:
+    """Reads only what was appended to a log file since the last call.
+
+    Remembers the byte offset it got to and holds back a trailing partial
+    line until the writer finishes it. A file that shrank or was replaced
+    (the server truncates its log on start) is read again from the top.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.inode = None
+        self.partial = b''
+
+    def read_new(self):
+        """``(new records, restarted)``; ``restarted`` means drop earlier ones."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return [], False
+        restarted = stat.st_ino != self.inode or stat.st_size < self.offset
+        if restarted:
+            self.inode = stat.st_ino
+            self.offset = 0
+            self.partial = b''
+        if stat.st_size == self.offset:
+            return [], restarted
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+        self.offset += len(data)
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        records = [parse_line(line.decode(errors='replace')) for line in lines if line.strip()]
+        return records, restarted
+
+
+def format_record(record):
+    ts = record.get('ts')
+    stamp = time.strftime('%H:%M:%S', time.localtime(ts)) if ts else '--:--:--'
+    conn = f" [{record['conn']}]" if record.get('conn') else ''
+    return f"{stamp} {record.get('level', 'info').upper():7}{conn} {record.get('msg', '')}"
@@ -0,0 +1,232 @@
+import json
+import select
+
+from common.congestion import DEFAULT_CONGESTION_CONTROL
+
+# A v2 client sends this in place of the 4-byte ASCII name_len of the v1
+# preamble, followed by a length-prefixed JSON hello. v1 clients never start
+# with it since their first four bytes are space-padded digits.
+HELLO_MAGIC = b"FFv2"
+PROTOCOL_VERSION = 2
+
+PACKET_HEADER_SIZE = 8
+# High bit of a packet's length field: the payload is compressed with the
+# codec negotiated as 'compression' in the hello (payloads stay < 2 GiB)
+COMPRESSED_FLAG = 1 << 31
+# Payload size spoken by v1 peers; v2 peers negotiate up to MAX_PACKET_SIZE
+LEGACY_PACKET_SIZE = 4096
+MAX_PACKET_SIZE = 1 << 20
+END_SEQ = 0xFFFFFFFF
+# Cumulative ACK value meaning "nothing in order yet" (seq -1 on the wire)
+ACK_NONE = 0xFFFFFFFF
+# Sent by v2 receivers once END arrives so the sender can drain stale ACKs
+# before reading the next message off the stream
+ACK_FIN = 0xFFFFFFFE
+
+# Capability bits exchanged as 'caps' in the v2 hello and reply; each side
+# uses a feature only if both set its bit
+CAP_SACK = 1 << 0
+# Server may send QUEUE_STATUS frames while a conversion waits for a slot
+CAP_QUEUE_STATUS = 1 << 1
+# Interrupted transfers can pick up where they stopped: uploads name a
+# 'transfer_id' in the hello and the reply carries 'resume_offset'; downloads
+# announce what they hold as 'download': {'offset', 'etag'} and the server
+# answers with a JSON {'offset', 'etag'} frame right after the file name
+CAP_RESUME = 1 << 2
+# Every ACK carries the receiver's free buffer space as 4 more bytes right
+# after the cumulative ACK: how many bytes past it the sender may have out
+CAP_RWND = 1 << 3
+# Large transfers may be striped over parallel connections. The hello asks
+# for up to 'stripes' and the reply grants as many. The JSON frame ahead of a
+# striped transfer carries 'stripe_id' and 'ranges', one [start, end) byte
+# range per stripe. Stripe 0 runs on the connection itself. The client opens
+# another connection for each further stripe, with a hello of just
+# {'stripe': id, 'index': i}, answered send or error. Each stripe is then an
+# ordinary transfer of its range.
+CAP_STRIPE = 1 << 4
+# A single-job connection stays open once the job is answered, and the next
+# hello may follow on it. The reply states in 'keepalive' how many idle
+# seconds the server waits for that hello before closing.
+CAP_KEEPALIVE = 1 << 5
+# Data packets and ACKs may go over UDP, sealed with AES-GCM. A hello with
+# 'transport': 'udp' names the client's 'udp_port'; the reply grants it with
+# 'udp': {'port', 'channel', 'key'}, a fresh key per channel. The size
+# header, END and ACK_FIN stay on the TLS connection.
+CAP_DATAGRAM = 1 << 6
+SACK_MAX_BLOCKS = 8
+
+# hello replies
+STATUS_HAVE = "have"
+STATUS_SEND = "send"
+STATUS_ERROR = "error"
+STATUS_BUSY = "busy"
+
+# Multi-job sessions: a v2 hello with 'session' set is answered with
+# STATUS_SESSION, after which the client sends 2-byte commands, each
+# followed by a JSON frame. SUBMIT gets a have/send/busy/error reply (then
+# the upload and a queued/error verdict); FETCH gets the next finished job
+# (ready, followed by its download, or busy/error), pending or idle.
+STATUS_SESSION = "session"
+STATUS_QUEUED = "queued"
+STATUS_READY = "ready"
+STATUS_PENDING = "pending"
+STATUS_IDLE = "idle"
+CMD_SUBMIT = b"SB"
+CMD_FETCH = b"FT"
+CMD_BYE = b"BY"
+
+# 2-byte conversion outcomes sent ahead of the download; QUEUE_STATUS is
+# followed by a JSON frame and repeats until one of the others arrives
+RESULT_OK = b"OK"
+RESULT_ERROR = b"ER"
+RESULT_BUSY = b"BZ"
+QUEUE_STATUS = b"QP"
+
+
+class TransferParams:
+    """Per-connection transfer settings agreed in the hello.
+
+    ``packet_size`` is what we send with (and, in adaptive mode, start at),
+    ``peer_max_packet`` caps what we may send, ``max_packet`` is the largest
+    payload we accept. ``fin_ack`` means the receiver answers END with
+    ACK_FIN. ``caps`` holds the capability bits both peers set. ``cc`` names
+    the congestion controller our sends use. ``compression`` is the codec
+    both ends may use for packets, or None. ``stripes`` is how many
+    connections a large transfer may be spread over. ``channel`` is the UDP
+    channel packets travel on once ``attach``ed, else None. v1 peers get the
+    fixed 4 KiB defaults, no FIN ACK, no capabilities, no compression and Reno.
+    """
+
+    def __init__(self, packet_size=LEGACY_PACKET_SIZE, peer_max_packet=LEGACY_PACKET_SIZE,
+                 max_packet=LEGACY_PACKET_SIZE, adaptive=False, fin_ack=False, caps=0,
+                 cc=DEFAULT_CONGESTION_CONTROL, compression=None, stripes=1):
+        self.packet_size = min(packet_size, peer_max_packet)
+        self.peer_max_packet = peer_max_packet
+        self.max_packet = max_packet
+        self.adaptive = adaptive
+        self.fin_ack = fin_ack
+        self.caps = caps
+        self.cc = cc
+        self.compression = compression
+        self.stripes = stripes if caps & CAP_STRIPE else 1
+        self.channel = None
+
+    @property
+    def sack(self):
+        return bool(self.caps & CAP_SACK)
+
+    @property
+    def rwnd(self):
+        return bool(self.caps & CAP_RWND)
+
+    def attach(self, channel):
+        """Send packets over ``channel`` (CAP_DATAGRAM), each small enough for one datagram."""
+        self.channel = channel
+        self.packet_size = min(self.packet_size, channel.max_payload)
+        self.peer_max_packet = min(self.peer_max_packet, channel.max_payload)
+        # one channel per connection, so no striping
+        self.stripes = 1
+
+    @classmethod
+    def negotiate(cls, peer_hello, packet_size, max_packet, adaptive=False, caps=0,
+                  cc=DEFAULT_CONGESTION_CONTROL, codecs=(), stripes=1):
+        """``codecs`` are the compression codecs we speak, most preferred first.
+
+        Clients offer a list in the hello, the server answers with its pick
+        (or None); either way the first of ours the peer named wins.
+        ``stripes`` is the most connections we allow per transfer; the
+        smaller of ours and the peer's applies.
+        """
+        peer_max = min(int(peer_hello.get('max_packet', LEGACY_PACKET_SIZE)), MAX_PACKET_SIZE)
+        shared_caps = int(peer_hello.get('caps', 0)) & caps
+        peer_codecs = peer_hello.get('compression') or []
+        if isinstance(peer_codecs, str):
+            peer_codecs = [peer_codecs]
+        compression = next((name for name in codecs if name in peer_codecs), None)
+        peer_stripes = max(int(peer_hello.get('stripes', 1)), 1)
+        return cls(packet_size, peer_max, max_packet, adaptive, fin_ack=True, caps=shared_caps,
+                   cc=cc, compression=compression, stripes=min(stripes, peer_stripes))
+
+
+def recv_exact(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionResetError("Connection closed mid-message")
+        data += chunk
+    return bytes(data)
+
+
+def encode_ack(ack_num, blocks=None, window=None):
+    """Cumulative ACK, plus the receive window and SACK blocks when negotiated.
+
+    With CAP_RWND the 4-byte cumulative ACK is followed by the 4-byte
+    ``window``. With SACK there follow a block count and that many
+    inclusive (start, end) sequence ranges held beyond the cumulative ACK.
+    """
+    data = (ack_num & 0xFFFFFFFF).to_bytes(4, 'big')
+    if window is not None:
+        data += min(window, 0xFFFFFFFF).to_bytes(4, 'big')
+    if blocks is None:
+        return data
+    parts = [data, len(blocks).to_bytes(1, 'big')]
+    for start, end in blocks:
+        parts.append(start.to_bytes(4, 'big') + end.to_bytes(4, 'big'))
+    return b''.join(parts)
+
+
+def decode_ack(data):
+    ack_num = int.from_bytes(data, 'big')
+    return -1 if ack_num == ACK_NONE else ack_num
+
+
+def recv_ack(sock, sack=False, rwnd=False):
+    """Read one ACK; returns ``(cumulative ack, list of SACK blocks, window)``.
+
+    ``window`` is None unless the connection negotiated CAP_RWND.
+    """
+    ack_num = decode_ack(recv_exact(sock, 4))
+    window = int.from_bytes(recv_exact(sock, 4), 'big') if rwnd else None
+    if not sack:
+        return ack_num, [], window
+    count = recv_exact(sock, 1)[0]
+    raw = recv_exact(sock, 8 * count) if count else b''
+    blocks = [(int.from_bytes(raw[i:i + 4], 'big'), int.from_bytes(raw[i + 4:i + 8], 'big'))
+              for i in range(0, len(raw), 8)]
+    return ack_num, blocks, window
+
+
+def drain_acks(sock, sack=False, rwnd=False):
+    """Discard late duplicate ACKs up to and including ACK_FIN."""
+    while recv_ack(sock, sack, rwnd)[0] != ACK_FIN:
+        pass
+
+
+def send_json(sock, obj):
+    payload = json.dumps(obj).encode()
+    sock.sendall(len(payload).to_bytes(4, 'big') + payload)
+
+
+def recv_json(sock):
+    length = int.from_bytes(recv_exact(sock, 4), 'big')
+    return json.loads(recv_exact(sock, length).decode())
+
+
+def wait_readable(sock, timeout):
+    """True once ``sock`` has data to read, False if ``timeout`` passes first."""
+    # TLS sockets and datagram channels may hold data select() cannot see
+    pending = getattr(sock, 'pending', None)
+    if pending and pending():
+        return True
+    return bool(select.select([sock], [], [], timeout)[0])
+
+
+def recv_exact_into(sock, view):
+    """Fill ``view`` (a writable memoryview) from the socket without copies."""
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionResetError("Connection closed mid-message")
+        received += n
@@ -0,0 +1,110 @@
+import json
+import os
+import re
+import threading
+import time
+
+RESUME_TTL = float(os.environ.get('FILEFUSION_RESUME_TTL', str(24 * 3600)))
+
+_TRANSFER_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def valid_transfer_id(transfer_id):
+    return isinstance(transfer_id, str) and bool(_TRANSFER_ID_RE.match(transfer_id))
+
+
+class PartialStore:
+    """Partly received files kept on disk so a broken transfer can resume.
+
+    Each transfer ID owns ``<root>/<id>.part`` plus a small JSON sidecar
+    with a tag describing what is being received (content digest and size,
+    or the sender's etag). StreamingReceiver only ever writes the in-order
+    prefix, so the committed offset is simply the size of the .part file:
+    whatever reached the disk before the connection died. Entries untouched
+    for ``ttl`` seconds are deleted.
+    """
+
+    def __init__(self, root, ttl=RESUME_TTL):
+        self.root = root
+        self.ttl = ttl
+        self.active = set()
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, transfer_id):
+        return os.path.join(self.root, f"{transfer_id}.part")
+
+    def _meta_path(self, transfer_id):
+        return os.path.join(self.root, f"{transfer_id}.json")
+
+    def _read_meta(self, transfer_id):
+        try:
+            with open(self._meta_path(transfer_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def claim(self, transfer_id):
+        """Reserve ``transfer_id`` for one connection; False if already taken."""
+        with self.lock:
+            if transfer_id in self.active:
+                return False
+            self.active.add(transfer_id)
+            return True
+
+    def held(self, transfer_id):
+        """``(tag, committed bytes)`` of an unexpired entry, else ``(None, 0)``."""
+        meta = self._read_meta(transfer_id)
+        if meta is None or time.time() - meta.get('updated', 0) > self.ttl:
+            return None, 0
+        try:
+            return meta.get('tag'), os.path.getsize(self.path(transfer_id))
+        except FileNotFoundError:
+            return None, 0
+
+    def prepare(self, transfer_id, tag, offset):
+        """Cut the part file back to ``offset`` and label it; returns its path."""
+        path = self.path(transfer_id)
+        with open(path, 'ab') as f:
+            f.truncate(offset)
+        with open(self._meta_path(transfer_id), 'w') as f:
+            json.dump({'tag': tag, 'updated': time.time()}, f)
+        return path
+
+    def open(self, transfer_id, tag):
+        """Claim ``transfer_id`` and ready it for ``tag``; ``(path, offset)`` or None.
+
+        Returns ``None`` if another connection holds the same ID. A tag
+        mismatch or expired entry starts over from offset 0.
+        """
+        self.expire()
+        if not self.claim(transfer_id):
+            return None
+        held_tag, offset = self.held(transfer_id)
+        if held_tag != tag:
+            offset = 0
+        return self.prepare(transfer_id, tag, offset), offset
+
+    def release(self, transfer_id):
+        """Give up the claim but keep the data for a later resume."""
+        with self.lock:
+            self.active.discard(transfer_id)
+
+    def finish(self, transfer_id):
+        """Forget a transfer that completed (or must not be resumed)."""
+        for path in (self.path(transfer_id), self._meta_path(transfer_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.release(transfer_id)
+
+    def expire(self):
+        now = time.time()
+        for name in os.listdir(self.root):
+            transfer_id, ext = os.path.splitext(name)
+            if ext != '.json' or transfer_id in self.active:
+                continue
+            meta = self._read_meta(transfer_id)
+            if meta is None or now - meta.get('updated', 0) > self.ttl:
+                self.finish(transfer_id)
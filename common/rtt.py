@@ -0,0 +1,189 @@
+import math
+
+# RFC 6298 constants
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+INITIAL_RTO = 1.0
+# RFC 6298 asks for a 1 s floor; on a LAN that would dominate recovery time
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+
+
+class RttEstimator:
+    """Smoothed RTT and retransmission timeout as in RFC 6298.
+
+    Callers apply Karn's rule themselves: only ACKs for packets that were
+    sent exactly once may be passed to ``sample``.
+    """
+
+    def __init__(self, initial_rto=INITIAL_RTO, min_rto=MIN_RTO, max_rto=MAX_RTO,
+                 granularity=0.001):
+        self.srtt = None
+        self.rttvar = None
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.granularity = granularity
+        self.rto = min(max(initial_rto, min_rto), max_rto)
+        self.backoffs = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.backoffs = 0
+        self._set_rto(self.srtt + max(self.granularity, K * self.rttvar))
+
+    def backoff(self):
+        """Double the RTO after a retransmission timeout."""
+        self.backoffs += 1
+        self._set_rto(self.rto * 2)
+
+    def _set_rto(self, rto):
+        self.rto = min(max(rto, self.min_rto), self.max_rto)
+
+    def describe(self):
+        srtt = self.srtt if self.srtt is not None else 0.0
+        rttvar = self.rttvar if self.rttvar is not None else 0.0
+        return f"srtt={srtt:.4f} rttvar={rttvar:.4f} rto={self.rto:.4f}"
+
+
+class TimerWheel:
+    """Hashed timer wheel holding one retransmission deadline per packet.
+
+    Scheduling and cancelling are O(1); ``expired`` only visits the slots
+    for the ticks that elapsed instead of scanning every in-flight packet.
+    Deadlines more than one revolution out stay in their slot until due.
+    """
+
+    def __init__(self, tick=0.005, slots=1024):
+        self.tick = tick
+        self.slots = slots
+        self.wheel = [set() for _ in range(slots)]
+        self.deadlines = {}
+        self.cursor = None
+
+    def _tick_of(self, when):
+        return math.floor(when / self.tick)
+
+    def schedule(self, seq_num, deadline):
+        self.deadlines[seq_num] = deadline
+        tick = self._tick_of(deadline)
+        self.wheel[tick % self.slots].add(seq_num)
+        if self.cursor is None or tick < self.cursor:
+            self.cursor = tick
+
+    def cancel(self, seq_num):
+        # slot entries are dropped lazily when their slot is next visited
+        self.deadlines.pop(seq_num, None)
+
+    def cancel_below(self, base):
+        for seq_num in [s for s in self.deadlines if s < base]:
+            del self.deadlines[seq_num]
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def _due_in_tick(self, t):
+        """Live deadlines that fall inside tick ``t``; prunes stale entries."""
+        slot = self.wheel[t % self.slots]
+        due = []
+        for seq_num in list(slot):
+            deadline = self.deadlines.get(seq_num)
+            if deadline is None or self._tick_of(deadline) % self.slots != t % self.slots:
+                slot.discard(seq_num)
+            elif self._tick_of(deadline) == t:
+                due.append((deadline, seq_num))
+        return due
+
+    def expired(self, now):
+        """Pop and return every packet whose deadline is at or before ``now``."""
+        if not self.deadlines:
+            self.cursor = None
+            return []
+        now_tick = self._tick_of(now)
+        if self.cursor is None or self.cursor > now_tick:
+            return []
+        if now_tick - self.cursor >= self.slots:
+            # slept through a whole revolution; fall back to a full sweep
+            due = sorted(s for s, d in self.deadlines.items() if d <= now)
+            for seq_num in due:
+                del self.deadlines[seq_num]
+            self.cursor = now_tick
+            return due
+        due = []
+        for t in range(self.cursor, now_tick + 1):
+            for deadline, seq_num in self._due_in_tick(t):
+                if deadline <= now:
+                    self.wheel[t % self.slots].discard(seq_num)
+                    del self.deadlines[seq_num]
+                    due.append(seq_num)
+        self.cursor = now_tick
+        due.sort()
+        return due
+
+    def next_deadline(self, now):
+        """Earliest pending deadline (possibly already past), or ``None``."""
+        if not self.deadlines:
+            return None
+        now_tick = self._tick_of(now)
+        t = self.cursor if self.cursor is not None else now_tick
+        for t in range(t, max(t, now_tick) + self.slots):
+            due = self._due_in_tick(t)
+            if due:
+                return min(due)[0]
+            if t < now_tick:
+                # nothing left in a tick that has already passed
+                self.cursor = t + 1
+        # everything is more than one revolution away
+        return min(self.deadlines.values())
+
+
+class RetransmitTimer:
+    """Sender-side RTO machinery for one transfer.
+
+    Records send times, applies Karn's rule (retransmitted packets never
+    produce RTT samples) and keeps one deadline per in-flight packet in a
+    TimerWheel armed with the current RTO.
+    """
+
+    def __init__(self, max_rto=MAX_RTO):
+        self.rtt = RttEstimator(max_rto=max_rto)
+        self.wheel = TimerWheel()
+        self.sent_at = {}
+        self.retransmitted = set()
+
+    def on_send(self, seq_num, now, retransmit=False):
+        if retransmit:
+            self.retransmitted.add(seq_num)
+        else:
+            self.sent_at[seq_num] = now
+        self.wheel.schedule(seq_num, now + self.rtt.rto)
+
+    def on_ack(self, ack_num, now):
+        """Cumulative ACK for ``ack_num``; returns the RTT sample it gave, if any."""
+        sampled = None
+        if ack_num in self.sent_at and ack_num not in self.retransmitted:
+            sampled = now - self.sent_at[ack_num]
+            self.rtt.sample(sampled)
+        for seq_num in [s for s in self.sent_at if s <= ack_num]:
+            del self.sent_at[seq_num]
+        self.retransmitted = {s for s in self.retransmitted if s > ack_num}
+        self.wheel.cancel_below(ack_num + 1)
+        return sampled
+
+    def expired(self, now):
+        """Packets whose timer fired; backs the RTO off once per expiry."""
+        due = self.wheel.expired(now)
+        if due:
+            self.rtt.backoff()
+        return due
+
+    def socket_timeout(self, now):
+        deadline = self.wheel.next_deadline(now)
+        if deadline is None:
+            return self.rtt.rto
+        return max(deadline - now, 0.001)
@@ -0,0 +1,591 @@
+import hashlib
+import mmap
+import os
+import ssl
+import time
+
+from common.compression import CompressionStats, probe
+from common.protocol import (COMPRESSED_FLAG, END_SEQ, LEGACY_PACKET_SIZE, PACKET_HEADER_SIZE,
+                             SACK_MAX_BLOCKS, recv_exact_into)
+
+# Adaptive packet sizing never shrinks below the v1 packet size and grows
+# after this many consecutive loss-free cumulative ACKs.
+MIN_PACKET_SIZE = LEGACY_PACKET_SIZE
+GROW_AFTER_ACKS = 16
+
+# Out-of-order packets held while waiting for a hole to be filled. Anything
+# beyond this is dropped and left to the sender's retransmission.
+REORDER_LIMIT = 64
+# Bytes those packets may take up. With CAP_RWND the receiver advertises
+# what is left, so the sender slows down instead of having packets dropped.
+RECEIVE_BUFFER = int(os.environ.get('FILEFUSION_RECV_BUFFER', str(8 << 20)))
+# Zero-window probes go out after this long without a window update,
+# backing off exponentially up to PROBE_MAX
+PROBE_INTERVAL = 0.2
+PROBE_MAX = 10.0
+# Delayed ACKs: receivers ACK every ACK_EVERY in-order packets, or once the
+# oldest unacknowledged one has waited ACK_DELAY seconds. ACK_EVERY=1 ACKs
+# every packet.
+ACK_EVERY = int(os.environ.get('FILEFUSION_ACK_EVERY', '2'))
+ACK_DELAY = float(os.environ.get('FILEFUSION_ACK_DELAY', '0.01'))
+# Senders frame a burst of packets into one buffer and write it once it
+# holds this many bytes or the burst ends; 0 writes every packet on its own
+BATCH_BYTES = int(os.environ.get('FILEFUSION_BATCH_BYTES', str(1 << 20)))
+# Striped transfers write their ranges into one file with os.pwrite, which
+# Windows lacks; CAP_STRIPE is only offered where it exists
+HAVE_PWRITE = hasattr(os, 'pwrite')
+
+
+class StreamingReceiver:
+    """Selective Repeat receive side that writes to disk as data becomes contiguous.
+
+    Only the out-of-order tail is kept in memory (at most ``max_buffered``
+    packets and ``buffer_bytes``); in-order payloads go straight from the
+    socket buffer to the file. Packets flagged as compressed are inflated
+    with ``codec`` on the way in.
+    """
+
+    def __init__(self, fileobj, max_payload, max_buffered=REORDER_LIMIT, codec=None,
+                 buffer_bytes=RECEIVE_BUFFER):
+        self.file = fileobj
+        self.max_buffered = max_buffered
+        self.buffer_bytes = max(buffer_bytes, max_payload)
+        self.expected_seq = 0
+        self.pending = {}
+        self.pending_bytes = 0
+        self.bytes_written = 0
+        self.sha256 = hashlib.sha256()
+        self.header = bytearray(PACKET_HEADER_SIZE)
+        self.payload = bytearray(max_payload)
+        self.stats = CompressionStats(codec) if codec else None
+        self.compressed = False
+        self.wire_len = 0
+        self.in_sequence = False
+
+    @property
+    def last_in_order(self):
+        return self.expected_seq - 1
+
+    def read_packet(self, sock):
+        """Read one packet into the reusable buffers.
+
+        Returns ``(seq_num, payload view)``, or ``(None, None)`` at END.
+        """
+        recv_exact_into(sock, memoryview(self.header))
+        seq_num, data_len = self.parse_header(self.header)
+        if seq_num is None:
+            return None, None
+        view = memoryview(self.payload)[:data_len]
+        recv_exact_into(sock, view)
+        return seq_num, self.decode(view)
+
+    def parse_header(self, header):
+        """Returns ``(seq_num, payload length)``, or ``(None, None)`` for END."""
+        seq_num = int.from_bytes(header[:4], 'big')
+        data_len = int.from_bytes(header[4:PACKET_HEADER_SIZE], 'big')
+        if seq_num == END_SEQ and data_len == 0:
+            return None, None
+        self.compressed = bool(data_len & COMPRESSED_FLAG)
+        data_len &= ~COMPRESSED_FLAG
+        if data_len > len(self.payload):
+            raise ValueError(f"Packet {seq_num} payload of {data_len} bytes exceeds {len(self.payload)}")
+        # size on the wire, before decode() inflates it
+        self.wire_len = PACKET_HEADER_SIZE + data_len
+        return seq_num, data_len
+
+    def decode(self, payload):
+        """Inflate ``payload`` if the header parsed last flagged it as compressed."""
+        if not self.compressed:
+            return payload
+        if self.stats is None:
+            raise ValueError("Compressed packet on a connection without compression")
+        return memoryview(self.stats.decompress(payload, len(self.payload)))
+
+    def sack_blocks(self, limit=SACK_MAX_BLOCKS):
+        """Inclusive (start, end) ranges buffered beyond the cumulative point."""
+        blocks = []
+        for seq_num in sorted(self.pending):
+            if blocks and seq_num == blocks[-1][1] + 1:
+                blocks[-1][1] = seq_num
+            else:
+                blocks.append([seq_num, seq_num])
+        return [tuple(b) for b in blocks[:limit]]
+
+    def preload(self, path, length):
+        """Count the first ``length`` bytes of ``path`` as already received.
+
+        Used when resuming: the file holds the prefix from an earlier
+        attempt, the digest must still cover it, and ``bytes_written``
+        keeps measuring the whole file.
+        """
+        with open(path, 'rb') as f:
+            while self.bytes_written < length:
+                chunk = f.read(min(1 << 20, length - self.bytes_written))
+                if not chunk:
+                    raise ValueError(f"{path} is shorter than the {length} bytes to resume from")
+                self.sha256.update(chunk)
+                self.bytes_written += len(chunk)
+
+    def _write(self, data):
+        self.file.write(data)
+        self.sha256.update(data)
+        self.bytes_written += len(data)
+
+    def accept(self, seq_num, payload):
+        """Take one packet; returns False if it was a duplicate or dropped."""
+        # no reordering involved: the packet just extends the in-order run
+        self.in_sequence = seq_num == self.expected_seq and not self.pending
+        if seq_num < self.expected_seq or seq_num in self.pending:
+            return False
+        if seq_num == self.expected_seq:
+            self._write(payload)
+            self.expected_seq += 1
+            while self.expected_seq in self.pending:
+                data = self.pending.pop(self.expected_seq)
+                self.pending_bytes -= len(data)
+                self._write(data)
+                self.expected_seq += 1
+            return True
+        if len(self.pending) >= self.max_buffered \
+                or self.pending_bytes + len(payload) > self.buffer_bytes:
+            return False
+        self.pending[seq_num] = bytes(payload)
+        self.pending_bytes += len(payload)
+        return True
+
+    def ack_urgent(self, total_size):
+        """True if the packet just accepted should be ACKed without delay.
+
+        That is anything that did not simply extend the in-order run, so
+        duplicate ACKs and SACK blocks reach the sender at once, plus the
+        first packet, which a sender in slow start is waiting on, and the
+        last one.
+        """
+        return not self.in_sequence or self.expected_seq == 1 or self.bytes_written >= total_size
+
+    def window(self):
+        """Bytes past the cumulative ACK we can still take (advertised with CAP_RWND).
+
+        Held out-of-order packets count against it, so the window closes
+        while a hole is open and reopens once the retransmission fills it.
+        """
+        free_slots = self.max_buffered - len(self.pending)
+        if free_slots <= 0:
+            return 0
+        return max(0, min(self.buffer_bytes - self.pending_bytes, free_slots * len(self.payload)))
+
+
+class DelayedAck:
+    """Receiver-side delayed ACK timer (in the spirit of RFC 1122/5681).
+
+    ``on_packet`` says whether to ACK now. Otherwise the ACK is held until
+    ``every`` packets are unacknowledged or ``wait`` runs out; the receive
+    loop stops waiting for the next packet at that point and ACKs.
+    """
+
+    def __init__(self, every=ACK_EVERY, delay=ACK_DELAY):
+        self.every = max(every, 1)
+        self.delay = delay
+        self.unacked = 0
+        self.deadline = None
+
+    def on_packet(self, now, urgent=False):
+        self.unacked += 1
+        if urgent or self.unacked >= self.every:
+            return True
+        if self.deadline is None:
+            self.deadline = now + self.delay
+        return False
+
+    def sent(self):
+        self.unacked = 0
+        self.deadline = None
+
+    def wait(self, now):
+        """Seconds until the held ACK is due, or None when nothing is held."""
+        return None if self.deadline is None else max(self.deadline - now, 0.0)
+
+
+class PeerWindow:
+    """Sender's view of the receive window the peer advertises (CAP_RWND).
+
+    Packets may go out while they start inside ``window`` bytes of the
+    first unacknowledged one. When the window keeps the sender idle,
+    ``probe_due`` fires once no ACK has come for PROBE_INTERVAL, then at
+    doubling intervals: the probe packet makes the receiver ACK with its
+    current window, so a transfer cannot stall on a window update that
+    never comes.
+    """
+
+    def __init__(self):
+        self.window = None  # unknown (no limit) until the first ACK
+        self.next_probe = None
+        self.interval = PROBE_INTERVAL
+        self.probes = 0
+
+    def update(self, window):
+        if window is None:
+            return
+        self.window = window
+        # an ACK just came, so nothing is stalled; re-armed if still blocked
+        self.next_probe = None
+        if window:
+            self.interval = PROBE_INTERVAL
+
+    def allows(self, source, base, seq_num):
+        if self.window is None:
+            return True
+        return source.offset(seq_num) - source.offset(base) < self.window
+
+    def blocked(self, now):
+        """Note that the window (not cwnd or pacing) held the sender back."""
+        if self.next_probe is None:
+            self.next_probe = now + self.interval
+
+    def probe_due(self, now):
+        if self.next_probe is None or now < self.next_probe:
+            return False
+        self.probes += 1
+        self.interval = min(self.interval * 2, PROBE_MAX)
+        self.next_probe = now + self.interval
+        return True
+
+    def wait(self, now, default):
+        """Seconds until the next probe, or ``default`` when none is scheduled.
+
+        Never 0: as a socket timeout that would switch the socket to
+        non-blocking mode.
+        """
+        return default if self.next_probe is None else max(self.next_probe - now, 0.001)
+
+
+class Scoreboard:
+    """Sender-side SACK scoreboard (in the spirit of RFC 6675).
+
+    Tracks which in-flight packets the receiver reported holding and which
+    we already retransmitted. A packet counts as lost once ``dup_thresh``
+    SACKed packets sit above it.
+    """
+
+    def __init__(self, dup_thresh=3):
+        self.dup_thresh = dup_thresh
+        self.sacked = set()
+        self.retransmitted = set()
+
+    def update(self, ack_num, blocks):
+        for start, end in blocks:
+            self.sacked.update(range(max(start, ack_num + 1), end + 1))
+        self.sacked = {s for s in self.sacked if s > ack_num}
+        self.retransmitted = {s for s in self.retransmitted if s > ack_num}
+
+    def lost(self, base, next_seq):
+        """Missing packets that need a retransmit, lowest first."""
+        lost = []
+        above = 0
+        for seq_num in range(next_seq - 1, base - 1, -1):
+            if seq_num in self.sacked:
+                above += 1
+            elif above >= self.dup_thresh and seq_num not in self.retransmitted:
+                lost.append(seq_num)
+        lost.reverse()
+        return lost
+
+    def on_retransmit(self, seq_num):
+        self.retransmitted.add(seq_num)
+
+    def on_timeout(self):
+        # after an RTO every hole is fair game again
+        self.retransmitted.clear()
+
+
+class PacketSource:
+    """Sender-side packet view over a buffer; nothing is copied up front.
+
+    Payloads are memoryview slices of ``data`` (bytes, a Streamlit upload
+    buffer or an mmap of the file on disk), cut on demand as the window
+    advances, so only the packets in flight ever get materialised.
+
+    Packets are cut at the current ``packet_size``. In adaptive mode that
+    size doubles after a run of loss-free ACKs and halves on every
+    retransmit, staying between ``min_packet_size`` and ``max_packet_size``.
+    A retransmit always reuses the original packet's byte range.
+
+    ``start`` skips a prefix the receiver already holds from an interrupted
+    transfer; packet 0 then begins there and offsets stay absolute.
+
+    Once compression is enabled each packet is compressed the first time it
+    is framed and sent flagged if that made it smaller; retransmits reuse
+    the result until the packet is ACKed.
+    """
+
+    def __init__(self, data, packet_size, max_packet_size=None, adaptive=False, closer=None,
+                 start=0):
+        self.view = memoryview(data).cast('B')
+        self.packet_size = packet_size
+        self.max_packet_size = max(packet_size, max_packet_size or packet_size)
+        self.min_packet_size = min(packet_size, MIN_PACKET_SIZE)
+        self.adaptive = adaptive
+        self.total_size = len(self.view)
+        self.bounds = {}
+        self.cut_offset = min(start, self.total_size)
+        self.cut_count = 0
+        self.clean_acks = 0
+        self._closer = closer
+        self.stats = None
+        self.packed = {}
+        # reused to glue header and payload into a single TLS record
+        self._scratch = bytearray(PACKET_HEADER_SIZE + self.max_packet_size)
+        self.batch_bytes = BATCH_BYTES
+        self.batch = bytearray()
+
+    @classmethod
+    def from_file(cls, path, packet_size, max_packet_size=None, adaptive=False, start=0,
+                  byte_range=None):
+        """Map ``path``, or only its ``(start, end)`` ``byte_range`` for one stripe."""
+        f = open(path, 'rb')
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            f.close()
+            return cls(b'', packet_size, max_packet_size, adaptive)
+        if byte_range:
+            piece = memoryview(mapped)[byte_range[0]:byte_range[1]]
+
+            def closer():
+                piece.release()
+                mapped.close()
+                f.close()
+            return cls(piece, packet_size, max_packet_size, adaptive, closer)
+
+        def closer():
+            mapped.close()
+            f.close()
+        return cls(mapped, packet_size, max_packet_size, adaptive, closer, start)
+
+    def enable_compression(self, codec):
+        """Compress with ``codec`` if the data looks compressible; returns the probe's reason."""
+        worth, reason = probe(self.view[self.cut_offset:])
+        if worth:
+            self.stats = CompressionStats(codec)
+        return reason
+
+    def has_packet(self, seq_num):
+        """True if ``seq_num`` exists, cutting the next packet if needed."""
+        if seq_num < self.cut_count:
+            return True
+        if self.cut_offset >= self.total_size:
+            return False
+        end = min(self.cut_offset + self.packet_size, self.total_size)
+        self.bounds[self.cut_count] = (self.cut_offset, end)
+        self.cut_offset = end
+        self.cut_count += 1
+        return True
+
+    def finished(self, base):
+        return base >= self.cut_count and self.cut_offset >= self.total_size
+
+    def offset(self, seq_num):
+        """Byte offset where packet ``seq_num`` starts."""
+        bounds = self.bounds.get(seq_num)
+        return bounds[0] if bounds else self.cut_offset
+
+    def release(self, base):
+        """Forget the byte ranges of packets below ``base`` (all ACKed)."""
+        for seq_num in [s for s in self.bounds if s < base]:
+            del self.bounds[seq_num]
+            self.packed.pop(seq_num, None)
+
+    def on_progress(self):
+        """Note a loss-free cumulative ACK; returns True if the size grew."""
+        if not self.adaptive:
+            return False
+        self.clean_acks += 1
+        if self.clean_acks >= GROW_AFTER_ACKS and self.packet_size < self.max_packet_size:
+            self.packet_size = min(self.packet_size * 2, self.max_packet_size)
+            self.clean_acks = 0
+            return True
+        return False
+
+    def on_loss(self):
+        """Note a retransmit; returns True if the size shrank."""
+        if not self.adaptive:
+            return False
+        self.clean_acks = 0
+        if self.packet_size > self.min_packet_size:
+            self.packet_size = max(self.packet_size // 2, self.min_packet_size)
+            return True
+        return False
+
+    def payload(self, seq_num):
+        start, end = self.bounds[seq_num]
+        return self.view[start:end]
+
+    def frame(self, seq_num):
+        """``(header, payload view)`` for packet ``seq_num``."""
+        payload = self.payload(seq_num)
+        if self.stats is None:
+            return seq_num.to_bytes(4, 'big') + len(payload).to_bytes(4, 'big'), payload
+        if seq_num not in self.packed:
+            self.packed[seq_num] = self.stats.compress(payload)
+        packed = self.packed[seq_num]
+        if packed is None:
+            return seq_num.to_bytes(4, 'big') + len(payload).to_bytes(4, 'big'), payload
+        return (seq_num.to_bytes(4, 'big') + (len(packed) | COMPRESSED_FLAG).to_bytes(4, 'big'),
+                memoryview(packed))
+
+    def queue(self, seq_num):
+        """Frame packet ``seq_num`` onto the write batch; returns its size."""
+        header, payload = self.frame(seq_num)
+        self.batch += header
+        self.batch += payload
+        return len(header) + len(payload)
+
+    def take_batch(self):
+        """The batched bytes, leaving an empty batch behind."""
+        batch, self.batch = self.batch, bytearray()
+        return batch
+
+    def send(self, sock, seq_num):
+        """Send packet ``seq_num`` as header + payload without building a packets list.
+
+        With batching on the packet is only queued, and goes out with the
+        rest of the burst once the batch is full or at ``flush``. Returns
+        the number of bytes sent or queued.
+        """
+        if self.batch_bytes:
+            size = self.queue(seq_num)
+            if len(self.batch) >= self.batch_bytes:
+                self.flush(sock)
+            return size
+        header, payload = self.frame(seq_num)
+        if isinstance(sock, ssl.SSLSocket):
+            # SSLSocket has no sendmsg/sendfile; one copy into the scratch
+            # buffer keeps header and payload in the same TLS record.
+            end = PACKET_HEADER_SIZE + len(payload)
+            self._scratch[:PACKET_HEADER_SIZE] = header
+            self._scratch[PACKET_HEADER_SIZE:end] = payload
+            sock.sendall(memoryview(self._scratch)[:end])
+        else:
+            send_vectored(sock, [header, payload])
+        return len(header) + len(payload)
+
+    def flush(self, sock):
+        """Write out the batch; call before waiting on the peer."""
+        if self.batch:
+            sock.sendall(self.take_batch())
+
+    def close(self):
+        self.view.release()
+        if self._closer:
+            self._closer()
+            self._closer = None
+
+
+class RangeWriter:
+    """File stand-in that puts a stripe's bytes in place with os.pwrite.
+
+    StreamingReceiver only ever appends. Given one of these it fills the
+    stripe's range of a shared file instead, so stripes can write
+    concurrently without fighting over a file position.
+    """
+
+    def __init__(self, fileobj, offset):
+        self.fd = fileobj.fileno()
+        self.offset = offset
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            written = os.pwrite(self.fd, view, self.offset)
+            self.offset += written
+            view = view[written:]
+
+
+def file_sha256(path):
+    """Hex SHA-256 of a file, read in 1 MiB chunks."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def send_vectored(sock, buffers):
+    """sendall() for a list of buffers using scatter-gather sendmsg."""
+    buffers = [memoryview(b).cast('B') for b in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values`` (``fraction`` in 0..1), None if empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class TransferStats:
+    """Counters for one transfer; plain attribute bumps so hot loops stay cheap.
+
+    The server folds them into its global metrics when the transfer
+    finishes; benchmarks read them directly.
+    """
+
+    __slots__ = ('conn', 'direction', 'cc', 'started', 'bytes', 'packets', 'delivered',
+                 'fast_retransmits', 'timeout_retransmits', 'sack_retransmits', 'dup_acks',
+                 'duplicates', 'srtt', 'rtt_samples')
+
+    def __init__(self, conn, direction, cc):
+        self.conn = conn
+        self.direction = direction
+        self.cc = cc
+        self.started = time.time()
+        self.bytes = 0
+        self.packets = 0
+        # file bytes through so far (goodput); ``bytes`` counts everything on the wire
+        self.delivered = 0
+        self.fast_retransmits = 0
+        self.timeout_retransmits = 0
+        self.sack_retransmits = 0
+        self.dup_acks = 0
+        self.duplicates = 0
+        self.srtt = None
+        self.rtt_samples = []
+
+    def on_rtt(self, sample, srtt):
+        self.rtt_samples.append(sample)
+        self.srtt = srtt
+
+    def absorb(self, other):
+        """Add the counters of another stripe of the same transfer."""
+        for name in ('bytes', 'packets', 'delivered', 'fast_retransmits', 'timeout_retransmits',
+                     'sack_retransmits', 'dup_acks', 'duplicates'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.rtt_samples.extend(other.rtt_samples)
+
+    def snapshot(self, now=None):
+        elapsed = (now or time.time()) - self.started
+        return {
+            'conn': self.conn,
+            'direction': self.direction,
+            'cc': self.cc,
+            'elapsed': round(elapsed, 3),
+            'bytes': self.bytes,
+            'packets': self.packets,
+            'delivered': self.delivered,
+            'retransmits': {'fast': self.fast_retransmits, 'timeout': self.timeout_retransmits,
+                            'sack': self.sack_retransmits},
+            'dup_acks': self.dup_acks,
+            'duplicates': self.duplicates,
+            'goodput': round(self.delivered / elapsed, 1) if elapsed > 0 else 0.0,
+            'srtt': self.srtt,
+            'rtt_p50': percentile(self.rtt_samples, 0.5),
+            'rtt_p99': percentile(self.rtt_samples, 0.99),
+        }
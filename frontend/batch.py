@@ -0,0 +1,312 @@
+import argparse
+import hashlib
+import json
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import transport
+from transport import (CONGESTION_CONTROL, HOST, PORT, close_session, connect, fetch_result,
+                       log_message, open_session, submit_job)
+from common.congestion import CONGESTION_CONTROLS
+from common.log import WARNING
+from common.protocol import STATUS_BUSY, STATUS_IDLE, STATUS_PENDING, STATUS_QUEUED, STATUS_READY
+
+BATCH_CONNECTIONS = int(os.environ.get('FILEFUSION_BATCH_CONNECTIONS', '4'))
+BATCH_RETRIES = 2
+RETRY_DELAY = 1.0
+INPUT_EXTENSIONS = (".pptx", ".doc", ".docx", ".odt", ".xls", ".xlsx")
+OUTPUT_FORMATS = ("pdf", "docx", "odt")
+# Records finished jobs in the output directory so reruns skip them
+MANIFEST_NAME = ".filefusion_batch.json"
+
+
+class BatchJob:
+    """One file to convert, read from ``path`` or held in memory as ``data``.
+
+    ``name`` is where the result goes relative to the output directory
+    (with the extension swapped for the output format).
+    """
+
+    def __init__(self, job_id, name, output_format, path=None, data=None):
+        self.job_id = job_id
+        self.name = name
+        self.output_format = output_format
+        self.path = path
+        self.data = data
+        self.digest = None
+        # kept across retries so a new connection resumes the upload
+        self.transfer_id = uuid.uuid4().hex
+        self.attempts = 0
+        self.status = None
+        self.error = None
+
+    @property
+    def output_name(self):
+        return f"{os.path.splitext(self.name)[0]}.{self.output_format}"
+
+    @property
+    def key(self):
+        return f"{self.digest}.{self.output_format}"
+
+    def read(self):
+        if self.data is not None:
+            return self.data
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def hash(self):
+        sha256 = hashlib.sha256()
+        if self.data is not None:
+            sha256.update(self.data)
+        else:
+            with open(self.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha256.update(chunk)
+        self.digest = sha256.hexdigest()
+        return self.digest
+
+
+def collect_inputs(paths, output_format):
+    """BatchJobs for the given files and (recursively) directories."""
+    jobs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in INPUT_EXTENSIONS:
+                        full = os.path.join(root, name)
+                        jobs.append((full, os.path.relpath(full, path)))
+        else:
+            jobs.append((path, os.path.basename(path)))
+    return [BatchJob(str(i), name, output_format, path=full)
+            for i, (full, name) in enumerate(jobs)]
+
+
+class BatchRunner:
+    """Converts many files over a few parallel multi-job sessions.
+
+    Each of ``connections`` workers opens a session, pulls jobs from a
+    shared queue, submits them back to back and downloads results as they
+    finish. Failed jobs go back on the queue up to ``retries`` times.
+    Finished ones are recorded in a manifest in the output directory, each
+    output name with the input digest and format it was made from, so
+    running the same batch again only redoes what is missing or changed.
+    """
+
+    def __init__(self, jobs, output_dir, connections=BATCH_CONNECTIONS, retries=BATCH_RETRIES,
+                 host=HOST, port=PORT, cc_name=CONGESTION_CONTROL):
+        self.jobs = jobs
+        self.output_dir = output_dir
+        self.connections = max(1, connections)
+        self.retries = retries
+        self.host = host
+        self.port = port
+        self.cc_name = cc_name
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self.manifest = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.started = None
+        self._dedupe_names()
+
+    def _dedupe_names(self):
+        seen = set()
+        for job in self.jobs:
+            base, ext = os.path.splitext(job.name)
+            n = 1
+            while job.output_name in seen:
+                job.name = f"{base}_{n}{ext}"
+                n += 1
+            seen.add(job.output_name)
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.manifest = {}
+
+    def _save_manifest(self):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def run(self, on_progress=None, interval=0.25):
+        """Convert everything; calls ``on_progress(snapshot)`` from this thread."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._load_manifest()
+        for job in self.jobs:
+            job.hash()
+            if self.manifest.get(job.output_name) == job.key \
+                    and os.path.exists(os.path.join(self.output_dir, job.output_name)):
+                job.status = 'skipped'
+            else:
+                job.status = 'pending'
+                self.pending.put(job)
+
+        self.started = time.time()
+        workers = [threading.Thread(target=self._worker, daemon=True)
+                   for _ in range(min(self.connections, self.pending.qsize()))]
+        for w in workers:
+            w.start()
+        while any(w.is_alive() for w in workers):
+            for w in workers:
+                w.join(interval / len(workers))
+            if on_progress:
+                on_progress(self.snapshot())
+
+        # only left over if every worker gave up on connecting
+        while not self.pending.empty():
+            job = self.pending.get_nowait()
+            job.status, job.error = 'failed', job.error or "could not connect"
+        snapshot = self.snapshot()
+        if on_progress:
+            on_progress(snapshot)
+        return snapshot
+
+    def snapshot(self):
+        counts = {'done': 0, 'skipped': 0, 'failed': 0, 'pending': 0}
+        for job in self.jobs:
+            counts[job.status if job.status in counts else 'pending'] += 1
+        elapsed = time.time() - self.started if self.started else 0.0
+        moved = self.bytes_sent + self.bytes_received
+        return {
+            **counts,
+            'total': len(self.jobs),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'elapsed': elapsed,
+            'throughput': moved / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def _worker(self):
+        staging = tempfile.mkdtemp(prefix='.partial_', dir=self.output_dir)
+        failures = 0
+        try:
+            while not self.pending.empty() and failures <= self.retries:
+                outstanding = {}
+                # taken off the queue but not yet outstanding
+                submitting = None
+                sock = None
+                try:
+                    sock = connect(self.host, self.port)
+                    params = open_session(sock, self.cc_name)
+                    failures = 0
+                    while True:
+                        try:
+                            submitting = job = self.pending.get_nowait()
+                        except queue.Empty:
+                            break
+                        job.attempts += 1
+                        data = job.read()
+                        status = submit_job(sock, params, job.job_id, os.path.basename(job.name),
+                                            data, job.output_format,
+                                            transfer_id=job.transfer_id)
+                        submitting = None
+                        if status == STATUS_QUEUED:
+                            outstanding[job.job_id] = job
+                            with self.lock:
+                                self.bytes_sent += len(data)
+                        else:
+                            self._fail(job, status)
+                        self._collect(sock, params, staging, outstanding, wait=False)
+                    while outstanding:
+                        self._collect(sock, params, staging, outstanding, wait=True)
+                    close_session(sock)
+                except (OSError, ValueError, KeyError) as e:
+                    log_message(f"[BATCH] Session failed: {e}", WARNING)
+                    failures += 1
+                    if submitting is not None:
+                        self._fail(submitting, f"upload failed: {e}")
+                    for job in outstanding.values():
+                        self._fail(job, f"connection lost: {e}")
+                    time.sleep(RETRY_DELAY)
+                finally:
+                    if sock:
+                        sock.close()
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def _collect(self, sock, params, staging, outstanding, wait):
+        reply = fetch_result(sock, params, staging, wait=wait)
+        if reply['status'] in (STATUS_PENDING, STATUS_IDLE):
+            return
+        job = outstanding.pop(reply['job'])
+        if reply['status'] == STATUS_READY:
+            self._complete(job, reply['path'])
+        else:
+            self._fail(job, reply['status'])
+
+    def _complete(self, job, downloaded_path):
+        dest = os.path.join(self.output_dir, job.output_name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(downloaded_path, dest)
+        with self.lock:
+            self.bytes_received += os.path.getsize(dest)
+            self.manifest[job.output_name] = job.key
+            self._save_manifest()
+        job.status, job.error = 'done', None
+        log_message(f"[BATCH] {job.name} -> {dest}")
+
+    def _fail(self, job, reason):
+        job.error = reason
+        if job.attempts <= self.retries:
+            log_message(f"[BATCH] {job.name} failed ({reason}), retrying", WARNING)
+            if reason == STATUS_BUSY:
+                time.sleep(RETRY_DELAY * job.attempts)
+            self.pending.put(job)
+        else:
+            log_message(f"[BATCH] {job.name} failed ({reason}), giving up", WARNING)
+            job.status = 'failed'
+
+
+def describe(snapshot):
+    return (f"{snapshot['done'] + snapshot['skipped']}/{snapshot['total']} done "
+            f"({snapshot['skipped']} skipped), {snapshot['failed']} failed, "
+            f"{snapshot['throughput'] / (1 << 20):.2f} MiB/s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert many documents with a FileFusion server.")
+    parser.add_argument('inputs', nargs='+', help="files or directories to convert")
+    parser.add_argument('-o', '--output-dir', default='converted')
+    parser.add_argument('-f', '--format', default='pdf', choices=OUTPUT_FORMATS)
+    parser.add_argument('-j', '--connections', type=int, default=BATCH_CONNECTIONS,
+                        help="parallel sessions to the server")
+    parser.add_argument('--retries', type=int, default=BATCH_RETRIES)
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--cc', default=CONGESTION_CONTROL, choices=list(CONGESTION_CONTROLS))
+    parser.add_argument('-v', '--verbose', action='store_true', help="echo protocol logs")
+    args = parser.parse_args(argv)
+
+    transport.LOG.echo = args.verbose
+    jobs = collect_inputs(args.inputs, args.format)
+    if not jobs:
+        print("No convertible files found")
+        return 1
+    runner = BatchRunner(jobs, args.output_dir, args.connections, args.retries,
+                         args.host, args.port, args.cc)
+    summary = runner.run(lambda snapshot: print(f"\r{describe(snapshot)}", end='', flush=True))
+    print()
+    for job in jobs:
+        if job.status == 'failed':
+            print(f"FAILED {job.name}: {job.error}")
+        elif job.status == 'pending':
+            print(f"NOT CONVERTED {job.name}")
+    print(f"{summary['bytes_sent']:,} bytes up, {summary['bytes_received']:,} bytes down "
+          f"in {summary['elapsed']:.1f}s")
+    return 1 if summary['failed'] or summary['pending'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
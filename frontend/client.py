@@ -1,201 +1,35 @@
-import socket
-import ssl
 import streamlit as st
 import time
 import os
-from collections import defaultdict
+import sys
+import hashlib
+import uuid
 import qrcode
 from io import BytesIO
 from urllib.parse import quote
-import random
-
-timestamp = int(time.time())
-LOG_DIR = "../logs"
-os.makedirs(LOG_DIR, exist_ok=True)
-LOG_FILE = os.path.join(LOG_DIR, f"client_{timestamp}.log")
-
-HOST = '127.0.0.1'
-PORT = 65432
-BUFFER_SIZE = 4096
-PACKET_HEADER_SIZE = 8
-TIMEOUT = 50.0
-WINDOW_SIZE = 5
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.protocol import (CAP_KEEPALIVE, HELLO_MAGIC, MAX_PACKET_SIZE, QUEUE_STATUS,
+                             RESULT_BUSY, RESULT_OK, STATUS_BUSY, STATUS_HAVE, STATUS_SEND,
+                             TransferParams, recv_exact, recv_json, send_json)
+from common.congestion import CONGESTION_CONTROLS
+from batch import BATCH_CONNECTIONS, OUTPUT_FORMATS, BatchJob, BatchRunner, describe
+from transport import (ADAPTIVE_PACKETS, COMPRESSION_CODECS, CONGESTION_CONTROL, DOWNLOADS, HOST,
+                       PACKET_SIZE, PORT, STRIPES, SUPPORTED_CAPS, TIMEOUT, TRANSPORT, TRANSPORTS,
+                       ConnectionPool, accept_datagrams, download_id, offer_datagrams,
+                       receive_result, resume_hint, send_upload)
+
 STATIC_DIR = "static_downloads"
 
 os.makedirs(STATIC_DIR, exist_ok=True)
 
 
+@st.cache_resource
+def connection_pool():
+    # one pool per process, kept across reruns and shared by every session
+    return ConnectionPool(HOST, PORT)
 
 
-def log_message(message):
-    print(message)
-    with open(LOG_FILE, "a") as f:
-        f.write(f"{message}\n")
-
-
-def send_ack(sock, ack_num):
-    sock.sendall(ack_num.to_bytes(4, 'big'))
-    log_message(f"[CLIENT] Sent ACK {ack_num}")
-
-def receive_ack(sock):
-    ack_data = b''
-    while len(ack_data) < 4:
-        chunk = sock.recv(4 - len(ack_data))
-        if not chunk:
-            raise ConnectionResetError("Connection closed while waiting for ACK")
-        ack_data += chunk
-    return int.from_bytes(ack_data, 'big')
-
-
-def send_with_ack(sock, file_bytes, progress_bar, status_text):
-    total_size = len(file_bytes)
-    total_packets = (total_size + BUFFER_SIZE - 1) // BUFFER_SIZE
-
-    sock.sendall(str(total_size).encode().ljust(16))
-    status_text.text(f"Sent file size: {total_size}")
-
-    packets = []
-    for seq_num in range(total_packets):
-        start = seq_num * BUFFER_SIZE
-        end = min(start + BUFFER_SIZE, total_size)
-        data = file_bytes[start:end]
-        header = seq_num.to_bytes(4, 'big') + len(data).to_bytes(4, 'big')
-        packets.append((seq_num, header + data))
-
-    # ✅ Randomly choose 6 unique packets to drop once (no repeats)
-    LOSS_PACKETS = set(random.sample(range(total_packets), min(6, total_packets)))
-    dropped_once = set()
-    log_message(f"[CLIENT] Random LOSS_PACKETS selected: {sorted(LOSS_PACKETS)}")
-
-    base = 0
-    next_seq = 0
-    timers = {}
-    dup_acks = defaultdict(int)
-    sock.settimeout(TIMEOUT)
-
-    # TCP Reno variables
-    cwnd = 1
-    ssthresh = 16
-    reno_state = "Slow Start"
-    recover_point = None
-
-    log_message(f"[CLIENT][CC] cwnd={cwnd:.2f} ssthresh={ssthresh:.2f} state={reno_state}")
-
-    while base < total_packets:
-        while next_seq < base + int(cwnd) and next_seq < total_packets:
-            seq, pkt_data = packets[next_seq]
-            if seq in LOSS_PACKETS and seq not in dropped_once:
-                log_message(f"[CLIENT] Intentionally dropping Packet {seq}")
-                dropped_once.add(seq)
-                timers[seq] = time.time()
-                next_seq += 1
-                continue
-            sock.sendall(pkt_data)
-            log_message(f"[CLIENT] Sent Packet {seq}")
-            timers[seq] = time.time()
-            next_seq += 1
-
-        try:
-            ack_num = receive_ack(sock)
-            log_message(f"[CLIENT] Received ACK {ack_num}")
-
-            if ack_num >= base:
-                base = ack_num + 1
-                for i in list(timers):
-                    if i <= ack_num:
-                        timers.pop(i, None)
-                dup_acks.clear()
-
-                # ✅ Fast Recovery exit condition
-                if reno_state == "Fast Recovery" and ack_num >= recover_point:
-                    cwnd = ssthresh
-                    reno_state = "Congestion Avoidance"
-                    log_message(f"[CLIENT][CC] Exit FR: cwnd={cwnd:.2f} ssthresh={ssthresh:.2f} state={reno_state}")
-
-                # Regular cwnd increase
-                if reno_state == "Slow Start":
-                    cwnd += 1
-                    if cwnd >= ssthresh:
-                        reno_state = "Congestion Avoidance"
-                elif reno_state == "Congestion Avoidance":
-                    cwnd += 1 / cwnd
-                elif reno_state == "Fast Recovery":
-                    cwnd = cwnd  # Stay fixed in FR unless we exit
-
-                log_message(f"[CLIENT][CC] cwnd={cwnd:.2f} ssthresh={ssthresh:.2f} state={reno_state}")
-                progress_bar.progress(min(base / total_packets, 1.0))
-
-            else:
-                dup_acks[ack_num] += 1
-                if dup_acks[ack_num] >= 3 and reno_state != "Fast Recovery":
-                    ssthresh = max(cwnd / 2, 2)
-                    cwnd = ssthresh + 3
-                    reno_state = "Fast Recovery"
-                    recover_point = next_seq - 1
-                    log_message(f"[CLIENT][CC] DUPACK threshold: cwnd={cwnd:.2f} ssthresh={ssthresh:.2f} state={reno_state}")
-
-                    resend_seq = ack_num + 1
-                    if resend_seq < total_packets:
-                        log_message(f"[CLIENT] Fast retransmit of Packet {resend_seq}")
-                        sock.sendall(packets[resend_seq][1])
-                        timers[resend_seq] = time.time()
-                    dup_acks[ack_num] = 0
-
-        except socket.timeout:
-            now = time.time()
-            for seq in range(base, next_seq):
-                if seq in timers and now - timers[seq] >= TIMEOUT:
-                    ssthresh = max(cwnd / 2, 2)
-                    cwnd = ssthresh
-                    reno_state = "Slow Start"
-                    log_message(f"[CLIENT][CC] TIMEOUT: cwnd={cwnd:.2f} ssthresh={ssthresh:.2f} state={reno_state}")
-
-                    log_message(f"[CLIENT] Timeout retransmit of Packet {seq}")
-                    sock.sendall(packets[seq][1])
-                    timers[seq] = time.time()
-                    status_text.text(f"Timeout! Resending from Packet {seq}")
-
-    sock.sendall((0xFFFFFFFF).to_bytes(4, 'big') + (0).to_bytes(4, 'big'))
-    time.sleep(0.1)
-    status_text.text("Upload complete!")
-    progress_bar.progress(1.0)
-
-    return True
-
-def receive_with_ack(sock, progress_bar, status_text):
-    filesize = int(sock.recv(16).decode().strip())
-    buffer = {}
-    expected_seq = 0
-    received_bytes = 0
-
-    while received_bytes < filesize:
-        header = sock.recv(PACKET_HEADER_SIZE)
-        if not header:
-            raise ConnectionResetError("Connection closed while receiving header")
-        seq_num = int.from_bytes(header[:4], 'big')
-        data_len = int.from_bytes(header[4:], 'big')
-
-        if seq_num == 0xFFFFFFFF and data_len == 0:
-            break
-
-        data = b''
-        while len(data) < data_len:
-            chunk = sock.recv(data_len - len(data))
-            if not chunk:
-                raise ConnectionResetError("Connection closed during data reception")
-            data += chunk
-
-        buffer[seq_num] = data
-
-        if seq_num == expected_seq:
-            while expected_seq in buffer:
-                expected_seq += 1
-        send_ack(sock, expected_seq - 1)
-        received_bytes += len(data)
-        progress_bar.progress(min(received_bytes / filesize, 1.0))
-
-    return b''.join(buffer[seq] for seq in sorted(buffer))
-
 def generate_qr_code(url):
     qr = qrcode.QRCode(version=1, box_size=8, border=2)
     qr.add_data(url)
@@ -207,15 +41,59 @@ def generate_qr_code(url):
     return buf
 
 
+def batch_mode():
+    uploaded_files = st.file_uploader("Upload your files", type=[".doc", ".docx", ".odt", ".pptx"],
+                                      accept_multiple_files=True)
+    output_format = st.selectbox("Select output format", list(OUTPUT_FORMATS))
+    connections = st.slider("Parallel connections", 1, 16, BATCH_CONNECTIONS)
+    output_dir = st.text_input("Output directory", os.path.join(STATIC_DIR, "batch"))
+    st.caption("Running the same batch again retries failed files; finished ones are skipped.")
+
+    if not uploaded_files or not st.button("Convert all"):
+        return
+    jobs = [BatchJob(str(i), f.name, output_format, data=f.getbuffer())
+            for i, f in enumerate(uploaded_files)]
+    runner = BatchRunner(jobs, output_dir, connections)
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+
+    def on_progress(snapshot):
+        finished = snapshot['done'] + snapshot['skipped'] + snapshot['failed']
+        progress_bar.progress(finished / snapshot['total'])
+        status_text.text(describe(snapshot))
+
+    summary = runner.run(on_progress)
+    col1, col2, col3 = st.columns(3)
+    col1.metric("✅ Converted", summary['done'] + summary['skipped'])
+    col2.metric("❌ Failed", summary['failed'])
+    col3.metric("📶 Throughput", f"{summary['throughput'] / (1 << 20):.2f} MiB/s")
+    for job in jobs:
+        if job.status == 'failed':
+            st.error(f"{job.name}: {job.error}")
+    st.success(f"Results written to {os.path.abspath(output_dir)}")
+
+
 def main():
     st.title("📄 FileFusion (Secure File Converter)")
 
     with st.expander("📊 Protocol Information"):
-        st.write(f"**Packet Size:** {BUFFER_SIZE} bytes")
-        st.write(f"**Window Size:** {WINDOW_SIZE}")
-        st.write(f"**Timeout:** {TIMEOUT} seconds")
+        st.write(f"**Packet Size:** {PACKET_SIZE} bytes (negotiated, max {MAX_PACKET_SIZE})"
+                 f"{', adaptive' if ADAPTIVE_PACKETS else ''}")
+        st.write(f"**Congestion Control:** {', '.join(CONGESTION_CONTROLS)} "
+                 f"(default {CONGESTION_CONTROL})")
+        st.write(f"**Compression:** {', '.join(COMPRESSION_CODECS) or 'off'} "
+                 f"(skipped for ZIP-based and high-entropy files)")
+        st.write(f"**Timeout:** adaptive RTO (RFC 6298), max {TIMEOUT} seconds")
+        st.write(f"**Striping:** "
+                 f"{f'up to {STRIPES} connections per large file' if STRIPES > 1 else 'off'}")
+        st.write(f"**Transport:** TLS over TCP"
+                 f"{', or AES-GCM datagrams over UDP' if 'udp' in TRANSPORTS else ''}")
         st.write(f"**Server:** {HOST}:{PORT}")
 
+    if st.radio("Mode", ["Single file", "Batch"], horizontal=True) == "Batch":
+        batch_mode()
+        return
+
     uploaded_file = st.file_uploader("Upload your file", type=[".doc", ".docx", ".odt", ".pptx"])
 
     output_format = None
@@ -223,39 +101,97 @@ def main():
         file_ext = os.path.splitext(uploaded_file.name)[1].lower()
         allowed_outputs = ["pdf", "docx", "odt"]
         output_format = st.selectbox("Select output format", allowed_outputs)
+        algorithms = list(CONGESTION_CONTROLS)
+        cc_name = st.selectbox("Congestion control", algorithms,
+                               index=algorithms.index(CONGESTION_CONTROL)
+                               if CONGESTION_CONTROL in algorithms else 0)
+        transport = st.selectbox("Transport", TRANSPORTS,
+                                 index=TRANSPORTS.index(TRANSPORT)
+                                 if TRANSPORT in TRANSPORTS else 0,
+                                 format_func=lambda name: {'tcp': "TCP (TLS)",
+                                                           'udp': "UDP (AES-GCM)"}[name])
 
     if uploaded_file and output_format:
         filename = uploaded_file.name
-        file_bytes = uploaded_file.read()
+        # zero-copy view of the upload; packets are sliced from it on demand
+        file_bytes = uploaded_file.getbuffer()
 
         st.info(f"📄  **File:** {filename}")
         st.info(f"📏  **Size:** {len(file_bytes):,} bytes")
         st.info(f"🔄 **Converting to:** {output_format.upper()}")
 
-        expected_packets = (len(file_bytes) + BUFFER_SIZE - 1) // BUFFER_SIZE
+        expected_packets = (len(file_bytes) + PACKET_SIZE - 1) // PACKET_SIZE
         st.info(f"📦 **Expected packets:** {expected_packets}")
 
         if st.button("Upload and Convert"):
+            pool = connection_pool()
             sock = None
+            channel = None
+            # set once the exchange ends on a message boundary, so the
+            # connection can go back to the pool for the next job
+            clean = False
+            keepalive = None
+            digest = hashlib.sha256(file_bytes).hexdigest()
+            # Same IDs on every attempt, so pressing the button again after a
+            # dropped connection resumes the upload or download
+            upload_id = st.session_state.setdefault('upload_ids', {}).setdefault(
+                digest, uuid.uuid4().hex)
+            result_id = download_id(digest, output_format)
+            if not DOWNLOADS.claim(result_id):
+                result_id = None
             try:
                 with st.spinner("Connecting to secure server..."):
-                    raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    context = ssl._create_unverified_context()
-                    sock = context.wrap_socket(raw_sock, server_hostname=HOST)
-                    sock.settimeout(30.0)
-                    sock.connect((HOST, PORT))
-                    sock.settimeout(None)
-
-                    sock.sendall(str(len(filename)).encode().ljust(4))
-                    sock.sendall(filename.encode())
-                    sock.sendall(output_format.encode().ljust(8))
+                    sock = pool.acquire()
+
+                    # Hash-first hello: the server may already have this file
+                    hello = {
+                        'filename': filename,
+                        'output_format': output_format,
+                        'size': len(file_bytes),
+                        'digest': digest,
+                        'max_packet': MAX_PACKET_SIZE,
+                        'caps': SUPPORTED_CAPS,
+                        'cc': cc_name,
+                        'transfer_id': upload_id,
+                        'compression': COMPRESSION_CODECS,
+                        'stripes': STRIPES,
+                    }
+                    held = resume_hint(result_id) if result_id else None
+                    if held:
+                        hello['download'] = held
+                    channel = offer_datagrams(sock, hello, transport)
+                    sock.sendall(HELLO_MAGIC)
+                    send_json(sock, hello)
+                    reply = recv_json(sock)
+                    params = TransferParams.negotiate(reply, PACKET_SIZE, MAX_PACKET_SIZE,
+                                                      ADAPTIVE_PACKETS, SUPPORTED_CAPS, cc_name,
+                                                      COMPRESSION_CODECS, STRIPES)
+                    if params.caps & CAP_KEEPALIVE:
+                        keepalive = reply.get('keepalive')
+                    channel = accept_datagrams(sock, channel, reply, params)
+
+                if reply['status'] == STATUS_BUSY:
+                    st.error(f"⏳ Server is busy, try again in about "
+                             f"{reply.get('retry_after', 0):.0f}s")
+                    clean = True
+                    return
+                if reply['status'] not in (STATUS_HAVE, STATUS_SEND):
+                    st.error(f"❌ Server rejected the file: {reply.get('message', reply['status'])}")
+                    clean = True
+                    return
 
                 st.subheader("📤 Upload Progress")
                 upload_progress = st.progress(0)
                 upload_status = st.empty()
 
                 upload_start = time.time()
-                success = send_with_ack(sock, file_bytes, upload_progress, upload_status)
+                if reply['status'] == STATUS_HAVE:
+                    upload_status.text("Server already has this file, upload skipped")
+                    upload_progress.progress(1.0)
+                    success = True
+                else:
+                    success = send_upload(sock, file_bytes, reply, upload_progress, upload_status,
+                                          params)
                 upload_end = time.time()
 
                 if not success:
@@ -267,28 +203,47 @@ def main():
                 conversion_status.text("Waiting for server response...")
 
                 sock.settimeout(600.0)
-                response = sock.recv(2)
+                response = recv_exact(sock, 2)
+                while response == QUEUE_STATUS:
+                    queue = recv_json(sock)
+                    if queue['position']:
+                        conversion_status.text(f"Queued at position {queue['position']}, "
+                                               f"about {queue['eta']:.0f}s to go...")
+                    else:
+                        conversion_status.text(f"Converting, about {queue['eta']:.0f}s to go...")
+                    response = recv_exact(sock, 2)
                 sock.settimeout(None)
+                clean = response != RESULT_OK
 
-                if response != b"OK":
+                if response == RESULT_BUSY:
+                    st.error("⏳ Server conversion queue is full, please try again shortly")
+                    return
+                if response != RESULT_OK:
                     st.error("❌ Conversion failed on server")
                     return
 
                 conversion_status.text("Conversion completed successfully!")
 
                 st.subheader("📥 Download Progress")
-                name_len = int(sock.recv(4).decode().strip())
-                converted_name = sock.recv(name_len).decode()
+                name_len = int(recv_exact(sock, 4).decode().strip())
+                converted_name = os.path.basename(recv_exact(sock, name_len).decode())
+
+                # Stream straight into static_downloads so the converted file
+                # never has to sit in memory as one bytes object
+                os.makedirs(STATIC_DIR, exist_ok=True)
+                shared_path = os.path.join(STATIC_DIR, converted_name)
 
                 download_progress = st.progress(0)
                 download_status = st.empty()
                 download_start = time.time()
-                converted_data = receive_with_ack(sock, download_progress, download_status)
+                received = receive_result(sock, shared_path, download_progress, download_status,
+                                          params, result_id)
                 download_end = time.time()
 
-                if not converted_data:
+                if not received:
                     st.error("❌ Failed to receive converted file")
                     return
+                clean = True
 
                 st.success("🎉 Conversion completed successfully!")
 
@@ -298,36 +253,39 @@ def main():
                     st.metric("📥 Download Time (Client)", f"{download_end - download_start:.2f}s")
                     st.metric("📦 Total Packets", expected_packets)
 
-                st.download_button(
-                    label="💾 Download Converted File",
-                    data=converted_data,
-                    file_name=converted_name,
-                    mime='application/octet-stream'
-                )
-
                 # ✅ Save conversion result to session_state for later sharing
                 st.session_state['converted_name'] = converted_name
-                st.session_state['converted_data'] = converted_data
-
-                # ✅ Also save a local copy in static_downloads
-                os.makedirs("static_downloads", exist_ok=True)
-                shared_path = os.path.join("static_downloads", converted_name)
-                with open(shared_path, "wb") as f:
-                    f.write(converted_data)
+                st.session_state['converted_path'] = shared_path
 
             except Exception as e:
                 st.error(f"❌ Connection failed: {e}")
+                st.caption("Press Upload and Convert again to resume where the transfer stopped.")
                 import traceback
                 st.text(traceback.format_exc())
             finally:
+                if result_id:
+                    DOWNLOADS.release(result_id)
+                if channel:
+                    channel.close()
                 if sock:
                     try:
-                        sock.close()
+                        if clean:
+                            pool.release(sock, keepalive)
+                        else:
+                            pool.discard(sock)
                     except:
                         pass
 
     # ✅ Always show share section if we have a converted file
-    if 'converted_name' in st.session_state and 'converted_data' in st.session_state:
+    if 'converted_name' in st.session_state and 'converted_path' in st.session_state:
+        with open(st.session_state['converted_path'], 'rb') as f:
+            st.download_button(
+                label="💾 Download Converted File",
+                data=f,
+                file_name=st.session_state['converted_name'],
+                mime='application/octet-stream'
+            )
+
         st.subheader("📲 Share via QR code on local network")
         with st.expander("Share your file"):
             if "lan_ip" not in st.session_state:
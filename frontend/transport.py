@@ -0,0 +1,702 @@
+import socket
+import ssl
+import time
+import os
+import sys
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.protocol import (ACK_FIN, CAP_DATAGRAM, CAP_KEEPALIVE, CAP_QUEUE_STATUS, CAP_RESUME,
+                             CAP_RWND, CAP_SACK, CAP_STRIPE, CMD_BYE, CMD_FETCH, CMD_SUBMIT,
+                             END_SEQ,
+                             HELLO_MAGIC, MAX_PACKET_SIZE, STATUS_HAVE, STATUS_READY, STATUS_SEND,
+                             STATUS_SESSION, TransferParams, drain_acks, encode_ack, recv_ack,
+                             recv_exact, recv_json, send_json, wait_readable)
+from common.congestion import DEFAULT_CONGESTION_CONTROL, make_congestion_control
+from common.compression import make_codec, offered_codecs
+from common.datagram import HAVE_AESGCM, DatagramChannel
+from common.impair import Impairment
+from common.log import CONNECTION, DEBUG, INFO, TRACE, WARNING, AsyncLog, bind_connection
+from common.resume import PartialStore
+from common.rtt import RetransmitTimer
+from common.transfer import (HAVE_PWRITE, DelayedAck, PacketSource, PeerWindow, RangeWriter,
+                             Scoreboard, StreamingReceiver, TransferStats)
+
+# Client side of the transfer protocol, free of Streamlit so that both the
+# UI (client.py) and the headless batch runner (batch.py) can use it.
+
+timestamp = int(time.time())
+LOG_DIR = "../logs"
+os.makedirs(LOG_DIR, exist_ok=True)
+LOG_FILE = os.path.join(LOG_DIR, f"client_{timestamp}.log")
+# The batch CLI sets LOG.echo = False so protocol lines only go to the log file
+LOG = AsyncLog(LOG_FILE, 'client')
+
+HOST = '127.0.0.1'
+PORT = 65432
+# Upload packet size offered to the server (capped by its advertised maximum)
+PACKET_SIZE = int(os.environ.get('FILEFUSION_PACKET_SIZE', str(64 * 1024)))
+ADAPTIVE_PACKETS = os.environ.get('FILEFUSION_ADAPTIVE_PACKETS', '0') == '1'
+SUPPORTED_CAPS = (CAP_SACK | CAP_QUEUE_STATUS | CAP_RESUME | CAP_RWND | CAP_KEEPALIVE
+                  | (CAP_STRIPE if HAVE_PWRITE else 0) | (CAP_DATAGRAM if HAVE_AESGCM else 0))
+# Parallel connections a large transfer may be striped over (1 = never);
+# the server grants at most its FILEFUSION_MAX_STRIPES
+STRIPES = int(os.environ.get('FILEFUSION_STRIPES', '1'))
+# Default transport for packets: "tcp" (over TLS) or "udp" (AES-GCM
+# datagrams, needs the cryptography package); the UI can pick per job
+TRANSPORT = os.environ.get('FILEFUSION_TRANSPORT', 'tcp')
+TRANSPORTS = ('tcp', 'udp') if HAVE_AESGCM else ('tcp',)
+# Upper clamp for the adaptive retransmission timeout (RFC 6298 style)
+TIMEOUT = 50.0
+# Default upload congestion controller; the UI can pick another per job
+CONGESTION_CONTROL = os.environ.get('FILEFUSION_CC', DEFAULT_CONGESTION_CONTROL)
+# Packet compression codecs offered in the hello, best first (FILEFUSION_COMPRESSION)
+COMPRESSION_CODECS = offered_codecs()
+# Interrupted downloads are kept here and resumed by the next attempt
+PARTIAL_DIR = os.environ.get('FILEFUSION_PARTIAL_DIR', '.filefusion_partial')
+DOWNLOADS = PartialStore(PARTIAL_DIR)
+# Idle keep-alive connections a ConnectionPool holds on to
+POOL_SIZE = int(os.environ.get('FILEFUSION_POOL_SIZE', '4'))
+# Pooled connections are dropped this many seconds before the server's
+# keep-alive timeout would close them under us
+KEEPALIVE_MARGIN = 2.0
+# One context for every connection, so that TLS sessions can be resumed
+SSL_CONTEXT = ssl._create_unverified_context()
+
+
+class Silent:
+    """Stands in for the Streamlit progress bar and status text when headless."""
+
+    def progress(self, value):
+        pass
+
+    def text(self, value):
+        pass
+
+
+SILENT = Silent()
+
+
+def log_message(message, level=INFO):
+    LOG.log(message, level)
+
+
+def connect(host=HOST, port=PORT, timeout=30.0, session=None):
+    """Open a TLS connection, resuming ``session`` (an ssl.SSLSession) if the server agrees."""
+    raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # batched packet writes and small ACKs would stall behind Nagle and the
+    # peer's delayed ACK; asyncio already sets this on the server side
+    raw_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock = SSL_CONTEXT.wrap_socket(raw_sock, server_hostname=host, session=session)
+    sock.settimeout(timeout)
+    sock.connect((host, port))
+    sock.settimeout(None)
+    bind_socket(sock)
+    if session is not None:
+        log_message(f"[CLIENT] TLS session {'resumed' if sock.session_reused else 'renewed'}",
+                    DEBUG)
+    return sock
+
+
+def bind_socket(sock):
+    # same "ip:port" the server tags this connection's records with
+    local_host, local_port = sock.getsockname()[:2]
+    bind_connection(f"{local_host}:{local_port}")
+
+
+class ConnectionPool:
+    """Keep-alive connections to one server, shared by successive jobs (CAP_KEEPALIVE).
+
+    ``acquire`` hands out an idle connection that is still good, or opens a
+    new one resuming the last TLS session, so even a fresh connection skips
+    the full handshake. A job gives its connection back with ``release``
+    once it ended cleanly, or ``discard``s it after anything else. Safe to
+    share between threads; each connection serves one job at a time.
+    """
+
+    def __init__(self, host=HOST, port=PORT, size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle = []  # (sock, reuse deadline), most recently used last
+        self.session = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                sock, deadline = self.idle.pop()
+                # nothing arrives on an idle connection unless the server closed it
+                if deadline > now and not wait_readable(sock, 0):
+                    bind_socket(sock)
+                    log_message("[CLIENT] Reusing keep-alive connection", DEBUG)
+                    return sock
+                sock.close()
+            session = self.session
+        return connect(self.host, self.port, session=session)
+
+    def release(self, sock, keepalive):
+        """Take ``sock`` back after a job; ``keepalive`` is the server's idle
+        timeout from the hello reply, None if it did not offer one."""
+        self.remember(sock)
+        if not keepalive or keepalive <= KEEPALIVE_MARGIN:
+            sock.close()
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((sock, time.monotonic() + keepalive - KEEPALIVE_MARGIN))
+                return
+        sock.close()
+
+    def discard(self, sock):
+        self.remember(sock)
+        sock.close()
+
+    def remember(self, sock):
+        # TLS 1.3 tickets arrive after the handshake, so the session to
+        # resume is only there once the connection has been read from
+        session = sock.session
+        if session is not None:
+            with self.lock:
+                self.session = session
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for sock, _ in idle:
+            sock.close()
+
+
+def send_ack(sock, ack_num, blocks=None, window=None):
+    sock.sendall(encode_ack(ack_num, blocks, window))
+    log_message(f"[CLIENT] Sent ACK {ack_num}{f' SACK {blocks}' if blocks else ''}"
+                f"{f' rwnd={window}' if window is not None else ''}", TRACE)
+
+def receive_ack(sock, sack=False, rwnd=False):
+    return recv_ack(sock, sack, rwnd)
+
+
+def send_with_ack(sock, file_bytes, progress_bar=SILENT, status_text=SILENT, params=None,
+                  start=0, stats=None):
+    """Upload ``file_bytes``, skipping the first ``start`` bytes the server already holds.
+
+    Counters go into ``stats`` (a TransferStats) when the caller wants them.
+    """
+    params = params or TransferParams()
+    stats = stats or TransferStats(CONNECTION.get(), 'out', params.cc)
+    source = PacketSource(file_bytes, params.packet_size, params.peer_max_packet, params.adaptive,
+                          start=start)
+    total_size = source.total_size
+
+    try:
+        sock.sendall(str(total_size).encode().ljust(16))
+        status_text.text(f"Sent file size: {total_size}")
+        if start:
+            log_message(f"[CLIENT] Resuming upload at byte {start}")
+            status_text.text(f"Resuming upload at byte {start:,}")
+        codec = make_codec(params.compression)
+        if codec:
+            reason = source.enable_compression(codec)
+            log_message(f"[CLIENT][COMPRESSION] {codec.name} {'on' if source.stats else 'off'}: "
+                        f"{reason}")
+
+        impairment = Impairment(log=lambda m: log_message(f"[CLIENT][SIMULATION] {m}", DEBUG))
+        # packets and ACKs take the UDP channel if there is one, a datagram each
+        channel = params.channel
+        packets = channel or sock
+        if channel:
+            channel.start()
+            source.batch_bytes = 0
+        base = 0
+        next_seq = 0
+        timer = RetransmitTimer(max_rto=TIMEOUT)
+        scoreboard = Scoreboard()
+        peer_window = PeerWindow()
+        cc = make_congestion_control(params.cc, lambda m: log_message(f"[CLIENT][CC] {m}", DEBUG))
+
+        while not source.finished(base):
+            pace_wait = 0.0
+            while next_seq < base + cc.window() and source.has_packet(next_seq):
+                if not peer_window.allows(source, base, next_seq):
+                    peer_window.blocked(time.time())
+                    break
+                pace_wait = cc.pacing_wait(time.time())
+                if pace_wait:
+                    break
+                seq = next_seq
+                cc.on_send(time.time())
+                for out_seq in impairment.outgoing(seq):
+                    stats.bytes += source.send(packets, out_seq)
+                    stats.packets += 1
+                    log_message(f"[CLIENT] Sent Packet {out_seq}", TRACE)
+                timer.on_send(seq, time.time())
+                next_seq += 1
+            for seq in impairment.flush():
+                stats.bytes += source.send(packets, seq)
+                stats.packets += 1
+                log_message(f"[CLIENT] Sent Packet {seq}", TRACE)
+            if peer_window.probe_due(time.time()) and source.has_packet(next_seq):
+                # the first unacknowledged packet, or the next one if none is out
+                probe = min(base, next_seq)
+                log_message(f"[CLIENT] Window probe with Packet {probe} "
+                            f"(rwnd={peer_window.window})", DEBUG)
+                stats.bytes += source.send(packets, probe)
+                stats.packets += 1
+                timer.on_send(probe, time.time(), retransmit=probe < next_seq)
+                next_seq = max(next_seq, probe + 1)
+
+            expired = [seq for seq in timer.expired(time.time())
+                       if seq >= base and seq not in scoreboard.sacked]
+            if expired:
+                scoreboard.on_timeout()
+                cc.on_timeout()
+                log_message(f"[CLIENT][RTT] Timeout backoff {timer.rtt.describe()}", DEBUG)
+                status_text.text(f"Timeout! Resending from Packet {expired[0]}")
+            for seq in expired:
+                if source.on_loss():
+                    log_message(f"[CLIENT] Packet size shrunk to {source.packet_size}", DEBUG)
+                log_message(f"[CLIENT] Timeout retransmit of Packet {seq}", DEBUG)
+                stats.bytes += source.send(packets, seq)
+                stats.packets += 1
+                stats.timeout_retransmits += 1
+                timer.on_send(seq, time.time(), retransmit=True)
+
+            source.flush(packets)
+            now = time.time()
+            packets.settimeout(min(timer.socket_timeout(now), pace_wait or TIMEOUT,
+                                peer_window.wait(now, TIMEOUT)))
+            try:
+                ack_num, blocks, window = receive_ack(packets, params.sack, params.rwnd)
+            except socket.timeout:
+                continue
+            log_message(f"[CLIENT] Received ACK {ack_num}{f' SACK {blocks}' if blocks else ''}"
+                        f"{f' rwnd={window}' if window is not None else ''}", TRACE)
+            peer_window.update(window)
+
+            if params.sack:
+                scoreboard.update(ack_num, blocks)
+                lost = scoreboard.lost(max(base, ack_num + 1), next_seq)
+                if lost:
+                    cc.on_loss(next_seq)
+                for seq in lost:
+                    if source.on_loss():
+                        log_message(f"[CLIENT] Packet size shrunk to {source.packet_size}", DEBUG)
+                    log_message(f"[CLIENT] SACK retransmit of Packet {seq}", DEBUG)
+                    stats.bytes += source.send(packets, seq)
+                    stats.packets += 1
+                    stats.sack_retransmits += 1
+                    scoreboard.on_retransmit(seq)
+                    timer.on_send(seq, time.time(), retransmit=True)
+
+            if ack_num >= base:
+                newly_acked = ack_num + 1 - base
+                base = ack_num + 1
+                now = time.time()
+                rtt_sample = timer.on_ack(ack_num, now)
+                if rtt_sample is not None:
+                    stats.on_rtt(rtt_sample, timer.rtt.srtt)
+                    log_message(f"[CLIENT][RTT] {timer.rtt.describe()}", TRACE)
+                stats.delivered = source.offset(base) - start
+                source.release(base)
+                if source.on_progress():
+                    log_message(f"[CLIENT] Packet size grown to {source.packet_size}", DEBUG)
+
+                # NewReno partial ACK: the next hole is lost too
+                if cc.on_ack(ack_num, newly_acked, now, rtt_sample) and base < next_seq \
+                        and base not in scoreboard.sacked:
+                    log_message(f"[CLIENT] Partial ACK retransmit of Packet {base}", DEBUG)
+                    stats.bytes += source.send(packets, base)
+                    stats.packets += 1
+                    stats.fast_retransmits += 1
+                    timer.on_send(base, time.time(), retransmit=True)
+                if total_size:
+                    progress_bar.progress(min(source.offset(base) / total_size, 1.0))
+
+            else:
+                stats.dup_acks += 1
+                if not params.sack and cc.on_dupack(ack_num, next_seq):
+                    resend_seq = ack_num + 1
+                    if resend_seq < source.cut_count:
+                        if source.on_loss():
+                            log_message(f"[CLIENT] Packet size shrunk to {source.packet_size}",
+                                        DEBUG)
+                        log_message(f"[CLIENT] Fast retransmit of Packet {resend_seq}", DEBUG)
+                        stats.bytes += source.send(packets, resend_seq)
+                        stats.packets += 1
+                        stats.fast_retransmits += 1
+                        timer.on_send(resend_seq, time.time(), retransmit=True)
+
+        source.flush(packets)
+    finally:
+        source.close()
+    if source.stats:
+        log_message(f"[CLIENT][COMPRESSION] Sent {source.stats.describe()}")
+    if channel:
+        channel.stop()
+    sock.sendall(END_SEQ.to_bytes(4, 'big') + (0).to_bytes(4, 'big'))
+    if params.fin_ack:
+        sock.settimeout(TIMEOUT)
+        drain_acks(sock, params.sack, params.rwnd)
+    else:
+        time.sleep(0.1)
+    status_text.text("Upload complete!")
+    progress_bar.progress(1.0)
+
+    return True
+
+def receive_with_ack(sock, dest_path, progress_bar=SILENT, status_text=SILENT, params=None,
+                     offset=0, byte_range=None):
+    """Download into ``dest_path``, which already holds ``offset`` bytes when resuming.
+
+    A stripe passes its ``(start, end)`` ``byte_range`` and fills in just
+    that part of an existing ``dest_path``.
+    """
+    params = params or TransferParams()
+    filesize = int(recv_exact(sock, 16).decode().strip())
+    # packets and ACKs take the UDP channel if there is one; END still comes over TLS
+    channel = params.channel
+    packets = channel or sock
+    if channel:
+        channel.start(sock)
+
+    with open(dest_path, 'r+b' if byte_range else 'ab' if offset else 'wb') as f:
+        receiver = StreamingReceiver(RangeWriter(f, byte_range[0]) if byte_range else f,
+                                     params.max_packet, codec=make_codec(params.compression))
+        if offset:
+            receiver.preload(dest_path, offset)
+        delayed_ack = DelayedAck()
+
+        def ack():
+            send_ack(packets, receiver.last_in_order,
+                     receiver.sack_blocks() if params.sack else None,
+                     receiver.window() if params.rwnd else None)
+            delayed_ack.sent()
+
+        while True:
+            wait = delayed_ack.wait(time.time())
+            if wait is not None and not wait_readable(packets, wait):
+                ack()
+            seq_num, payload = receiver.read_packet(packets)
+            if seq_num is None:
+                if channel:
+                    channel.stop()
+                if params.fin_ack:
+                    send_ack(sock, ACK_FIN, [] if params.sack else None,
+                             0 if params.rwnd else None)
+                break
+            receiver.accept(seq_num, payload)
+            if delayed_ack.on_packet(time.time(), receiver.ack_urgent(filesize)):
+                ack()
+            if filesize:
+                progress_bar.progress(min(receiver.bytes_written / filesize, 1.0))
+
+    if receiver.bytes_written != filesize:
+        raise ConnectionError(f"Download truncated: {receiver.bytes_written}/{filesize} bytes")
+    if receiver.stats and receiver.stats.packets:
+        log_message(f"[CLIENT][COMPRESSION] Received {receiver.stats.describe()}")
+    status_text.text("Download complete!")
+    return receiver.bytes_written
+
+
+class StripeProgress:
+    """Folds the progress of every stripe into one bar.
+
+    Stripes report from their own threads, but only stripe 0, which runs on
+    the caller's thread, touches the real bar, because Streamlit elements
+    may only be updated from the script thread.
+    """
+
+    def __init__(self, bar, ranges):
+        self.bar = bar
+        self.sizes = [end - start for start, end in ranges]
+        self.total = sum(self.sizes) or 1
+        self.done = [0.0] * len(ranges)
+
+    def stripe(self, index):
+        """Progress bar stand-in for stripe ``index``."""
+        return StripeBar(self, index)
+
+    def update(self, index, value):
+        self.done[index] = value * self.sizes[index]
+        if index == 0:
+            self.bar.progress(min(sum(self.done) / self.total, 1.0))
+
+
+class StripeBar:
+    def __init__(self, progress, index):
+        self.owner = progress
+        self.index = index
+
+    def progress(self, value):
+        self.owner.update(self.index, value)
+
+
+def open_stripe(host, port, stripe_id, index, session=None):
+    """Open the extra connection for stripe ``index`` of a striped transfer."""
+    sock = connect(host, port, session=session)
+    try:
+        sock.sendall(HELLO_MAGIC)
+        send_json(sock, {'stripe': stripe_id, 'index': index})
+        reply = recv_json(sock)
+        if reply['status'] != STATUS_SEND:
+            raise ConnectionError(f"Stripe {index} refused: "
+                                  f"{reply.get('message', reply['status'])}")
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def run_stripes(sock, announce, progress_bar, transfer):
+    """Run a transfer striped as ``announce`` describes (CAP_STRIPE).
+
+    ``transfer(stripe_sock, index, byte_range, bar)`` moves one stripe.
+    Stripe 0 uses ``sock`` on this thread, and each other stripe gets its
+    own connection and thread, so TLS work spreads over several cores.
+    Returns the stripe results in order.
+    """
+    ranges = announce['ranges']
+    host, port = sock.getpeername()[:2]
+    # the extra connections resume this one's TLS session where they can
+    session = sock.session if sock.context is SSL_CONTEXT else None
+    progress = StripeProgress(progress_bar, ranges)
+    log_message(f"[CLIENT] Striping over {len(ranges)} connections", DEBUG)
+    stripe_socks = []
+
+    def run_extra(index):
+        stripe_sock = open_stripe(host, port, announce['stripe_id'], index, session)
+        stripe_socks.append(stripe_sock)
+        try:
+            return transfer(stripe_sock, index, ranges[index], progress.stripe(index))
+        finally:
+            stripe_sock.close()
+
+    with ThreadPoolExecutor(max_workers=len(ranges) - 1) as pool:
+        futures = [pool.submit(run_extra, index) for index in range(1, len(ranges))]
+        try:
+            results = [transfer(sock, 0, ranges[0], progress.stripe(0))]
+            results += [future.result() for future in futures]
+        except BaseException:
+            # unblock stripes still running so the pool can shut down
+            for stripe_sock in stripe_socks:
+                try:
+                    stripe_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            raise
+    progress_bar.progress(1.0)
+    return results
+
+
+def send_striped(sock, file_bytes, announce, progress_bar=SILENT, status_text=SILENT,
+                 params=None, stats=None):
+    """Upload ``file_bytes`` as the striped transfer ``announce`` describes."""
+    params = params or TransferParams()
+    stats = stats or TransferStats(CONNECTION.get(), 'out', params.cc)
+    view = memoryview(file_bytes).cast('B')
+    status_text.text(f"Uploading over {len(announce['ranges'])} connections")
+
+    def transfer(stripe_sock, index, byte_range, bar):
+        stripe_stats = stats if index == 0 else TransferStats(CONNECTION.get(), 'out', params.cc)
+        send_with_ack(stripe_sock, view[byte_range[0]:byte_range[1]], bar, SILENT, params,
+                      stats=stripe_stats)
+        return stripe_stats
+
+    for stripe_stats in run_stripes(sock, announce, progress_bar, transfer)[1:]:
+        stats.absorb(stripe_stats)
+    status_text.text("Upload complete!")
+    return True
+
+
+def receive_striped(sock, dest_path, announce, progress_bar=SILENT, status_text=SILENT,
+                    params=None):
+    """Download the striped transfer ``announce`` describes into ``dest_path``."""
+    with open(dest_path, 'wb') as f:
+        f.truncate(announce['ranges'][-1][1])
+    status_text.text(f"Downloading over {len(announce['ranges'])} connections")
+
+    def transfer(stripe_sock, index, byte_range, bar):
+        return receive_with_ack(stripe_sock, dest_path, bar, SILENT, params,
+                                byte_range=byte_range)
+
+    received = sum(run_stripes(sock, announce, progress_bar, transfer))
+    status_text.text("Download complete!")
+    return received
+
+
+def send_upload(sock, file_bytes, reply, progress_bar=SILENT, status_text=SILENT, params=None,
+                stats=None):
+    """Upload after a send reply: striped if it announced stripes, else resumed at its offset."""
+    if reply.get('ranges'):
+        return send_striped(sock, file_bytes, reply, progress_bar, status_text, params, stats)
+    return send_with_ack(sock, file_bytes, progress_bar, status_text, params,
+                         reply.get('resume_offset', 0), stats)
+
+
+def download_id(digest, output_format):
+    """Transfer ID under which the download of one conversion is kept in DOWNLOADS."""
+    return hashlib.sha256(f"{digest}.{output_format}".encode()).hexdigest()[:32]
+
+
+def resume_hint(transfer_id):
+    """Hello 'download' field for a claimed DOWNLOADS entry, or None if it holds nothing."""
+    etag, offset = DOWNLOADS.held(transfer_id)
+    if not etag or not offset:
+        return None
+    log_message(f"[CLIENT] Holding {offset} bytes of download {transfer_id}")
+    return {'offset': offset, 'etag': etag}
+
+
+def receive_result(sock, dest_path, progress_bar=SILENT, status_text=SILENT, params=None,
+                   transfer_id=None):
+    """Receive the converted file that follows RESULT_OK and its name.
+
+    With CAP_RESUME the server first says where it resumes and which
+    version of the file it sends, and with CAP_STRIPE whether it stripes
+    the file over several connections. ``transfer_id`` is a DOWNLOADS entry the
+    caller has claimed: the bytes collect there, so a dropped connection
+    leaves them for the next attempt, and move to ``dest_path`` once whole.
+    """
+    params = params or TransferParams()
+    if not params.caps & (CAP_RESUME | CAP_STRIPE):
+        return receive_with_ack(sock, dest_path, progress_bar, status_text, params)
+    info = recv_json(sock)
+    if info.get('ranges'):
+        # the server only stripes from byte 0; whatever we held is stale
+        if transfer_id:
+            DOWNLOADS.finish(transfer_id)
+        return receive_striped(sock, dest_path, info, progress_bar, status_text, params)
+    if transfer_id is None or not params.caps & CAP_RESUME:
+        if info['offset']:
+            raise ConnectionError("Server resumed a download we did not ask for")
+        return receive_with_ack(sock, dest_path, progress_bar, status_text, params)
+    part_path = DOWNLOADS.prepare(transfer_id, info['etag'], info['offset'])
+    if info['offset']:
+        log_message(f"[CLIENT] Resuming download at byte {info['offset']}")
+        status_text.text(f"Resuming download at byte {info['offset']:,}")
+    received = receive_with_ack(sock, part_path, progress_bar, status_text, params, info['offset'])
+    os.replace(part_path, dest_path)
+    DOWNLOADS.finish(transfer_id)
+    return received
+
+def offer_datagrams(sock, hello, transport):
+    """Ask in ``hello`` for packets over UDP if ``transport`` says so.
+
+    Returns the client's DatagramChannel, to be settled with
+    ``accept_datagrams`` once the reply is in, or None for TCP.
+    """
+    if transport != 'udp':
+        return None
+    if not HAVE_AESGCM:
+        log_message("[CLIENT] UDP needs the cryptography package, staying on TCP", WARNING)
+        return None
+    channel = DatagramChannel(sock.getsockname()[0],
+                              lambda m: log_message(f"[CLIENT][DATAGRAM] {m}", DEBUG))
+    hello.update(channel.hello())
+    return channel
+
+
+def accept_datagrams(sock, channel, reply, params):
+    """Attach ``channel`` to ``params`` if the server granted it; returns it, or None.
+
+    A server without the datagram transport answers without 'udp', and the
+    job stays on TCP.
+    """
+    if channel is None:
+        return None
+    if not params.caps & CAP_DATAGRAM or 'udp' not in reply:
+        log_message("[CLIENT] Server did not grant UDP, staying on TCP", WARNING)
+        channel.close()
+        return None
+    channel.connect(sock.getpeername()[0], reply['udp'])
+    params.attach(channel)
+    log_message(f"[CLIENT] Packets over UDP, up to {params.packet_size} bytes each")
+    return channel
+
+
+def open_session(sock, cc_name=CONGESTION_CONTROL, transport='tcp'):
+    """Turn a fresh connection into a multi-job session; returns its TransferParams.
+
+    With ``transport`` "udp" every transfer of the session goes over the
+    channel in ``params.channel``, which the caller closes with the session.
+    """
+    hello = {'session': True, 'max_packet': MAX_PACKET_SIZE, 'caps': SUPPORTED_CAPS,
+             'cc': cc_name, 'compression': COMPRESSION_CODECS, 'stripes': STRIPES}
+    channel = offer_datagrams(sock, hello, transport)
+    try:
+        sock.sendall(HELLO_MAGIC)
+        send_json(sock, hello)
+        reply = recv_json(sock)
+        if reply['status'] != STATUS_SESSION:
+            raise ConnectionError(
+                f"Server refused session: {reply.get('message', reply['status'])}")
+    except BaseException:
+        if channel:
+            channel.close()
+        raise
+    log_message("[CLIENT] Session opened")
+    params = TransferParams.negotiate(reply, PACKET_SIZE, MAX_PACKET_SIZE,
+                                      ADAPTIVE_PACKETS, SUPPORTED_CAPS, cc_name,
+                                      COMPRESSION_CODECS, STRIPES)
+    accept_datagrams(sock, channel, reply, params)
+    return params
+
+
+def submit_job(sock, params, job_id, filename, file_bytes, output_format,
+               progress_bar=SILENT, status_text=SILENT, transfer_id=None, stats=None):
+    """Send one file in a session; returns the server's verdict status.
+
+    "queued" means the job was accepted and converts in the background
+    while the session carries on; anything else (busy, error) is final.
+    Reusing ``transfer_id`` after a dropped connection resumes the upload.
+    """
+    sock.sendall(CMD_SUBMIT)
+    request = {
+        'job': job_id,
+        'filename': filename,
+        'output_format': output_format,
+        'size': len(file_bytes),
+        'digest': hashlib.sha256(file_bytes).hexdigest(),
+    }
+    if transfer_id:
+        request['transfer_id'] = transfer_id
+    send_json(sock, request)
+    reply = recv_json(sock)
+    if reply['status'] == STATUS_SEND:
+        send_upload(sock, file_bytes, reply, progress_bar, status_text, params, stats)
+    elif reply['status'] == STATUS_HAVE:
+        status_text.text("Server already has this file, upload skipped")
+        progress_bar.progress(1.0)
+    else:
+        log_message(f"[CLIENT] Job {job_id} turned away: {reply['status']}", WARNING)
+        return reply['status']
+    verdict = recv_json(sock)
+    log_message(f"[CLIENT] Job {job_id} {verdict['status']}")
+    return verdict['status']
+
+
+def fetch_result(sock, params, dest_dir, progress_bar=SILENT, status_text=SILENT, wait=True):
+    """Ask for the next finished job and download it into ``dest_dir``.
+
+    Returns the server's reply; for a "ready" job it gains the local
+    ``path``. Without ``wait`` the reply may be "pending" instead.
+    """
+    sock.sendall(CMD_FETCH)
+    send_json(sock, {'wait': wait})
+    reply = recv_json(sock)
+    if reply['status'] == STATUS_READY:
+        path = os.path.join(dest_dir, os.path.basename(reply['filename']))
+        if reply.get('ranges'):
+            receive_striped(sock, path, reply, progress_bar, status_text, params)
+        else:
+            receive_with_ack(sock, path, progress_bar, status_text, params)
+        reply['path'] = path
+    log_message(f"[CLIENT] Fetch: job {reply.get('job')} {reply['status']}")
+    return reply
+
+
+def close_session(sock):
+    sock.sendall(CMD_BYE)
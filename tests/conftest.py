@@ -0,0 +1,82 @@
+import asyncio
+import os
+import shutil
+import ssl
+import sys
+import threading
+
+import pytest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for path in (REPO_DIR, os.path.join(REPO_DIR, 'backend'), os.path.join(REPO_DIR, 'frontend')):
+    sys.path.insert(0, path)
+
+
+def fake_convert(input_path, output_path, output_format):
+    """Stands in for LibreOffice: the output is the input behind a format tag."""
+    with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+        dst.write(f"{output_format}:".encode())
+        shutil.copyfileobj(src, dst)
+    return True
+
+
+class LoopbackServer:
+    """The real connection handler on a private event loop thread, over TLS on loopback."""
+
+    def __init__(self):
+        import server
+        self.server = server
+        server.LOG.echo = False
+        server.CONVERTER.convert = fake_convert
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        threading.Thread(target=self._run, args=(started,), daemon=True).start()
+        started.wait(10)
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile='cert.pem', keyfile='key.pem')
+        listener = self.loop.run_until_complete(
+            asyncio.start_server(self.server.handle_client, '127.0.0.1', 0, ssl=context))
+        self.port = listener.sockets[0].getsockname()[1]
+        # for CAP_DATAGRAM; a no-op without the cryptography package
+        self.loop.run_until_complete(self.server.start_datagrams('127.0.0.1', 0))
+        started.set()
+        self.loop.run_forever()
+
+    @staticmethod
+    def converted(data, output_format):
+        """What fake_convert makes of ``data``."""
+        return f"{output_format}:".encode() + data
+
+
+@pytest.fixture(scope='session')
+def workdir(tmp_path_factory):
+    """Scratch backend directory to import server and client modules from.
+
+    Both keep uploads, caches and logs relative to the working directory,
+    so a test run never touches the real ones.
+    """
+    backend_dir = tmp_path_factory.mktemp('filefusion') / 'backend'
+    backend_dir.mkdir()
+    for name in ('cert.pem', 'key.pem'):
+        shutil.copy(os.path.join(REPO_DIR, 'backend', name), backend_dir)
+    cwd = os.getcwd()
+    os.chdir(backend_dir)
+    yield backend_dir
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def transport(workdir):
+    import transport
+    transport.LOG.echo = False
+    return transport
+
+
+@pytest.fixture(scope='session')
+def loopback(workdir):
+    server = LoopbackServer()
+    yield server
+    server.loop.call_soon_threadsafe(server.loop.stop)
@@ -0,0 +1,151 @@
+import json
+import os
+
+import pytest
+
+from common.protocol import STATUS_ERROR, STATUS_PENDING, STATUS_QUEUED, STATUS_READY
+
+
+@pytest.fixture
+def batch(transport, monkeypatch):
+    import batch
+    monkeypatch.setattr(batch, 'RETRY_DELAY', 0)
+    return batch
+
+
+class FakeSocket:
+    def close(self):
+        pass
+
+
+class FakeServer:
+    """Stands in for the session calls batch.py makes; every job converts at once.
+
+    The first ``broken_uploads`` submits raise as a dropped connection would.
+    """
+
+    def __init__(self, broken_uploads=0):
+        self.broken_uploads = broken_uploads
+        self.submitted = []
+        self.ready = []
+
+    def install(self, batch, monkeypatch):
+        for name in ('connect', 'open_session', 'submit_job', 'fetch_result', 'close_session'):
+            monkeypatch.setattr(batch, name, getattr(self, name))
+
+    def connect(self, host, port):
+        return FakeSocket()
+
+    def open_session(self, sock, cc_name):
+        return None
+
+    def close_session(self, sock):
+        pass
+
+    def submit_job(self, sock, params, job_id, filename, data, output_format, transfer_id=None):
+        if self.broken_uploads:
+            self.broken_uploads -= 1
+            raise ConnectionResetError("Connection closed mid-message")
+        self.submitted.append(job_id)
+        self.ready.append((job_id, f"{os.path.splitext(filename)[0]}.{output_format}", data))
+        return STATUS_QUEUED
+
+    def fetch_result(self, sock, params, dest_dir, wait=True):
+        if not self.ready:
+            return {'status': STATUS_PENDING}
+        job_id, name, data = self.ready.pop(0)
+        path = os.path.join(dest_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return {'job': job_id, 'status': STATUS_READY, 'path': path}
+
+
+def jobs_for(batch, *names):
+    return [batch.BatchJob(str(i), name, 'pdf', data=name.encode())
+            for i, name in enumerate(names)]
+
+
+def test_all_jobs_convert_and_land_in_the_output_dir(batch, tmp_path, monkeypatch):
+    fake = FakeServer()
+    fake.install(batch, monkeypatch)
+    jobs = jobs_for(batch, 'a.docx', 'sub/b.pptx')
+    summary = batch.BatchRunner(jobs, str(tmp_path), connections=2).run()
+    assert (summary['done'], summary['failed'], summary['pending']) == (2, 0, 0)
+    assert (tmp_path / 'a.pdf').read_bytes() == b'a.docx'
+    assert (tmp_path / 'sub' / 'b.pdf').read_bytes() == b'sub/b.pptx'
+    assert summary['bytes_sent'] == len(b'a.docx') + len(b'sub/b.pptx')
+
+
+def test_a_job_whose_upload_fails_is_retried(batch, tmp_path, monkeypatch):
+    fake = FakeServer(broken_uploads=1)
+    fake.install(batch, monkeypatch)
+    jobs = jobs_for(batch, 'a.docx', 'b.docx')
+    summary = batch.BatchRunner(jobs, str(tmp_path), connections=1).run()
+    assert (summary['done'], summary['failed'], summary['pending']) == (2, 0, 0)
+    assert jobs[0].attempts == 2
+    assert sorted(fake.submitted) == ['0', '1']
+
+
+def test_a_job_whose_upload_keeps_failing_is_counted_as_failed(batch, tmp_path, monkeypatch):
+    fake = FakeServer(broken_uploads=100)
+    fake.install(batch, monkeypatch)
+    jobs = jobs_for(batch, 'a.docx')
+    summary = batch.BatchRunner(jobs, str(tmp_path), connections=1, retries=1).run()
+    assert (summary['done'], summary['failed'], summary['pending']) == (0, 1, 0)
+    assert jobs[0].attempts == 2
+    assert jobs[0].error.startswith("upload failed")
+
+
+def test_jobs_the_server_refuses_are_retried_then_failed(batch, tmp_path, monkeypatch):
+    fake = FakeServer()
+    fake.install(batch, monkeypatch)
+    monkeypatch.setattr(batch, 'submit_job', lambda *args, **kwargs: STATUS_ERROR)
+    jobs = jobs_for(batch, 'a.docx')
+    summary = batch.BatchRunner(jobs, str(tmp_path), connections=1, retries=2).run()
+    assert summary['failed'] == 1
+    assert jobs[0].attempts == 3
+
+
+def test_a_rerun_skips_what_the_manifest_records(batch, tmp_path, monkeypatch):
+    fake = FakeServer()
+    fake.install(batch, monkeypatch)
+    batch.BatchRunner(jobs_for(batch, 'a.docx', 'b.docx'), str(tmp_path)).run()
+    manifest = json.loads((tmp_path / batch.MANIFEST_NAME).read_text())
+    assert sorted(manifest) == ['a.pdf', 'b.pdf']
+
+    (tmp_path / 'b.pdf').unlink()
+    fake.submitted.clear()
+    summary = batch.BatchRunner(jobs_for(batch, 'a.docx', 'b.docx'), str(tmp_path)).run()
+    assert (summary['skipped'], summary['done']) == (1, 1)
+    assert fake.submitted == ['1']
+
+
+def test_clashing_output_names_are_renamed(batch, tmp_path):
+    jobs = [batch.BatchJob('0', 'a.docx', 'pdf', data=b'1'),
+            batch.BatchJob('1', 'a.doc', 'pdf', data=b'2')]
+    batch.BatchRunner(jobs, str(tmp_path))
+    assert [job.output_name for job in jobs] == ['a.pdf', 'a_1.pdf']
+
+
+def test_main_fails_unless_every_file_converted(batch, tmp_path, monkeypatch):
+    source = tmp_path / 'in'
+    source.mkdir()
+    (source / 'a.docx').write_bytes(b'a')
+    (source / 'notes.txt').write_bytes(b'skipped')
+    argv = [str(source), '-o', str(tmp_path / 'out'), '-j', '1', '--retries', '0']
+    FakeServer(broken_uploads=1).install(batch, monkeypatch)
+    assert batch.main(argv) == 1
+    FakeServer().install(batch, monkeypatch)
+    assert batch.main(argv) == 0
+    assert (tmp_path / 'out' / 'a.pdf').read_bytes() == b'a'
+
+
+def test_batch_against_the_server(batch, loopback, tmp_path):
+    jobs = [batch.BatchJob(str(i), f"doc{i}.docx", 'pdf', data=os.urandom(100_000))
+            for i in range(5)]
+    runner = batch.BatchRunner(jobs, str(tmp_path), connections=2, host='127.0.0.1',
+                               port=loopback.port)
+    summary = runner.run()
+    assert (summary['done'], summary['failed'], summary['pending']) == (5, 0, 0)
+    for job in jobs:
+        assert (tmp_path / job.output_name).read_bytes() == loopback.converted(job.data, 'pdf')
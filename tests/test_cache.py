@@ -0,0 +1,127 @@
+import os
+import threading
+
+from cache import ConversionCache
+
+DIGEST = 'a' * 64
+OTHER = 'b' * 64
+
+
+def writer(data, calls=None):
+    def produce(tmp_path):
+        if calls is not None:
+            calls.append(tmp_path)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        return True
+    return produce
+
+
+def test_second_lookup_is_a_hit(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+    calls = []
+    path, hit = cache.get_or_create(DIGEST, 'pdf', writer(b'converted', calls))
+    assert not hit
+    assert path == os.path.join(str(tmp_path), f"{DIGEST}.pdf")
+    with open(path, 'rb') as f:
+        assert f.read() == b'converted'
+    assert cache.get_or_create(DIGEST, 'pdf', writer(b'again', calls)) == (path, True)
+    assert cache.acquire(DIGEST, 'pdf') == path
+    assert cache.acquire(DIGEST, 'docx') is None
+    assert len(calls) == 1
+    assert cache.stats() == {'entries': 1, 'bytes': 9, 'hits': 2, 'misses': 1}
+
+
+def test_failed_produce_leaves_nothing_behind(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+
+    def fail(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(b'half')
+        return False
+
+    assert cache.get_or_create(DIGEST, 'pdf', fail) == (None, False)
+    assert os.listdir(str(tmp_path)) == []
+    assert cache.stats()['entries'] == 0
+    # the next caller tries again
+    assert cache.get_or_create(DIGEST, 'pdf', writer(b'ok'))[0] is not None
+
+
+def concurrent_callers(cache, produce, count=4):
+    """Run ``count`` get_or_create calls at once, the first inside ``produce``."""
+    entered = threading.Event()
+    release = threading.Event()
+    results = [None] * count
+
+    def blocking(tmp_path):
+        entered.set()
+        release.wait(5)
+        return produce(tmp_path)
+
+    def call(index):
+        results[index] = cache.get_or_create(DIGEST, 'pdf', blocking)
+
+    threads = [threading.Thread(target=call, args=(0,))]
+    threads[0].start()
+    entered.wait(5)
+    threads += [threading.Thread(target=call, args=(i,)) for i in range(1, count)]
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_callers_share_one_produce(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+    calls = []
+    results = concurrent_callers(cache, writer(b'x', calls))
+    assert len(calls) == 1
+    assert results[0] == (results[0][0], False)
+    assert {path for path, _ in results} == {results[0][0]}
+    assert cache.stats()['misses'] == 1
+
+
+def test_concurrent_callers_share_a_failure(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+    calls = []
+
+    def fail(tmp_path):
+        calls.append(tmp_path)
+        return False
+
+    assert concurrent_callers(cache, fail) == [(None, False)] * 4
+    assert len(calls) == 1
+    assert cache.inflight == {}
+
+
+def test_eviction_spares_pinned_entries(tmp_path):
+    cache = ConversionCache(str(tmp_path), max_bytes=15)
+    first, _ = cache.get_or_create(DIGEST, 'pdf', writer(b'x' * 10))
+    second, _ = cache.get_or_create(OTHER, 'pdf', writer(b'y' * 10))
+    # both pinned, so over budget for now
+    assert cache.stats()['entries'] == 2
+    cache.release(first)
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+    assert cache.stats() == {'entries': 1, 'bytes': 10, 'hits': 0, 'misses': 2}
+
+
+def test_expired_entries_are_dropped(tmp_path):
+    cache = ConversionCache(str(tmp_path), max_age=-1)
+    path, _ = cache.get_or_create(DIGEST, 'pdf', writer(b'x'))
+    cache.release(path)
+    assert not os.path.exists(path)
+    assert cache.acquire(DIGEST, 'pdf') is None
+
+
+def test_index_is_rebuilt_from_disk(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+    path, _ = cache.get_or_create(DIGEST, 'pdf', writer(b'kept'))
+    (tmp_path / f".{DIGEST}.pdf.0.tmp").write_bytes(b'crashed mid-produce')
+    (tmp_path / 'unrelated.txt').write_bytes(b'?')
+    reopened = ConversionCache(str(tmp_path))
+    assert reopened.acquire(DIGEST, 'pdf') == path
+    assert reopened.stats()['bytes'] == 4
+    assert not (tmp_path / f".{DIGEST}.pdf.0.tmp").exists()
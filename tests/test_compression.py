@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from common.compression import (CODECS, PREFERENCE, CompressionStats, entropy, make_codec,
+                                offered_codecs, probe)
+from common.transfer import PacketSource
+
+TEXT = b'FileFusion converts documents. ' * 2000
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_codecs_round_trip(name):
+    codec = make_codec(name)
+    packed = codec.compress(TEXT[:65536])
+    assert len(packed) < 65536
+    assert codec.decompress(packed, 65536) == TEXT[:65536]
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_codecs_refuse_packets_that_inflate_past_the_limit(name):
+    codec = make_codec(name)
+    with pytest.raises(ValueError):
+        codec.decompress(codec.compress(b'\0' * 65536), 4096)
+
+
+def test_offered_codecs():
+    assert offered_codecs('off') == []
+    assert offered_codecs('auto') == [name for name in PREFERENCE if name in CODECS]
+    assert offered_codecs('nope, zlib') == ['zlib']
+    assert make_codec('nope') is None
+
+
+def test_probe_skips_zip_containers_and_random_data():
+    assert probe(memoryview(b'PK\x03\x04' + TEXT))[0] is False
+    assert probe(memoryview(os.urandom(100_000)))[0] is False
+    assert probe(memoryview(TEXT))[0] is True
+    assert entropy(b'') == 0.0
+    assert entropy(b'ab' * 100) == pytest.approx(1.0)
+
+
+def test_stats_send_incompressible_packets_as_they_are():
+    stats = CompressionStats(make_codec('zlib'))
+    assert stats.compress(os.urandom(4096)) is None
+    assert stats.compress(TEXT[:4096]) is not None
+    assert (stats.packets, stats.stored, stats.raw_bytes) == (2, 1, 8192)
+    assert stats.wire_bytes < 8192
+
+
+def test_source_compresses_only_what_the_probe_allows():
+    codec = make_codec('zlib')
+    source = PacketSource(TEXT, 4096)
+    source.enable_compression(codec)
+    assert source.stats is not None
+    source = PacketSource(os.urandom(100_000), 4096)
+    assert source.enable_compression(codec).startswith("entropy")
+    assert source.stats is None
@@ -0,0 +1,153 @@
+import pytest
+
+from common.congestion import (CONGESTION_AVOIDANCE, CONGESTION_CONTROLS, FAST_RECOVERY,
+                               SLOW_START, BBRLite, Cubic, NewReno, Reno,
+                               make_congestion_control)
+
+
+def in_avoidance(cls, cwnd):
+    cc = cls()
+    cc.cwnd = float(cwnd)
+    cc.state = CONGESTION_AVOIDANCE
+    return cc
+
+
+def test_slow_start_grows_per_ack_up_to_the_abc_limit():
+    cc = Reno()
+    assert cc.window() == 1
+    cc.on_ack(0, 1, 0.0)
+    assert cc.cwnd == 2
+    cc.on_ack(5, 5, 0.0)
+    assert cc.cwnd == 4
+
+
+def test_slow_start_hands_over_at_ssthresh():
+    cc = Reno(ssthresh=4)
+    while cc.state == SLOW_START:
+        cc.on_ack(0, 1, 0.0)
+    assert cc.state == CONGESTION_AVOIDANCE
+    assert cc.cwnd == 4
+    cc.on_ack(1, 1, 0.0)
+    assert cc.cwnd == pytest.approx(4.25)
+
+
+def test_third_dupack_enters_fast_recovery():
+    cc = in_avoidance(Reno, 10)
+    assert not cc.on_dupack(4, 20)
+    assert not cc.on_dupack(4, 20)
+    assert cc.on_dupack(4, 20)
+    assert cc.state == FAST_RECOVERY
+    assert cc.ssthresh == 5
+    assert cc.cwnd == 8
+    assert cc.recover_point == 19
+    # further dupacks do not reduce again
+    for _ in range(5):
+        assert not cc.on_dupack(4, 20)
+    assert cc.ssthresh == 5
+
+
+def test_recovery_ends_once_the_recover_point_is_acked():
+    cc = in_avoidance(Reno, 10)
+    cc.on_loss(20)
+    assert not cc.on_ack(10, 1, 0.0)
+    assert cc.state == FAST_RECOVERY
+    cc.on_ack(19, 1, 0.0)
+    assert cc.state == CONGESTION_AVOIDANCE
+    assert cc.cwnd == pytest.approx(5 + 1 / 5)
+
+
+def test_loss_reduces_at_most_once_per_window():
+    cc = in_avoidance(Reno, 10)
+    cc.on_loss(20)
+    cc.on_loss(21)
+    assert cc.ssthresh == 5
+
+
+def test_timeout_falls_back_to_slow_start():
+    cc = in_avoidance(Reno, 10)
+    cc.on_timeout()
+    assert cc.state == SLOW_START
+    assert cc.ssthresh == 5
+    assert cc.cwnd == 5
+
+
+def test_ssthresh_never_drops_below_two():
+    cc = in_avoidance(Reno, 2)
+    cc.on_timeout()
+    assert cc.ssthresh == 2
+
+
+def test_newreno_resends_on_a_partial_ack():
+    cc = in_avoidance(NewReno, 10)
+    cc.on_loss(20)
+    assert cc.on_ack(12, 2, 0.0)
+    assert cc.state == FAST_RECOVERY
+    assert cc.cwnd == 7
+    assert not cc.on_ack(19, 1, 0.0)
+    assert cc.state == CONGESTION_AVOIDANCE
+
+
+def test_cubic_reduces_by_beta_and_remembers_the_peak():
+    cc = in_avoidance(Cubic, 10)
+    cc.on_timeout()
+    assert cc.w_max == 10
+    assert cc.cwnd == pytest.approx(7)
+
+
+def test_cubic_fast_convergence_lowers_a_peak_it_did_not_reach():
+    cc = in_avoidance(Cubic, 10)
+    cc.on_timeout()
+    cc.state = CONGESTION_AVOIDANCE
+    cc.on_timeout()
+    assert cc.w_max == pytest.approx(7 * 1.7 / 2)
+
+
+def test_cubic_climbs_back_to_the_peak_without_overshooting_it():
+    cc = in_avoidance(Cubic, 10)
+    cc.on_timeout()
+    cc.state = CONGESTION_AVOIDANCE
+    cc.grow(0.0, None)
+    assert cc.k == pytest.approx((3 / Cubic.C) ** (1 / 3))
+    for _ in range(1000):
+        cc.grow(cc.k, None)
+    assert 9.9 < cc.cwnd <= 10
+
+
+def test_bbr_losses_do_not_shrink_the_window():
+    cc = BBRLite()
+    cwnd = cc.cwnd
+    assert cc.on_dupack(0, 10) is False
+    cc.on_dupack(0, 10)
+    assert cc.on_dupack(0, 10)
+    assert cc.state == FAST_RECOVERY
+    assert cc.cwnd == cwnd
+    assert cc.on_ack(5, 1, 0.0)
+    cc.on_timeout()
+    assert cc.cwnd == 4
+    assert cc.state == "ProbeBW"
+
+
+def test_bbr_sizes_the_window_from_bandwidth_and_min_rtt():
+    cc = BBRLite()
+    now = 0.0
+    for ack in range(200):
+        now += 0.001
+        cc.on_ack(ack, 1, now, rtt=0.01)
+    # one packet per ms at 10 ms min RTT is a BDP of about 10 packets
+    assert cc.min_rtt == pytest.approx(0.01)
+    assert cc.btl_bw == pytest.approx(1000, rel=0.2)
+    assert cc.cwnd >= BBRLite.CWND_GAIN * 10 * 0.8
+    assert cc.pacing_delay() > 0
+
+
+def test_changes_are_logged():
+    lines = []
+    cc = Reno(log=lines.append)
+    cc.on_timeout()
+    assert lines[-1].startswith("TIMEOUT: cwnd=")
+
+
+def test_unknown_names_fall_back_to_the_default():
+    assert isinstance(make_congestion_control('nope'), Reno)
+    for name, cls in CONGESTION_CONTROLS.items():
+        assert type(make_congestion_control(name)) is cls
@@ -0,0 +1,173 @@
+import socket
+import threading
+
+import pytest
+
+from common.datagram import (CLIENT_ROLE, HAVE_AESGCM, OVERHEAD, REPLAY_WINDOW, SERVER_ROLE,
+                             DatagramChannel, max_payload, new_channel)
+from common.protocol import END_SEQ
+
+pytestmark = pytest.mark.skipif(not HAVE_AESGCM, reason="needs the cryptography package")
+
+if HAVE_AESGCM:
+    from common.datagram import DatagramCipher
+
+
+@pytest.fixture
+def ciphers():
+    channel_id, key = new_channel()
+    return (DatagramCipher(key, channel_id, CLIENT_ROLE),
+            DatagramCipher(key, channel_id, SERVER_ROLE))
+
+
+def test_sealed_datagrams_open_on_the_other_end(ciphers):
+    client, server = ciphers
+    datagram = client.seal(b'packet')
+    assert len(datagram) == len(b'packet') + OVERHEAD
+    assert server.open(datagram) == (0, b'packet')
+    assert client.open(server.seal(b'ack')) == (0, b'ack')
+
+
+def test_datagrams_carry_the_epoch(ciphers):
+    client, server = ciphers
+    client.epoch = 3
+    assert server.open(client.seal(b'x')) == (3, b'x')
+
+
+def test_own_datagrams_do_not_open(ciphers):
+    client, _ = ciphers
+    assert client.open(client.seal(b'x')) is None
+
+
+def test_replays_are_dropped(ciphers):
+    client, server = ciphers
+    datagram = client.seal(b'once')
+    assert server.open(datagram) is not None
+    assert server.open(datagram) is None
+
+
+def test_reordering_inside_the_window_is_fine(ciphers):
+    client, server = ciphers
+    first, second, third = (client.seal(bytes([i])) for i in range(3))
+    assert server.open(third) == (0, b'\x02')
+    assert server.open(first) == (0, b'\x00')
+    assert server.open(second) == (0, b'\x01')
+    assert server.open(first) is None
+
+
+def test_datagrams_older_than_the_window_are_dropped(ciphers):
+    client, server = ciphers
+    datagrams = [client.seal(b'x') for _ in range(REPLAY_WINDOW + 1)]
+    assert server.open(datagrams[-1]) is not None
+    assert server.open(datagrams[0]) is None
+    assert server.open(datagrams[1]) is not None
+
+
+@pytest.mark.parametrize('index', [-1, 10, 25])
+def test_tampering_is_detected(ciphers, index):
+    # the last byte is in the tag, 10 in the epoch, 25 in the ciphertext
+    client, server = ciphers
+    datagram = bytearray(client.seal(b'some payload'))
+    datagram[index] ^= 1
+    assert server.open(bytes(datagram)) is None
+
+
+def test_foreign_and_short_datagrams_are_dropped(ciphers):
+    client, server = ciphers
+    other_id, key = new_channel()
+    stranger = DatagramCipher(key, other_id, CLIENT_ROLE)
+    assert server.open(stranger.seal(b'x')) is None
+    assert server.open(client.seal(b'x')[:OVERHEAD - 1]) is None
+
+
+def test_max_payload_leaves_room_for_the_headers():
+    assert max_payload(1472) == 1472 - OVERHEAD - 8
+
+
+class Peer:
+    """Server side of a channel: a bare UDP socket and the server's cipher."""
+
+    def __init__(self, channel):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(5)
+        channel_id, key = new_channel()
+        self.cipher = DatagramCipher(key, channel_id, SERVER_ROLE)
+        channel.connect('127.0.0.1', {'port': self.sock.getsockname()[1],
+                                      'channel': channel_id.hex(), 'key': key.hex()})
+        self.address = ('127.0.0.1', channel.port)
+
+    def send(self, payload, epoch):
+        self.cipher.epoch = epoch
+        self.sock.sendto(self.cipher.seal(payload), self.address)
+
+    def receive(self):
+        return self.cipher.open(self.sock.recv(65535))
+
+
+@pytest.fixture
+def channel():
+    channel = DatagramChannel('127.0.0.1')
+    peer = Peer(channel)
+    yield channel, peer
+    channel.close()
+    peer.sock.close()
+
+
+def test_channel_round_trip(channel):
+    channel, peer = channel
+    channel.start()
+    channel.sendall(b'packet')
+    assert peer.receive() == (1, b'packet')
+    peer.send(b'ack', 1)
+    channel.settimeout(5)
+    assert channel.recv(3) == b'ack'
+
+
+def test_channel_skips_datagrams_from_an_earlier_transfer(channel):
+    channel, peer = channel
+    channel.start()
+    channel.start()
+    peer.send(b'late', 1)
+    peer.send(b'current', 2)
+    channel.settimeout(5)
+    assert channel.recv(100) == b'current'
+
+
+def test_channel_reads_end_from_the_control_socket(channel):
+    channel, _ = channel
+    control, other = socket.socketpair()
+    try:
+        channel.start(control)
+        end = END_SEQ.to_bytes(4, 'big') + (0).to_bytes(4, 'big')
+        other.sendall(end)
+        channel.settimeout(5)
+        assert channel.recv(8) == end
+    finally:
+        control.close()
+        other.close()
+
+
+def test_channel_timeout_applies_within_a_transfer(channel):
+    channel, _ = channel
+    channel.start()
+    channel.settimeout(0.05)
+    with pytest.raises(socket.timeout):
+        channel.recv(1)
+
+
+def test_next_transfer_does_not_inherit_the_senders_timeout(channel):
+    channel, peer = channel
+    # an upload leaves its ACK timeout set...
+    channel.start()
+    channel.settimeout(0.05)
+    channel.stop()
+    # ...and the download that follows must wait for its first packet
+    channel.start()
+    assert channel.timeout is None
+    sender = threading.Timer(0.2, peer.send, (b'packet', 2))
+    sender.start()
+    try:
+        assert channel.recv(6) == b'packet'
+    finally:
+        sender.cancel()
@@ -0,0 +1,95 @@
+import asyncio
+import json
+
+import pytest
+
+from metrics import Counter, Histogram, ServerMetrics, handle_metrics_request
+
+
+def test_counters_render_with_escaped_labels():
+    counter = Counter('filefusion_test_total', "Test counter.")
+    counter.inc(kind='a')
+    counter.inc(2, kind='a')
+    counter.set(7, kind='say "hi"\\\n')
+    assert {labels['kind']: value for _, labels, value in counter.samples()} == {
+        'a': 3, 'say "hi"\\\n': 7}
+
+    metrics = ServerMetrics()
+    metrics.metrics = [counter]
+    text = metrics.prometheus()
+    assert "# HELP filefusion_test_total Test counter.\n" in text
+    assert "# TYPE filefusion_test_total counter\n" in text
+    assert 'filefusion_test_total{kind="a"} 3\n' in text
+    assert 'filefusion_test_total{kind="say \\"hi\\"\\\\\\n"} 7\n' in text
+
+
+def test_histograms_are_cumulative():
+    histogram = Histogram('filefusion_test_seconds', "Test histogram.", (0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 5.0):
+        histogram.observe(value)
+    samples = {(name, labels.get('le')): value for name, labels, value in histogram.samples()}
+    assert samples[('filefusion_test_seconds_bucket', '0.1')] == 1
+    assert samples[('filefusion_test_seconds_bucket', '1.0')] == 3
+    assert samples[('filefusion_test_seconds_bucket', '+Inf')] == 4
+    assert samples[('filefusion_test_seconds_count', None)] == 4
+    assert samples[('filefusion_test_seconds_sum', None)] == pytest.approx(6.25)
+
+
+def test_finished_transfers_fold_into_the_totals():
+    metrics = ServerMetrics()
+    stats = metrics.begin('127.0.0.1:1', 'out', 'reno')
+    assert metrics.snapshot()['transfers'][0]['conn'] == '127.0.0.1:1'
+    stats.bytes, stats.delivered, stats.packets = 3000, 2000, 3
+    stats.fast_retransmits = 1
+    stats.on_rtt(0.02, 0.02)
+    metrics.finish(stats, ok=True)
+
+    assert metrics.active == set()
+    assert metrics.bytes.values == {(('direction', 'out'),): 3000}
+    assert metrics.retransmits.values == {(('kind', 'fast'),): 1}
+    assert metrics.transfers.values == {(('direction', 'out'), ('outcome', 'ok')): 1}
+    recent = metrics.snapshot()['recent']
+    assert [(r['direction'], r['outcome'], r['delivered']) for r in recent] == [
+        ('out', 'ok', 2000)]
+    assert 'filefusion_rtt_seconds_count{cc="reno"} 1' in metrics.prometheus()
+
+
+def test_collectors_run_at_scrape_time():
+    metrics = ServerMetrics()
+    queued = [4]
+    metrics.collectors.append(lambda m: m.conversions_queued.set(queued[0]))
+    assert 'filefusion_conversions_queued 4\n' in metrics.prometheus()
+    queued[0] = 1
+    assert metrics.snapshot()['counters']['filefusion_conversions_queued'] == [
+        {'labels': {}, 'value': 1}]
+
+
+def test_metrics_over_http():
+    async def get(port, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        return head.split(b'\r\n')[0].decode(), body.decode()
+
+    async def main():
+        metrics = ServerMetrics()
+        metrics.connections.inc()
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_metrics_request(metrics, reader, writer),
+            '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            status, body = await get(port, '/metrics')
+            assert status == 'HTTP/1.1 200 OK'
+            assert 'filefusion_connections_total 1\n' in body
+            status, body = await get(port, '/metrics.json?pretty')
+            assert json.loads(body)['counters']['filefusion_connections_total'][0]['value'] == 1
+            status, _ = await get(port, '/nope')
+            assert status == 'HTTP/1.1 404 Not Found'
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(main())
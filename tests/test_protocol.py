@@ -0,0 +1,111 @@
+import socket
+
+import pytest
+
+from common.protocol import (ACK_FIN, ACK_NONE, CAP_QUEUE_STATUS, CAP_RWND, CAP_SACK,
+                             CAP_STRIPE, LEGACY_PACKET_SIZE, MAX_PACKET_SIZE, TransferParams,
+                             drain_acks, encode_ack, recv_ack)
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+@pytest.mark.parametrize('blocks', [None, [], [(5, 7), (9, 9)]])
+@pytest.mark.parametrize('window', [None, 0, 65536])
+def test_acks_round_trip(pair, blocks, window):
+    a, b = pair
+    a.sendall(encode_ack(3, blocks, window))
+    ack = recv_ack(b, sack=blocks is not None, rwnd=window is not None)
+    assert ack == (3, blocks or [], window)
+
+
+def test_ack_window_saturates():
+    assert encode_ack(0, window=1 << 40)[4:] == b'\xff\xff\xff\xff'
+
+
+def test_ack_none_reads_as_minus_one(pair):
+    a, b = pair
+    a.sendall(encode_ack(-1))
+    assert recv_ack(b) == (-1, [], None)
+    assert encode_ack(-1) == ACK_NONE.to_bytes(4, 'big')
+
+
+def test_drain_stops_at_fin(pair):
+    a, b = pair
+    a.sendall(encode_ack(1) + encode_ack(ACK_FIN) + encode_ack(7))
+    drain_acks(b)
+    assert recv_ack(b)[0] == 7
+    a.sendall(encode_ack(1, [], 10) + encode_ack(ACK_FIN, [], 0) + encode_ack(7, [], 10))
+    drain_acks(b, sack=True, rwnd=True)
+    assert recv_ack(b, sack=True, rwnd=True) == (7, [], 10)
+
+
+def test_negotiate_sends_with_the_smaller_packet_size():
+    params = TransferParams.negotiate({'max_packet': 8192}, 65536, 32768)
+    assert params.packet_size == 8192
+    assert params.peer_max_packet == 8192
+    assert params.max_packet == 32768
+    assert params.fin_ack
+
+
+def test_negotiate_keeps_only_capabilities_both_sides_set():
+    params = TransferParams.negotiate({'caps': CAP_SACK | CAP_QUEUE_STATUS}, 65536, 65536,
+                                      caps=CAP_SACK)
+    assert params.caps == CAP_SACK
+    assert params.sack
+    assert not params.rwnd
+    assert not TransferParams.negotiate({'caps': CAP_SACK}, 65536, 65536).sack
+    assert TransferParams.negotiate({'caps': CAP_RWND}, 65536, 65536, caps=CAP_RWND).rwnd
+
+
+def test_negotiate_picks_our_first_codec_the_peer_named():
+    hello = {'compression': ['zstd', 'zlib']}
+    params = TransferParams.negotiate(hello, 65536, 65536, codecs=('lz4', 'zlib'))
+    assert params.compression == 'zlib'
+    # the server answers with its single pick
+    assert TransferParams.negotiate({'compression': 'zlib'}, 65536, 65536,
+                                    codecs=('zlib',)).compression == 'zlib'
+    assert TransferParams.negotiate(hello, 65536, 65536, codecs=()).compression is None
+
+
+def test_negotiate_stripes_over_the_fewer_connections():
+    hello = {'caps': CAP_STRIPE, 'stripes': 2}
+    assert TransferParams.negotiate(hello, 65536, 65536, caps=CAP_STRIPE, stripes=4).stripes == 2
+    assert TransferParams.negotiate(hello, 65536, 65536, caps=CAP_STRIPE, stripes=1).stripes == 1
+    # without the capability there is one connection, whatever was asked for
+    assert TransferParams.negotiate(hello, 65536, 65536, stripes=4).stripes == 1
+
+
+def test_negotiate_with_a_v1_peer_falls_back_to_defaults():
+    params = TransferParams.negotiate({}, 65536, 65536, codecs=('zlib',))
+    assert params.packet_size == LEGACY_PACKET_SIZE
+    assert params.caps == 0
+    assert params.compression is None
+    assert params.stripes == 1
+
+
+def test_negotiate_caps_the_peer_packet_size():
+    params = TransferParams.negotiate({'max_packet': 1 << 30}, 1 << 30, 1 << 30)
+    assert params.peer_max_packet == MAX_PACKET_SIZE
+
+
+def test_v1_connections_keep_the_fixed_defaults():
+    params = TransferParams()
+    assert params.packet_size == params.max_packet == LEGACY_PACKET_SIZE
+    assert not params.fin_ack
+
+
+def test_attach_fits_packets_into_one_datagram():
+    class Channel:
+        max_payload = 1400
+
+    params = TransferParams(65536, 65536, 65536, caps=CAP_STRIPE, stripes=4)
+    params.attach(Channel())
+    assert params.packet_size == 1400
+    assert params.peer_max_packet == 1400
+    assert params.stripes == 1
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from common.resume import PartialStore, valid_transfer_id
+
+TRANSFER_ID = 'ab' * 16
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PartialStore(str(tmp_path / 'partial'))
+
+
+def test_transfer_ids_are_32_hex_digits():
+    assert valid_transfer_id(TRANSFER_ID)
+    assert not valid_transfer_id('AB' * 16)
+    assert not valid_transfer_id('../' + 'a' * 29)
+    assert not valid_transfer_id(None)
+
+
+def test_a_released_transfer_resumes_from_what_reached_the_disk(store):
+    path, offset = store.open(TRANSFER_ID, 'tag')
+    assert offset == 0
+    with open(path, 'ab') as f:
+        f.write(b'x' * 100)
+    store.release(TRANSFER_ID)
+    assert store.open(TRANSFER_ID, 'tag') == (path, 100)
+
+
+def test_a_different_tag_starts_over(store):
+    path, _ = store.open(TRANSFER_ID, 'old')
+    with open(path, 'ab') as f:
+        f.write(b'x' * 100)
+    store.release(TRANSFER_ID)
+    assert store.open(TRANSFER_ID, 'new') == (path, 0)
+    assert os.path.getsize(path) == 0
+
+
+def test_one_connection_at_a_time(store):
+    assert store.open(TRANSFER_ID, 'tag') is not None
+    assert store.open(TRANSFER_ID, 'tag') is None
+    store.release(TRANSFER_ID)
+    assert store.open(TRANSFER_ID, 'tag') is not None
+
+
+def test_finish_forgets_the_transfer(store):
+    path, _ = store.open(TRANSFER_ID, 'tag')
+    store.finish(TRANSFER_ID)
+    assert not os.path.exists(path)
+    assert store.held(TRANSFER_ID) == (None, 0)
+
+
+def test_stale_entries_expire(store):
+    path, _ = store.open(TRANSFER_ID, 'tag')
+    with open(path, 'ab') as f:
+        f.write(b'x' * 100)
+    store.release(TRANSFER_ID)
+    assert store.held(TRANSFER_ID) == ('tag', 100)
+    store.ttl = -1
+    store.expire()
+    assert not os.path.exists(path)
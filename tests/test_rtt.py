@@ -0,0 +1,106 @@
+import pytest
+
+from common.rtt import RetransmitTimer, RttEstimator, TimerWheel
+
+
+def test_first_sample_sets_srtt_and_half_rttvar():
+    rtt = RttEstimator()
+    rtt.sample(0.1)
+    assert rtt.srtt == pytest.approx(0.1)
+    assert rtt.rttvar == pytest.approx(0.05)
+    # RTO = SRTT + 4 * RTTVAR
+    assert rtt.rto == pytest.approx(0.3)
+
+
+def test_later_samples_follow_rfc_6298():
+    rtt = RttEstimator()
+    rtt.sample(0.1)
+    rtt.sample(0.3)
+    # RTTVAR updated with the old SRTT before SRTT moves
+    assert rtt.rttvar == pytest.approx(0.75 * 0.05 + 0.25 * 0.2)
+    assert rtt.srtt == pytest.approx(0.875 * 0.1 + 0.125 * 0.3)
+    assert rtt.rto == pytest.approx(rtt.srtt + 4 * rtt.rttvar)
+
+
+def test_rto_is_clamped():
+    rtt = RttEstimator(min_rto=0.2, max_rto=1.0)
+    rtt.sample(0.001)
+    assert rtt.rto == pytest.approx(0.2)
+    for _ in range(10):
+        rtt.backoff()
+    assert rtt.rto == pytest.approx(1.0)
+
+
+def test_backoff_doubles_and_a_sample_resets_it():
+    rtt = RttEstimator()
+    rtt.sample(0.1)
+    rtt.backoff()
+    rtt.backoff()
+    assert rtt.rto == pytest.approx(1.2)
+    assert rtt.backoffs == 2
+    rtt.sample(0.1)
+    assert rtt.backoffs == 0
+    assert rtt.rto < 1.2
+
+
+def test_wheel_pops_only_expired_deadlines():
+    wheel = TimerWheel()
+    wheel.schedule(1, 0.012)
+    wheel.schedule(2, 0.030)
+    assert wheel.expired(0.005) == []
+    assert wheel.expired(0.02) == [1]
+    assert wheel.next_deadline(0.02) == pytest.approx(0.030)
+    wheel.cancel(2)
+    assert wheel.expired(1.0) == []
+    assert len(wheel) == 0
+
+
+def test_wheel_cancel_below_drops_acked_packets():
+    wheel = TimerWheel()
+    for seq_num in range(5):
+        wheel.schedule(seq_num, 0.1)
+    wheel.cancel_below(3)
+    assert wheel.expired(0.2) == [3, 4]
+
+
+def test_wheel_keeps_deadlines_beyond_one_revolution():
+    wheel = TimerWheel(tick=0.005, slots=1024)
+    wheel.schedule(3, 100.0)
+    assert wheel.next_deadline(0.0) == pytest.approx(100.0)
+    assert wheel.expired(99.0) == []
+    assert wheel.expired(100.0) == [3]
+
+
+def test_wheel_sweeps_after_sleeping_through_a_revolution():
+    wheel = TimerWheel(tick=0.005, slots=16)
+    wheel.schedule(1, 0.01)
+    wheel.schedule(2, 50.0)
+    assert wheel.expired(10.0) == [1]
+    assert wheel.expired(50.0) == [2]
+
+
+def test_timer_applies_karns_rule():
+    timer = RetransmitTimer()
+    timer.on_send(0, 0.0)
+    assert timer.on_ack(0, 0.05) == pytest.approx(0.05)
+    timer.on_send(1, 1.0)
+    timer.on_send(1, 1.5, retransmit=True)
+    assert timer.on_ack(1, 1.6) is None
+
+
+def test_timer_expiry_backs_off_once():
+    timer = RetransmitTimer()
+    timer.on_send(0, 0.0)
+    timer.on_send(1, 0.0)
+    rto = timer.rtt.rto
+    assert timer.expired(rto / 2) == []
+    assert timer.expired(rto + 0.01) == [0, 1]
+    assert timer.rtt.rto == pytest.approx(2 * rto)
+
+
+def test_socket_timeout_never_reaches_zero():
+    timer = RetransmitTimer()
+    assert timer.socket_timeout(0.0) == timer.rtt.rto
+    timer.on_send(0, 0.0)
+    assert timer.socket_timeout(0.5) == pytest.approx(timer.rtt.rto - 0.5)
+    assert timer.socket_timeout(100.0) == pytest.approx(0.001)
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+
+import pytest
+
+from scheduler import DEFAULT_SECONDS_PER_MB, MIN_ESTIMATE, ConversionScheduler, QueueFull
+
+MB = 1 << 20
+
+
+def blocked(result='done'):
+    """A job function that runs until its gate opens; returns ``(gate, fn)``."""
+    gate = threading.Event()
+
+    def fn():
+        gate.wait(5)
+        return result
+    return gate, fn
+
+
+def test_runs_at_most_concurrency_jobs_at_once():
+    async def main():
+        scheduler = ConversionScheduler(2)
+        gates, jobs = [], []
+        for n in range(3):
+            gate, fn = blocked(n)
+            gates.append(gate)
+            jobs.append(scheduler.submit('client', ('.docx', 'pdf'), MB, fn))
+        assert scheduler.stats() == {'running': 2, 'queued': 1, 'completed': 0, 'rejected': 0}
+        for gate in gates:
+            gate.set()
+        assert await asyncio.gather(*(job.future for job in jobs)) == [0, 1, 2]
+        await asyncio.sleep(0)
+        assert scheduler.stats() == {'running': 0, 'queued': 0, 'completed': 3, 'rejected': 0}
+
+    asyncio.run(main())
+
+
+def test_a_full_queue_turns_jobs_away():
+    async def main():
+        scheduler = ConversionScheduler(1, max_queue=1)
+        gate, fn = blocked()
+        running = scheduler.submit('client', ('.docx', 'pdf'), MB, fn)
+        waiting = scheduler.submit('client', ('.docx', 'pdf'), MB, fn)
+        assert scheduler.full()
+        with pytest.raises(QueueFull):
+            scheduler.submit('client', ('.docx', 'pdf'), MB, fn)
+        assert scheduler.stats()['rejected'] == 1
+        gate.set()
+        await asyncio.gather(running.future, waiting.future)
+
+    asyncio.run(main())
+
+
+def test_clients_with_fewer_running_jobs_go_first_then_shortest_first():
+    async def main():
+        scheduler = ConversionScheduler(2)
+        order = []
+        gate_a1, fn_a1 = blocked()
+        gate_a2, fn_a2 = blocked()
+        a1 = scheduler.submit('a', ('.docx', 'pdf'), MB, fn_a1)
+        a2 = scheduler.submit('a', ('.docx', 'pdf'), MB, fn_a2)
+        small = scheduler.submit('a', ('.docx', 'pdf'), 1 * MB, lambda: order.append('small'))
+        large = scheduler.submit('a', ('.docx', 'pdf'), 9 * MB, lambda: order.append('large'))
+        other = scheduler.submit('b', ('.docx', 'pdf'), 50 * MB, lambda: order.append('b'))
+        # client b has nothing running, so its big job is first in line
+        assert [scheduler.position(job)[0] for job in (small, large, other)] == [2, 3, 1]
+        assert scheduler.position(a1) == (0, pytest.approx(1.0, abs=0.1))
+        # with a2 holding one slot, the rest run one at a time in queue order
+        gate_a1.set()
+        await asyncio.gather(a1.future, small.future, large.future, other.future)
+        assert order == ['b', 'small', 'large']
+        gate_a2.set()
+        await a2.future
+
+    asyncio.run(main())
+
+
+def test_only_waiting_jobs_can_be_cancelled():
+    async def main():
+        scheduler = ConversionScheduler(1)
+        gate, fn = blocked()
+        running = scheduler.submit('client', ('.docx', 'pdf'), MB, fn)
+        waiting = scheduler.submit('client', ('.docx', 'pdf'), MB, fn)
+        assert scheduler.cancel(waiting)
+        assert waiting.future.cancelled()
+        assert not scheduler.cancel(running)
+        gate.set()
+        assert await running.future == 'done'
+        assert scheduler.stats()['queued'] == 0
+
+    asyncio.run(main())
+
+
+def test_failures_reach_the_future():
+    async def main():
+        scheduler = ConversionScheduler(1)
+
+        def fail():
+            raise RuntimeError("soffice died")
+
+        job = scheduler.submit('client', ('.docx', 'pdf'), MB, fail)
+        with pytest.raises(RuntimeError):
+            await job.future
+        assert job.finished is None
+        scheduler.record(job)
+        assert scheduler.seconds_per_byte == {}
+
+    asyncio.run(main())
+
+
+def test_estimates_learn_from_recorded_jobs():
+    async def main():
+        scheduler = ConversionScheduler(1)
+        kind = ('.docx', 'pdf')
+        assert scheduler.estimate(kind, 4 * MB) == pytest.approx(4 * DEFAULT_SECONDS_PER_MB)
+        assert scheduler.estimate(kind, 1) == MIN_ESTIMATE
+        job = scheduler.submit('client', kind, 2 * MB, lambda: None)
+        await job.future
+        job.started, job.finished = 100.0, 110.0
+        scheduler.record(job)
+        assert scheduler.estimate(kind, 4 * MB) == pytest.approx(20.0)
+        # other pairs keep the default
+        assert scheduler.estimate(('.xlsx', 'pdf'), 4 * MB) == pytest.approx(4.0)
+
+    asyncio.run(main())
@@ -0,0 +1,353 @@
+import hashlib
+import os
+import socket
+import uuid
+
+import pytest
+
+from common.protocol import (CAP_STRIPE, HELLO_MAGIC, MAX_PACKET_SIZE, QUEUE_STATUS,
+                             RESULT_ERROR, RESULT_OK, STATUS_BUSY, STATUS_ERROR, STATUS_HAVE,
+                             STATUS_IDLE, STATUS_QUEUED, STATUS_READY, STATUS_SEND,
+                             TransferParams, recv_exact, recv_json, send_json)
+from common.datagram import HAVE_AESGCM
+from common.transfer import HAVE_PWRITE
+from scheduler import ConversionScheduler
+
+
+def document(size=200_000):
+    # fresh bytes, so nothing is answered from the caches of earlier tests
+    return os.urandom(size)
+
+
+def read_result(sock):
+    """Skip QUEUE_STATUS frames; returns the result code and, if OK, the file name."""
+    response = recv_exact(sock, 2)
+    while response == QUEUE_STATUS:
+        recv_json(sock)
+        response = recv_exact(sock, 2)
+    if response != RESULT_OK:
+        return response, None
+    name_len = int(recv_exact(sock, 4).decode().strip())
+    return response, recv_exact(sock, name_len).decode()
+
+
+def v1_job(transport, port, data, dest, name='doc.docx', output_format='pdf'):
+    """The original protocol: name and format, then the upload, then the result."""
+    sock = transport.connect('127.0.0.1', port)
+    try:
+        sock.sendall(str(len(name)).encode().ljust(4) + name.encode()
+                     + output_format.encode().ljust(8))
+        transport.send_with_ack(sock, data)
+        response, result_name = read_result(sock)
+        if response == RESULT_OK:
+            transport.receive_with_ack(sock, str(dest))
+        return response, result_name
+    finally:
+        sock.close()
+
+
+def v2_job(transport, port, data, dest, name='doc.docx', output_format='pdf', result_id=None,
+           **hello):
+    """Hash-first hello; returns the server's reply, the result code and name.
+
+    ``result_id`` is a claimed DOWNLOADS entry to receive the result into.
+    """
+    sock = transport.connect('127.0.0.1', port)
+    try:
+        return v2_exchange(transport, sock, data, dest, name, output_format, result_id, **hello)
+    finally:
+        sock.close()
+
+
+def v2_exchange(transport, sock, data, dest, name='doc.docx', output_format='pdf',
+                result_id=None, **hello):
+    """One v2 job on an open connection, as v2_job."""
+    hello = {'filename': name, 'output_format': output_format, 'size': len(data),
+             'digest': hashlib.sha256(data).hexdigest(), 'max_packet': MAX_PACKET_SIZE,
+             'caps': transport.SUPPORTED_CAPS, **hello}
+    sock.sendall(HELLO_MAGIC)
+    send_json(sock, hello)
+    reply = recv_json(sock)
+    if reply['status'] not in (STATUS_HAVE, STATUS_SEND):
+        return reply, None, None
+    params = TransferParams.negotiate(reply, transport.PACKET_SIZE, MAX_PACKET_SIZE,
+                                      caps=transport.SUPPORTED_CAPS,
+                                      codecs=transport.COMPRESSION_CODECS,
+                                      stripes=transport.STRIPES)
+    if reply['status'] == STATUS_SEND:
+        transport.send_upload(sock, data, reply, params=params)
+    response, result_name = read_result(sock)
+    if response == RESULT_OK:
+        transport.receive_result(sock, str(dest), params=params, transfer_id=result_id)
+    return reply, response, result_name
+
+
+def test_v1_round_trip(loopback, transport, tmp_path):
+    data = document()
+    dest = tmp_path / 'out.pdf'
+    assert v1_job(transport, loopback.port, data, dest) == (RESULT_OK, 'doc.pdf')
+    assert dest.read_bytes() == loopback.converted(data, 'pdf')
+
+
+def test_v1_upload_that_cannot_be_stored_fails_cleanly(loopback, transport, tmp_path,
+                                                       monkeypatch):
+    monkeypatch.setattr(loopback.server.INPUTS, 'get_or_create', lambda *args: (None, False))
+    response, _ = v1_job(transport, loopback.port, document(), tmp_path / 'out.pdf')
+    assert response == RESULT_ERROR
+
+
+@pytest.mark.parametrize('name,output_format', [('a.exe', 'pdf'), ('a.docx', 'exe')])
+def test_v1_rejects_bad_jobs_before_the_upload(loopback, transport, name, output_format):
+    sock = transport.connect('127.0.0.1', loopback.port)
+    try:
+        sock.sendall(str(len(name)).encode().ljust(4) + name.encode()
+                     + output_format.encode().ljust(8))
+        assert recv_exact(sock, 2) == RESULT_ERROR
+    finally:
+        sock.close()
+
+
+def test_v2_uploads_once_then_skips_the_upload(loopback, transport, tmp_path):
+    data = document()
+    reply, response, name = v2_job(transport, loopback.port, data, tmp_path / 'first.pdf')
+    assert (reply['status'], response, name) == (STATUS_SEND, RESULT_OK, 'doc.pdf')
+    assert (tmp_path / 'first.pdf').read_bytes() == loopback.converted(data, 'pdf')
+
+    reply, response, _ = v2_job(transport, loopback.port, data, tmp_path / 'again.pdf')
+    assert (reply['status'], response) == (STATUS_HAVE, RESULT_OK)
+    assert (tmp_path / 'again.pdf').read_bytes() == loopback.converted(data, 'pdf')
+
+
+@pytest.mark.parametrize('name,output_format', [('a.exe', 'pdf'), ('a.docx', 'exe')])
+def test_v2_turns_away_bad_jobs_before_the_upload(loopback, transport, tmp_path, name,
+                                                  output_format):
+    reply, _, _ = v2_job(transport, loopback.port, document(10), tmp_path / 'out', name,
+                         output_format)
+    assert reply['status'] == STATUS_ERROR
+    assert reply['message'].startswith("Unsupported")
+
+
+def test_v2_full_queue_turns_jobs_away_before_the_upload(loopback, transport, tmp_path,
+                                                        monkeypatch):
+    monkeypatch.setattr(loopback.server, 'SCHEDULER', ConversionScheduler(1, max_queue=0))
+    reply, _, _ = v2_job(transport, loopback.port, document(), tmp_path / 'out.pdf')
+    assert reply['status'] == STATUS_BUSY
+    assert reply['retry_after'] >= 0
+
+
+def test_only_successful_conversions_feed_the_estimates(loopback, transport, tmp_path,
+                                                         monkeypatch):
+    scheduler = ConversionScheduler(1)
+    monkeypatch.setattr(loopback.server, 'SCHEDULER', scheduler)
+    monkeypatch.setattr(loopback.server.CONVERTER, 'convert', lambda *args: False)
+    _, response, _ = v2_job(transport, loopback.port, document(), tmp_path / 'out.pdf')
+    assert response == RESULT_ERROR
+    assert scheduler.seconds_per_byte == {}
+
+    monkeypatch.undo()
+    monkeypatch.setattr(loopback.server, 'SCHEDULER', scheduler)
+    _, response, _ = v2_job(transport, loopback.port, document(), tmp_path / 'out.pdf')
+    assert response == RESULT_OK
+    assert list(scheduler.seconds_per_byte) == [('.docx', 'pdf')]
+
+
+def test_session_overlaps_several_jobs(loopback, transport, tmp_path, monkeypatch):
+    fake_convert = loopback.server.CONVERTER.convert
+
+    def convert(input_path, output_path, output_format):
+        with open(input_path, 'rb') as f:
+            if f.read(6) == b'broken':
+                return False
+        return fake_convert(input_path, output_path, output_format)
+
+    monkeypatch.setattr(loopback.server.CONVERTER, 'convert', convert)
+    docs = {'1': document(), '2': document(50_000), '3': b'broken' + document()}
+    sock = transport.connect('127.0.0.1', loopback.port)
+    try:
+        params = transport.open_session(sock, 'reno')
+        assert transport.fetch_result(sock, params, str(tmp_path))['status'] == STATUS_IDLE
+        for job_id, data in docs.items():
+            status = transport.submit_job(sock, params, job_id, f"doc{job_id}.docx", data, 'pdf')
+            assert status == STATUS_QUEUED
+        assert transport.submit_job(sock, params, '1', 'doc.docx', b'x', 'pdf') == STATUS_ERROR
+        assert transport.submit_job(sock, params, '4', 'doc.exe', b'x', 'pdf') == STATUS_ERROR
+
+        replies = {}
+        while len(replies) < len(docs):
+            reply = transport.fetch_result(sock, params, str(tmp_path))
+            replies[reply['job']] = reply
+        assert transport.fetch_result(sock, params, str(tmp_path))['status'] == STATUS_IDLE
+        transport.close_session(sock)
+    finally:
+        sock.close()
+
+    assert replies['3']['status'] == STATUS_ERROR
+    for job_id in ('1', '2'):
+        assert replies[job_id]['status'] == STATUS_READY
+        assert replies[job_id]['filename'] == f"doc{job_id}.pdf"
+        with open(replies[job_id]['path'], 'rb') as f:
+            assert f.read() == loopback.converted(docs[job_id], 'pdf')
+
+
+def test_v2_resumes_an_interrupted_upload(loopback, transport, tmp_path):
+    data = document()
+    digest = hashlib.sha256(data).hexdigest()
+    # what a dropped connection would have left on the server
+    transfer_id = uuid.uuid4().hex
+    partials = loopback.server.PARTIALS
+    with open(partials.path(transfer_id), 'wb') as f:
+        f.write(data[:120_000])
+    partials.prepare(transfer_id, f"{digest}:{len(data)}", 120_000)
+
+    reply, response, _ = v2_job(transport, loopback.port, data, tmp_path / 'out.pdf',
+                                transfer_id=transfer_id)
+    assert (reply['status'], reply['resume_offset'], response) == (STATUS_SEND, 120_000, RESULT_OK)
+    assert (tmp_path / 'out.pdf').read_bytes() == loopback.converted(data, 'pdf')
+    assert not os.path.exists(partials.path(transfer_id))
+
+
+def test_v2_resumes_an_interrupted_download(loopback, transport, tmp_path):
+    data = document()
+    expected = loopback.converted(data, 'pdf')
+    v2_job(transport, loopback.port, data, tmp_path / 'first.pdf')
+    digest = hashlib.sha256(data).hexdigest()
+    etag = loopback.server.file_etag(os.path.join(loopback.server.CACHE.root, f"{digest}.pdf"))
+
+    result_id = transport.download_id(digest, 'pdf')
+    assert transport.DOWNLOADS.claim(result_id)
+    # a marked prefix, so the result shows the server really skipped it
+    with open(transport.DOWNLOADS.path(result_id), 'wb') as f:
+        f.write(b'#' * 50_000)
+    transport.DOWNLOADS.prepare(result_id, etag, 50_000)
+    hint = transport.resume_hint(result_id)
+    assert hint == {'offset': 50_000, 'etag': etag}
+
+    _, response, _ = v2_job(transport, loopback.port, data, tmp_path / 'out.pdf',
+                            result_id=result_id, download=hint)
+    assert response == RESULT_OK
+    assert (tmp_path / 'out.pdf').read_bytes() == b'#' * 50_000 + expected[50_000:]
+    assert transport.DOWNLOADS.held(result_id) == (None, 0)
+
+
+def test_v2_restarts_a_download_whose_file_changed(loopback, transport, tmp_path):
+    data = document()
+    result_id = uuid.uuid4().hex
+    assert transport.DOWNLOADS.claim(result_id)
+    with open(transport.DOWNLOADS.path(result_id), 'wb') as f:
+        f.write(b'#' * 50_000)
+    transport.DOWNLOADS.prepare(result_id, 'stale-etag', 50_000)
+    _, response, _ = v2_job(transport, loopback.port, data, tmp_path / 'out.pdf',
+                            result_id=result_id, download=transport.resume_hint(result_id))
+    assert response == RESULT_OK
+    assert (tmp_path / 'out.pdf').read_bytes() == loopback.converted(data, 'pdf')
+
+
+def test_jobs_show_up_in_the_metrics(loopback, transport, tmp_path):
+    metrics = loopback.server.METRICS
+    uploads = (('direction', 'in'), ('outcome', 'ok'))
+    before = metrics.transfers.values.get(uploads, 0)
+    v2_job(transport, loopback.port, document(), tmp_path / 'out.pdf')
+    assert metrics.transfers.values[uploads] == before + 1
+    assert metrics.delivered.values[(('direction', 'in'),)] > 0
+    text = metrics.prometheus()
+    assert 'filefusion_conversion_seconds_count{kind="docx->pdf"}' in text
+    assert 'filefusion_cache_lookups_total{result="miss"}' in text
+
+
+def test_client_connections_turn_off_nagle(loopback, transport):
+    sock = transport.connect('127.0.0.1', loopback.port)
+    try:
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    finally:
+        sock.close()
+
+
+@pytest.fixture
+def striped(loopback, transport, monkeypatch):
+    """Stripe anything over 256 KiB, over up to four connections."""
+    if not HAVE_PWRITE:
+        pytest.skip("striping needs os.pwrite")
+    monkeypatch.setattr(loopback.server, 'STRIPE_MIN_BYTES', 256 << 10)
+    monkeypatch.setattr(loopback.server, 'MAX_STRIPES', 4)
+    monkeypatch.setattr(transport, 'STRIPES', 4)
+
+
+def test_stripe_ranges_cover_the_file(loopback):
+    params = TransferParams(caps=CAP_STRIPE, stripes=4)
+    assert loopback.server.stripe_ranges(None, params) is None
+    assert loopback.server.stripe_ranges(loopback.server.STRIPE_MIN_BYTES, params) is None
+    size = 3 * loopback.server.STRIPE_MIN_BYTES + 1
+    ranges = loopback.server.stripe_ranges(size, params)
+    assert len(ranges) == 3
+    assert ranges[0][0] == 0 and ranges[-1][1] == size
+    assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+
+
+def test_v2_stripes_a_large_upload_and_download(striped, loopback, transport, tmp_path):
+    data = document(1 << 20)
+    reply, response, _ = v2_job(transport, loopback.port, data, tmp_path / 'out.pdf',
+                                stripes=4)
+    assert reply['status'] == STATUS_SEND
+    assert len(reply['ranges']) == 4
+    assert response == RESULT_OK
+    assert (tmp_path / 'out.pdf').read_bytes() == loopback.converted(data, 'pdf')
+
+
+def test_session_stripes_large_results(striped, loopback, transport, tmp_path):
+    data = document(1 << 20)
+    sock = transport.connect('127.0.0.1', loopback.port)
+    try:
+        params = transport.open_session(sock, 'reno')
+        assert transport.submit_job(sock, params, 1, 'doc.docx', data, 'pdf') == STATUS_QUEUED
+        reply = transport.fetch_result(sock, params, str(tmp_path))
+        transport.close_session(sock)
+    finally:
+        sock.close()
+    assert len(reply['ranges']) == 4
+    with open(reply['path'], 'rb') as f:
+        assert f.read() == loopback.converted(data, 'pdf')
+
+
+def test_keepalive_connections_carry_several_jobs(loopback, transport, tmp_path):
+    pool = transport.ConnectionPool('127.0.0.1', loopback.port)
+    try:
+        sock = pool.acquire()
+        for n in range(3):
+            data = document()
+            reply, response, _ = v2_exchange(transport, sock, data, tmp_path / f"{n}.pdf")
+            assert response == RESULT_OK
+            assert (tmp_path / f"{n}.pdf").read_bytes() == loopback.converted(data, 'pdf')
+        pool.release(sock, reply['keepalive'])
+        assert pool.acquire() is sock
+        pool.discard(sock)
+
+        # a fresh connection resumes the TLS session of the last one
+        fresh = pool.acquire()
+        assert fresh is not sock
+        assert fresh.session_reused
+        pool.discard(fresh)
+    finally:
+        pool.close()
+
+
+@pytest.mark.skipif(not HAVE_AESGCM, reason="needs the cryptography package")
+def test_session_over_udp(loopback, transport, tmp_path):
+    docs = [document(), document(300_000)]
+    sock = transport.connect('127.0.0.1', loopback.port)
+    params = None
+    try:
+        params = transport.open_session(sock, 'reno', 'udp')
+        assert params.channel is not None
+        assert params.packet_size <= params.channel.max_payload
+        for job_id, data in enumerate(docs):
+            status = transport.submit_job(sock, params, job_id, f"doc{job_id}.docx", data, 'pdf')
+            assert status == STATUS_QUEUED
+        replies = [transport.fetch_result(sock, params, str(tmp_path)) for _ in docs]
+        transport.close_session(sock)
+    finally:
+        if params and params.channel:
+            params.channel.close()
+        sock.close()
+    for reply in replies:
+        with open(reply['path'], 'rb') as f:
+            assert f.read() == loopback.converted(docs[reply['job']], 'pdf')
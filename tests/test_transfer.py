@@ -0,0 +1,306 @@
+import hashlib
+import io
+import socket
+
+import pytest
+
+from common.compression import make_codec
+from common.protocol import END_SEQ
+from common.transfer import (DelayedAck, PacketSource, PeerWindow, Scoreboard,
+                             StreamingReceiver, file_sha256)
+
+
+class Collector:
+    """Socket stand-in that keeps everything sent to it."""
+
+    def __init__(self):
+        self.sent = bytearray()
+
+    def sendall(self, data):
+        self.sent += data
+
+
+def payload(seq_num, size=10):
+    return bytes([seq_num]) * size
+
+
+def test_receiver_writes_in_order_packets_through():
+    f = io.BytesIO()
+    receiver = StreamingReceiver(f, 10)
+    assert receiver.accept(0, payload(0))
+    assert receiver.accept(1, payload(1))
+    assert f.getvalue() == payload(0) + payload(1)
+    assert receiver.last_in_order == 1
+
+
+def test_receiver_buffers_out_of_order_packets_until_the_hole_fills():
+    f = io.BytesIO()
+    receiver = StreamingReceiver(f, 10)
+    for seq_num in (0, 2, 3, 5):
+        receiver.accept(seq_num, payload(seq_num))
+    assert f.getvalue() == payload(0)
+    assert receiver.last_in_order == 0
+
+    receiver.accept(1, payload(1))
+    assert f.getvalue() == b''.join(payload(s) for s in range(4))
+    assert receiver.last_in_order == 3
+
+
+def test_receiver_reports_held_ranges_as_sack_blocks():
+    receiver = StreamingReceiver(io.BytesIO(), 10)
+    assert receiver.sack_blocks() == []
+    for seq_num in (0, 2, 3, 5):
+        receiver.accept(seq_num, payload(seq_num))
+    assert receiver.sack_blocks() == [(2, 3), (5, 5)]
+    assert receiver.sack_blocks(limit=1) == [(2, 3)]
+    receiver.accept(1, payload(1))
+    assert receiver.sack_blocks() == [(5, 5)]
+
+
+def test_receiver_rejects_duplicates():
+    receiver = StreamingReceiver(io.BytesIO(), 10)
+    receiver.accept(0, payload(0))
+    receiver.accept(2, payload(2))
+    assert not receiver.accept(0, payload(0))
+    assert not receiver.accept(2, payload(2))
+    assert receiver.bytes_written == 10
+
+
+def test_receiver_drops_beyond_the_reorder_limit():
+    receiver = StreamingReceiver(io.BytesIO(), 10, max_buffered=2)
+    assert receiver.accept(2, payload(2))
+    assert receiver.accept(3, payload(3))
+    assert not receiver.accept(4, payload(4))
+    receiver.accept(0, payload(0))
+    receiver.accept(1, payload(1))
+    assert receiver.last_in_order == 3
+
+
+def test_receiver_window_shrinks_while_a_hole_is_open():
+    receiver = StreamingReceiver(io.BytesIO(), 10, max_buffered=4, buffer_bytes=15)
+    assert receiver.window() == 15
+    receiver.accept(1, payload(1))
+    assert receiver.window() == 5
+    assert not receiver.accept(2, payload(2))
+    receiver.accept(0, payload(0))
+    assert receiver.window() == 15
+
+
+def test_receiver_window_is_zero_with_no_free_slots():
+    receiver = StreamingReceiver(io.BytesIO(), 10, max_buffered=1)
+    receiver.accept(3, payload(3))
+    assert receiver.window() == 0
+
+
+def test_oversized_packet_is_refused():
+    receiver = StreamingReceiver(io.BytesIO(), 10)
+    with pytest.raises(ValueError):
+        receiver.parse_header((0).to_bytes(4, 'big') + (11).to_bytes(4, 'big'))
+
+
+@pytest.mark.parametrize('codec', [None, 'zlib'])
+def test_packets_round_trip_over_a_socket(codec):
+    data = (b'FileFusion ' * 2000) if codec else bytes(range(256)) * 80
+    sender, receiver_sock = socket.socketpair()
+    try:
+        source = PacketSource(data, 4096)
+        # one packet per write, so each can be read back before the next
+        source.batch_bytes = 0
+        if codec:
+            source.enable_compression(make_codec(codec))
+            assert source.stats is not None
+        out = io.BytesIO()
+        receiver = StreamingReceiver(out, 4096, codec=make_codec(codec))
+        seq_num = 0
+        while source.has_packet(seq_num):
+            source.send(sender, seq_num)
+            got, view = receiver.read_packet(receiver_sock)
+            assert got == seq_num
+            receiver.accept(got, view)
+            seq_num += 1
+        sender.sendall(END_SEQ.to_bytes(4, 'big') + (0).to_bytes(4, 'big'))
+        assert receiver.read_packet(receiver_sock) == (None, None)
+        assert out.getvalue() == data
+        if codec:
+            assert receiver.stats.raw_bytes == len(data) > receiver.stats.wire_bytes
+        source.close()
+    finally:
+        sender.close()
+        receiver_sock.close()
+
+
+def test_source_cuts_packets_on_demand():
+    source = PacketSource(b'x' * 25, 10)
+    assert [source.has_packet(s) for s in range(4)] == [True, True, True, False]
+    assert [source.bounds[s] for s in range(3)] == [(0, 10), (10, 20), (20, 25)]
+    assert not source.finished(2)
+    assert source.finished(3)
+    source.release(2)
+    assert list(source.bounds) == [2]
+
+
+def test_source_payloads_are_views_of_the_input():
+    data = bytearray(b'abcdefghij' * 3)
+    source = PacketSource(data, 10)
+    source.has_packet(0)
+    view = source.payload(0)
+    data[0:1] = b'z'
+    assert bytes(view[:1]) == b'z'
+
+
+def test_source_from_file_releases_the_mapping_on_close(tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(b'y' * 100)
+    source = PacketSource.from_file(str(path), 10, byte_range=(20, 60))
+    assert source.total_size == 40
+    assert bytes(source.view[:3]) == b'yyy'
+    source.close()
+    with pytest.raises(ValueError):
+        source.view[0]
+
+
+def test_adaptive_source_grows_after_clean_acks_and_halves_on_loss():
+    source = PacketSource(b'', 8192, 65536, adaptive=True)
+    grown = [source.on_progress() for _ in range(16)]
+    assert grown == [False] * 15 + [True]
+    assert source.packet_size == 16384
+    assert source.on_loss() and source.packet_size == 8192
+    assert source.on_loss() and source.packet_size == 4096
+    assert not source.on_loss()
+    assert source.packet_size == 4096
+
+
+def test_fixed_source_ignores_progress_and_loss():
+    source = PacketSource(b'', 8192, 65536)
+    assert not any(source.on_progress() for _ in range(32))
+    assert not source.on_loss()
+    assert source.packet_size == 8192
+
+
+def test_retransmit_reuses_the_original_byte_range():
+    source = PacketSource(bytes(range(100)), 40, 80, adaptive=True)
+    source.has_packet(0)
+    source.packet_size = 10
+    source.has_packet(1)
+    assert bytes(source.payload(0)) == bytes(range(40))
+    assert bytes(source.payload(1)) == bytes(range(40, 50))
+
+
+def test_scoreboard_counts_a_hole_lost_below_three_sacked_packets():
+    scoreboard = Scoreboard()
+    scoreboard.update(4, [(6, 8), (10, 10)])
+    assert scoreboard.sacked == {6, 7, 8, 10}
+    # 9 has only one SACKed packet above it
+    assert scoreboard.lost(5, 11) == [5]
+    scoreboard.on_retransmit(5)
+    assert scoreboard.lost(5, 11) == []
+    scoreboard.on_timeout()
+    assert scoreboard.lost(5, 11) == [5]
+
+
+def test_scoreboard_forgets_what_the_cumulative_ack_covers():
+    scoreboard = Scoreboard()
+    scoreboard.update(0, [(2, 4)])
+    scoreboard.on_retransmit(1)
+    scoreboard.update(2, [(2, 4)])
+    assert scoreboard.sacked == {3, 4}
+    assert scoreboard.retransmitted == set()
+
+
+def test_preload_makes_the_digest_cover_the_resumed_prefix(tmp_path):
+    data = bytes(range(256)) * 40
+    path = tmp_path / 'part'
+    path.write_bytes(data[:3000])
+    with open(path, 'ab') as f:
+        receiver = StreamingReceiver(f, 1000)
+        receiver.preload(path, 3000)
+        for seq_num, start in enumerate(range(3000, len(data), 1000)):
+            receiver.accept(seq_num, data[start:start + 1000])
+    assert receiver.bytes_written == len(data)
+    assert receiver.sha256.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert file_sha256(path) == hashlib.sha256(data).hexdigest()
+
+
+def test_preload_refuses_a_short_file(tmp_path):
+    path = tmp_path / 'part'
+    path.write_bytes(b'x' * 100)
+    receiver = StreamingReceiver(io.BytesIO(), 10)
+    with pytest.raises(ValueError):
+        receiver.preload(path, 200)
+
+
+def test_source_skips_a_resumed_prefix():
+    source = PacketSource(bytes(range(30)), 10, start=12)
+    # the size header still announces the whole file
+    assert source.total_size == 30
+    assert source.has_packet(0)
+    assert bytes(source.payload(0)) == bytes(range(12, 22))
+    assert source.offset(0) == 12
+
+
+def test_peer_window_limits_bytes_past_the_first_unacked_packet():
+    source = PacketSource(b'z' * 50, 10)
+    for seq_num in range(5):
+        source.has_packet(seq_num)
+    window = PeerWindow()
+    assert window.allows(source, 0, 4)
+    window.update(20)
+    assert window.allows(source, 0, 1)
+    assert not window.allows(source, 0, 2)
+    assert window.allows(source, 1, 2)
+
+
+def test_peer_window_probes_back_off():
+    window = PeerWindow()
+    window.update(0)
+    window.blocked(0.0)
+    assert not window.probe_due(0.1)
+    assert window.probe_due(0.2)
+    assert window.next_probe == pytest.approx(0.6)
+    assert window.wait(0.3, 5.0) == pytest.approx(0.3)
+    window.update(1000)
+    assert window.next_probe is None
+    assert window.interval == pytest.approx(0.2)
+    assert window.wait(0.3, 5.0) == 5.0
+
+
+def test_peer_window_wait_never_reaches_zero():
+    window = PeerWindow()
+    window.blocked(0.0)
+    assert window.wait(10.0, 5.0) > 0
+
+
+def test_batched_sends_go_out_on_flush():
+    source = PacketSource(b'a' * 30, 10)
+    source.batch_bytes = 1 << 20
+    sock = Collector()
+    for seq_num in range(3):
+        source.has_packet(seq_num)
+        assert source.send(sock, seq_num) == 18
+    assert sock.sent == b''
+    source.flush(sock)
+    assert len(sock.sent) == 3 * 18
+    assert sock.sent[:8] == (0).to_bytes(4, 'big') + (10).to_bytes(4, 'big')
+
+
+def test_batches_go_out_once_they_reach_batch_bytes():
+    source = PacketSource(b'a' * 30, 10)
+    source.batch_bytes = 30
+    sock = Collector()
+    for seq_num in range(3):
+        source.has_packet(seq_num)
+        source.send(sock, seq_num)
+    assert len(sock.sent) == 2 * 18
+    source.flush(sock)
+    assert len(sock.sent) == 3 * 18
+
+
+def test_delayed_ack_holds_until_every_or_the_deadline():
+    delayed = DelayedAck(every=2, delay=0.01)
+    assert delayed.wait(0.0) is None
+    assert not delayed.on_packet(0.0)
+    assert delayed.wait(0.004) == pytest.approx(0.006)
+    assert delayed.on_packet(0.005)
+    delayed.sent()
+    assert delayed.wait(0.006) is None
+    assert delayed.on_packet(0.007, urgent=True)